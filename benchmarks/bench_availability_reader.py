@@ -0,0 +1,133 @@
+"""
+Latency of the carpark availability read API, with and without its cache, against a local Postgres.
+
+It loads a day of synthetic carpark availability snapshots, one row per lot type, into a scratch schema
+of the local Postgres (the pg-data container by default), then sends the same skewed mix of "latest
+availability" and "last 24h" lookups of single carparks through an AvailabilityReader with its cache
+and one without it, and reports the p50 and p99 latency of each. It also times one batched lookup of
+many carparks against the same carparks looked up one by one, and checks that a new snapshot clears the cache.
+
+Usage:
+    python benchmarks/bench_availability_reader.py [--dsn "host=localhost port=5439 user=postgres password=docker"]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.availability_reader import AvailabilityReader
+
+SCHEMA = 'bench_availability_reader'
+TABLE = f'{SCHEMA}.carpark_availability'
+LOT_TYPES = {'C': 300, 'Y': 40, 'H': 10}
+START = datetime(2019, 8, 1)
+
+
+def load_snapshots(conn, carparks, snapshots, start):
+    """ COPY `snapshots` snapshots every 10 minutes from start, one row per carpark and lot type """
+    rng = random.Random(snapshots)
+    buffer = io.StringIO()
+    for i in range(snapshots):
+        date_time = (start + timedelta(minutes=10 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        for carpark in range(carparks):
+            for lot_type, total in LOT_TYPES.items():
+                buffer.write(f"{date_time},CP{carpark:04d},{lot_type},{rng.randint(0, total)},{total}\n")
+    buffer.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY {TABLE} (date_time, carpark_id, lot_type, lots_available, total_lots) FROM STDIN WITH (FORMAT CSV)", buffer)
+    conn.commit()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_workload(reader, workload):
+    """ Send every lookup of the workload, and return the latency of each of them in ms """
+    latencies = []
+    for kind, carpark_id in workload:
+        started = time.perf_counter()
+        if kind == 'latest':
+            reader.latest([carpark_id])
+        else:
+            reader.recent([carpark_id], hours=24)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default="host=localhost port=5439 user=postgres password=docker")
+    parser.add_argument('--carparks', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET TIME ZONE 'UTC';")
+        cursor.execute(f"CREATE TABLE {TABLE} (date_time timestamptz NOT NULL, carpark_id varchar, lot_type varchar, "
+                       "lots_available integer, total_lots integer)")
+        # Stands in for the compound sort key (date_time, carpark_id) of the fact table in Redshift.
+        cursor.execute(f"CREATE INDEX ON {TABLE} (date_time, carpark_id)")
+    conn.commit()
+    load_snapshots(conn, args.carparks, 144, START)
+    with conn.cursor() as cursor:
+        cursor.execute(f"ANALYZE {TABLE}")
+    conn.commit()
+
+    # A few popular carparks get most of the lookups, like the carparks near the city centre.
+    rng = random.Random(0)
+    workload = [('latest' if rng.random() < 0.8 else 'recent',
+                 f"CP{min(int(rng.paretovariate(0.8)) - 1, args.carparks - 1):04d}") for _ in range(args.requests)]
+
+    try:
+        print(f"{args.requests} lookups of {len({carpark_id for _, carpark_id in workload})} distinct carparks")
+        print(f"{'reader':>9} {'p50 ms':>8} {'p99 ms':>8} {'total s':>8}")
+        for name, cache_size in (('uncached', 0), ('cached', 4096)):
+            reader = AvailabilityReader(args.dsn, table=TABLE, cache_size=cache_size)
+            latencies = run_workload(reader, workload)
+            reader.close()
+            print(f"{name:>9} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.99):>8.3f} {sum(latencies) / 1000:>8.2f}")
+
+        reader = AvailabilityReader(args.dsn, table=TABLE, cache_size=0)
+        carpark_ids = [f"CP{carpark:04d}" for carpark in range(args.batch)]
+        started = time.perf_counter()
+        batched = reader.latest(carpark_ids)
+        batched_time = time.perf_counter() - started
+        started = time.perf_counter()
+        single = {}
+        for carpark_id in carpark_ids:
+            single.update(reader.latest([carpark_id]))
+        single_time = time.perf_counter() - started
+        reader.close()
+        if batched != single:
+            raise ValueError("The batched lookup does not match the single lookups")
+        print(f"latest of {args.batch} carparks: {batched_time * 1000:.1f} ms batched, {single_time * 1000:.1f} ms one by one")
+
+        # A new snapshot lands: the cached reader must serve it at the next freshness check, not after the TTL.
+        reader = AvailabilityReader(args.dsn, table=TABLE, freshness_interval=0)
+        before = reader.latest(['CP0000'])['CP0000'][0]
+        load_snapshots(conn, args.carparks, 1, START + timedelta(days=1))
+        after = reader.latest(['CP0000'])['CP0000'][0]
+        reader.close()
+        if after <= before:
+            raise ValueError(f"The cache still served the snapshot at {before} after a new one landed")
+        print(f"new snapshot served after invalidation: {before} -> {after}")
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark for flattening the Carpark Availability payload.
+
+It generates a synthetic payload of ~2,000 carparks, runs both the previous pandas implementation
+(itertuples + json_normalize + concat) and the single-pass `flatten_carpark`, checks that the columns
+are in the order of staging_carpark_availability and that both produce exactly the same CSV in that order,
+and reports the rows/sec of each.
+
+Usage:
+    python benchmarks/bench_carpark_flatten.py [--carparks 2000] [--repeat 10]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.transforms import flatten_carpark
+
+try:
+    from pandas import json_normalize
+except ImportError:
+    from pandas.io.json import json_normalize
+
+LOT_TYPES = ['C', 'H', 'Y', 'L']
+EXECUTION_TIME = '2019-08-09T10:00:00'
+# The column order of staging_carpark_availability, loaded by position by COPY.
+# The json_normalize of older pandas sorted the keys of carpark_info in this order, newer versions keep the json order.
+STAGING_COLUMNS = ['timestamp', 'carpark_number', 'lot_type', 'lots_available', 'total_lots']
+
+
+def make_carpark_payload(num_carparks, seed=0):
+    """ Build a payload shaped like the carpark-availability API response """
+    rng = random.Random(seed)
+    carpark_data = []
+    for i in range(num_carparks):
+        carpark_info = []
+        for lot_type in rng.sample(LOT_TYPES, rng.randint(1, 3)):
+            total_lots = rng.randint(20, 800)
+            carpark_info.append({
+                'total_lots': str(total_lots),
+                'lot_type': lot_type,
+                'lots_available': str(rng.randint(0, total_lots)),
+            })
+        carpark_data.append({
+            'carpark_info': carpark_info,
+            'carpark_number': 'CP{:04d}'.format(i),
+            'update_datetime': '2019-08-09T09:58:12',
+        })
+    return {'items': [{'timestamp': '2019-08-09T09:59:27+08:00', 'carpark_data': carpark_data}]}
+
+
+def legacy_flatten_carpark(json_data, execution_time):
+    """ The previous implementation in getCarpark.py, kept here as the baseline """
+    carpark_data = pd.DataFrame(json_data['items'])
+    if (carpark_data.empty != True):
+        carpark_data = pd.DataFrame([(tup.timestamp, d) for tup in carpark_data.itertuples() for d in tup.carpark_data])
+        carpark_data.rename(columns={0:'timestamp', 1:'readings'}, inplace=True)
+        carpark_data = pd.concat([carpark_data['timestamp'], json_normalize(carpark_data['readings'])],axis=1)
+        carpark_data = pd.DataFrame([(execution_time, tup.carpark_number, d) for tup in carpark_data.itertuples() for d in tup.carpark_info])
+        carpark_data.rename(columns={0:'timestamp', 1:'carpark_number', 2:'carpark_info'}, inplace=True)
+        carpark_data = pd.concat([pd.to_datetime(carpark_data['timestamp']), carpark_data['carpark_number'], json_normalize(carpark_data['carpark_info'])], axis=1)
+        carpark_data['timestamp'] = [x.strftime("%Y-%m-%d %H:%M:%S") for x in carpark_data['timestamp']]
+    return carpark_data
+
+
+def time_it(func, payload, repeat):
+    """ Return the best wall time over `repeat` runs and the resulting DataFrame """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(payload, EXECUTION_TIME)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--carparks', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    payload = make_carpark_payload(args.carparks)
+
+    legacy_time, legacy_result = time_it(legacy_flatten_carpark, payload, args.repeat)
+    new_time, new_result = time_it(flatten_carpark, payload, args.repeat)
+
+    if list(new_result.columns) != STAGING_COLUMNS:
+        raise ValueError(f"The flattened columns {list(new_result.columns)} are not in the staging order {STAGING_COLUMNS}")
+    if legacy_result[STAGING_COLUMNS].to_csv(index=False) != new_result.to_csv(index=False):
+        raise ValueError("The flattened CSV is different from the previous implementation")
+
+    rows = len(new_result)
+    print(f"carparks: {args.carparks}, rows: {rows}")
+    print(f"legacy:  {legacy_time * 1000:8.2f} ms  {rows / legacy_time:12,.0f} rows/sec")
+    print(f"flatten: {new_time * 1000:8.2f} ms  {rows / new_time:12,.0f} rows/sec")
+    print(f"speedup: {legacy_time / new_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
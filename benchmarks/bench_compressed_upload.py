@@ -0,0 +1,81 @@
+"""
+Benchmark of the compressed CSV uploads of the helpers against a local S3 stand-in.
+
+It starts a local moto S3 server, flattens a day of synthetic carpark availability snapshots
+into one file (the batch size of the backfill), and uploads it with `save_dataframe` uncompressed
+and with each compression. It reports the bytes stored in S3, the upload time and the peak memory
+allocated by the upload (Python allocations traced by tracemalloc), then reads every file back to check the content is the same.
+
+Requires moto[server], and zstandard for the zstd compression.
+
+Usage:
+    python benchmarks/bench_compressed_upload.py [--snapshots 144] [--carparks 2000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from check_backfill import start_s3
+
+BUCKET = 'bench-compressed-upload'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshots', type=int, default=144)
+    parser.add_argument('--carparks', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = start_s3()
+    # Imported after the endpoint is set, so s3fs uses the local server.
+    import s3fs
+    from bench_carpark_flatten import make_carpark_payload
+    from helpers.output import output_file_name, save_dataframe
+    from helpers.transforms import flatten_carpark
+
+    fs = s3fs.S3FileSystem()
+    fs.mkdir(BUCKET)
+
+    frames = []
+    for i in range(args.snapshots):
+        execution_time = pd.Timestamp('2019-08-01') + pd.Timedelta(minutes=10 * i)
+        frames.append(flatten_carpark(make_carpark_payload(args.carparks, seed=i), execution_time.strftime('%Y-%m-%dT%H:%M:%S')))
+    data = pd.concat(frames, ignore_index=True)
+    print(f"rows: {len(data):,}, in memory: {data.memory_usage(deep=True).sum() / (1024 * 1024):.1f} MB")
+    print(f"{'compression':>12} {'stored MB':>10} {'ratio':>6} {'upload s':>9} {'peak alloc MB':>14}")
+
+    expected = pd.read_csv(pd.io.common.StringIO(data.to_csv(index=False)))
+    baseline = None
+    try:
+        for compression in (None, 'gzip', 'zstd'):
+            s3_path = f"s3a://{BUCKET}/carpark_sg/" + output_file_name('carpark', '20190801T000000', 'csv', compression)
+            fs.invalidate_cache()
+            start = time.perf_counter()
+            save_dataframe(data, s3_path, 'csv', compression=compression)
+            elapsed = time.perf_counter() - start
+            # Upload again while tracing the allocations, which slows it down too much to be timed.
+            tracemalloc.start()
+            save_dataframe(data, s3_path, 'csv', compression=compression)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            size = fs.size(s3_path.split('://', 1)[-1])
+            baseline = baseline or size
+            with fs.open(s3_path.split('://', 1)[-1], 'rb') as f:
+                read_back = pd.read_csv(f, compression={'gzip': 'gzip', 'zstd': 'zstd'}.get(compression))
+            if not read_back.equals(expected):
+                raise ValueError(f"The {compression} upload does not read back the same data")
+            print(f"{str(compression):>12} {size / (1024 * 1024):>10.2f} {baseline / size:>6.1f} {elapsed:>9.2f} {peak / (1024 * 1024):>14.1f}")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of the shared HttpClient against plain `requests.get` calls.
+
+It starts a local stub server with injected latency and failures (503 responses),
+sends the same number of calls with each client, and reports how many calls succeeded,
+the wall time, and how many TCP connections the server accepted.
+
+Usage:
+    python benchmarks/bench_http_client.py [--calls 50] [--latency 0.02] [--fail-rate 0.2]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers.http_client import HttpClient
+from stub_server import StubServer
+
+
+def handle(path, query):
+    return 200, b'{"items": []}'
+
+
+def run(get, args):
+    """ Send the calls with `get`, and return the successes, wall time and connections accepted """
+    with StubServer(handle, latency=args.latency, fail_rate=args.fail_rate) as server:
+        successes = 0
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            response = get(server.url + '/v1/transport/carpark-availability')
+            successes += response.status_code == 200
+        elapsed = time.perf_counter() - start
+        return successes, elapsed, server.connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--fail-rate', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Hide the retry warnings of the injected failures.
+    logging.basicConfig(level=logging.ERROR)
+    client = HttpClient(backoff_factor=0.01, max_backoff=0.1)
+    print(f"{'client':>8} {'succeeded':>10} {'wall s':>7} {'connections':>12}")
+    for name, get in (('requests', requests.get), ('pooled', client.get)):
+        successes, elapsed, connections = run(get, args)
+        print(f"{name:>8} {successes:>6}/{args.calls:<3} {elapsed:>7.2f} {connections:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of the SVY21 conversion and the nearest weather stations of the carparks.
+
+It draws random SVY21 coordinates over Singapore for the carparks, and random latitudes and longitudes
+for the weather stations, then times the vectorized `svy21_to_wgs84` and `nearest_stations` against
+a row by row loop computing the same nearest stations, and checks that both agree.
+
+Usage:
+    python benchmarks/bench_nearest_station.py [--carparks 2000] [--stations 60] [--k 3]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.geo import EARTH_RADIUS_KM, nearest_stations, svy21_to_wgs84
+
+
+def loop_nearest_stations(carparks, stations, k):
+    """ Reference implementation, one haversine distance at a time """
+    rows = []
+    for carpark_id, lat1, lon1 in carparks.itertuples(index=False, name=None):
+        distances = []
+        for station_id, lat2, lon2 in stations.itertuples(index=False, name=None):
+            h = (math.sin(math.radians(lat2 - lat1) / 2) ** 2
+                 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+            distances.append((2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h)), station_id))
+        for rank, (distance, station_id) in enumerate(sorted(distances)[:k], 1):
+            rows.append((carpark_id, station_id, rank, distance))
+    return pd.DataFrame(rows, columns=['carpark_id', 'station_id', 'station_rank', 'distance_km'])
+
+
+def best_time(function, repeat=5):
+    """ Return the best wall time over `repeat` runs and the result """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--carparks', type=int, default=2000)
+    parser.add_argument('--stations', type=int, default=60)
+    parser.add_argument('--k', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    northing = rng.uniform(25000, 49000, args.carparks)
+    easting = rng.uniform(5000, 48000, args.carparks)
+    stations = pd.DataFrame({
+        'station_id': [f"S{i:03d}" for i in range(args.stations)],
+        'station_latitude': rng.uniform(1.25, 1.45, args.stations),
+        'station_longitude': rng.uniform(103.65, 104.0, args.stations),
+    })
+
+    convert_time, (latitudes, longitudes) = best_time(lambda: svy21_to_wgs84(northing, easting))
+    carparks = pd.DataFrame({
+        'carpark_id': [f"CP{i:04d}" for i in range(args.carparks)],
+        'carpark_latitude': latitudes,
+        'carpark_longitude': longitudes,
+    })
+
+    vectorized_time, vectorized = best_time(lambda: nearest_stations(carparks, stations, args.k))
+    loop_time, loop = best_time(lambda: loop_nearest_stations(carparks, stations, args.k), repeat=1)
+
+    if not (vectorized['station_id'].tolist() == loop['station_id'].tolist()
+            and np.allclose(vectorized['distance_km'].values, loop['distance_km'].values)):
+        raise ValueError("The vectorized nearest stations do not match the loop")
+
+    print(f"{args.carparks} carparks x {args.stations} stations, k={args.k}")
+    print(f"svy21_to_wgs84:         {convert_time * 1000:8.2f} ms")
+    print(f"nearest_stations:       {vectorized_time * 1000:8.2f} ms")
+    print(f"row by row loop:        {loop_time * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of the CSV and Parquet output formats of the helpers.
+
+It flattens a week of synthetic carpark availability snapshots (one every 10 minutes),
+writes each snapshot as its own file in a temporary folder, the same way the helpers write to S3,
+and reports the total file size, write time and read time of each format.
+
+Usage:
+    python benchmarks/bench_output_formats.py [--days 7] [--carparks 2000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_carpark_flatten import make_carpark_payload
+from helpers.output import output_file_name, save_dataframe
+from helpers.transforms import flatten_carpark
+
+# Same as getCarpark.PARQUET_DTYPES, which cannot be imported without airflow.
+CARPARK_DTYPES = {
+    'timestamp': 'datetime',
+    'total_lots': 'Int32',
+    'lots_available': 'Int32',
+}
+
+READERS = {
+    'csv': pd.read_csv,
+    'parquet': pd.read_parquet,
+}
+
+
+def make_snapshots(days, num_carparks):
+    """ Flatten one synthetic snapshot every 10 minutes over the given number of days """
+    start = datetime(2019, 8, 1)
+    snapshots = []
+    for i in range(days * 24 * 6):
+        execution_time = start + timedelta(minutes=10 * i)
+        payload = make_carpark_payload(num_carparks, seed=i)
+        snapshots.append((execution_time.strftime('%Y%m%dT%H%M%S'),
+                          flatten_carpark(payload, execution_time.strftime('%Y-%m-%dT%H:%M:%S'))))
+    return snapshots
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--carparks', type=int, default=2000)
+    args = parser.parse_args()
+
+    snapshots = make_snapshots(args.days, args.carparks)
+    rows = sum(len(data) for _, data in snapshots)
+    print(f"snapshots: {len(snapshots)}, rows: {rows:,}")
+    print(f"{'format':>8} {'size MB':>9} {'write s':>9} {'read s':>8}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        for output_format in ('csv', 'parquet'):
+            paths = []
+            start = time.perf_counter()
+            for ts_nodash, data in snapshots:
+                path = os.path.join(folder, output_file_name('carpark', ts_nodash, output_format))
+                save_dataframe(data, path, output_format, CARPARK_DTYPES)
+                paths.append(path)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for path in paths:
+                READERS[output_format](path)
+            read_time = time.perf_counter() - start
+
+            size = sum(os.path.getsize(path) for path in paths)
+            print(f"{output_format:>8} {size / (1024 * 1024):>9.1f} {write_time:>9.2f} {read_time:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Throughput of loading the carpark availability staging table of a local Postgres.
+
+It flattens synthetic carpark availability snapshots, then loads them into a scratch copy of
+staging_carpark_availability of the local Postgres (the pg-data container by default) with:
+- insert: row by row INSERT statements with executemany, on a sample of the rows,
+- file: the CSV file written to disk first, as the S3 and server-side file paths do, then copied,
+- stdin: `copy_dataframe`, which streams the DataFrame with COPY FROM STDIN from an in-memory buffer.
+It reports the rows loaded per second of each of them.
+
+Usage:
+    python benchmarks/bench_postgres_copy.py [--dsn "host=localhost port=5439 user=postgres password=docker"] [--snapshots 144]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_carpark_flatten import make_carpark_payload
+from helpers.postgres_loader import STAGING_COLUMNS, copy_dataframe
+from helpers.sql_queries import SqlQueries
+from helpers.transforms import flatten_carpark
+
+SCHEMA = 'bench_postgres_copy'
+TABLE = 'staging_carpark_availability'
+INSERT_SAMPLE = 20000
+
+
+def create_table(conn):
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA};")
+    cur.execute(f"""CREATE TABLE {TABLE} (
+        date_time timestamptz NOT NULL,
+        carpark_id varchar,
+        lot_type varchar,
+        lots_available integer,
+        total_lots integer
+    )""")
+    conn.commit()
+
+
+def load_insert(conn, data):
+    """ Row by row INSERT of a sample of the rows """
+    sample = data[[source for source, _ in STAGING_COLUMNS[TABLE]]].head(INSERT_SAMPLE)
+    cur = conn.cursor()
+    cur.execute(f"DELETE FROM {TABLE}")
+    cur.executemany(f"INSERT INTO {TABLE} VALUES (%s, %s, %s, %s, %s)", sample.itertuples(index=False, name=None))
+    conn.commit()
+    return len(sample)
+
+
+def load_file(conn, data):
+    """ CSV file written to disk, then copied """
+    columns = STAGING_COLUMNS[TABLE]
+    copy_sql = SqlQueries.staging_copy_stdin.format(table=TABLE, columns=", ".join(target for _, target in columns))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'carpark.csv')
+        data[[source for source, _ in columns]].to_csv(path, index=False, header=False)
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM {TABLE}")
+        with open(path) as f:
+            cur.copy_expert(copy_sql, f)
+        conn.commit()
+    return len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default="host=localhost port=5439 user=postgres password=docker")
+    parser.add_argument('--snapshots', type=int, default=144)
+    parser.add_argument('--carparks', type=int, default=2000)
+    args = parser.parse_args()
+
+    frames = []
+    for i in range(args.snapshots):
+        execution_time = pd.Timestamp('2019-08-01') + pd.Timedelta(minutes=10 * i)
+        frames.append(flatten_carpark(make_carpark_payload(args.carparks, seed=i), execution_time.strftime('%Y-%m-%dT%H:%M:%S')))
+    data = pd.concat(frames, ignore_index=True)
+    print(f"rows: {len(data):,}")
+
+    conn = psycopg2.connect(args.dsn)
+    create_table(conn)
+    print(f"{'path':>6} {'rows':>9} {'seconds':>8} {'rows/s':>10}")
+    try:
+        for name, load in (('insert', load_insert), ('file', load_file), ('stdin', lambda conn, data: copy_dataframe(conn, data, TABLE))):
+            start = time.perf_counter()
+            rows = load(conn, data)
+            elapsed = time.perf_counter() - start
+            cur = conn.cursor()
+            cur.execute(f"SELECT COUNT(*) FROM {TABLE}")
+            if cur.fetchone()[0] != rows:
+                raise ValueError(f"The {name} path did not load {rows} rows")
+            print(f"{name:>6} {rows:>9,} {elapsed:>8.2f} {rows / elapsed:>10,.0f}")
+    finally:
+        cur = conn.cursor()
+        cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
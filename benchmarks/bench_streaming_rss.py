@@ -0,0 +1,103 @@
+"""
+Peak memory of the buffered versus streaming json parsing of the carpark availability payload.
+
+It starts a local stub server that serves an artificially inflated carpark availability payload,
+then fetches and flattens it in a fresh process for each mode, and reports the peak RSS of that process
+measured after the imports.
+The buffered mode is `requests.get(...).json()` as the helpers do by default, and the streaming mode
+is the opt-in `streaming` param, which parses the response incrementally from the socket.
+
+Usage:
+    python benchmarks/bench_streaming_rss.py [--scales 1 10 100]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+PLUGINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins')
+sys.path.insert(0, PLUGINS)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+EXECUTION_TIME = '2019-08-09T10:00:00'
+
+
+def reset_peak_rss():
+    """ Reset the peak RSS high-water mark on Linux, so the import of pandas does not hide the transform """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_child(mode, url):
+    """ Fetch and flatten the payload in this process, and print the row count and the peak RSS """
+    import requests
+    from helpers.streaming import iter_json_items
+    from helpers.transforms import flatten_carpark, flatten_carpark_readings
+
+    reset_peak_rss()
+
+    if mode == 'buffered':
+        carpark_data = flatten_carpark(requests.get(url).json(), EXECUTION_TIME)
+    else:
+        response = requests.get(url, stream=True)
+        readings = iter_json_items(response, 'items.item.carpark_data.item')
+        carpark_data = flatten_carpark_readings(readings, EXECUTION_TIME)
+    print(json.dumps({'rows': len(carpark_data), 'peak_rss_mb': peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help='payload size as a multiple of ~2,000 carparks')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    from bench_carpark_flatten import make_carpark_payload
+    from stub_server import StubServer
+
+    payloads = {}
+    for scale in args.scales:
+        payloads[scale] = json.dumps(make_carpark_payload(2000 * scale)).encode('utf-8')
+
+    def handle(path, query):
+        return 200, payloads[int(path.rsplit('/', 1)[-1])]
+
+    print(f"{'scale':>5} {'payload MB':>11} {'rows':>9} {'buffered MB':>12} {'streaming MB':>13}")
+    with StubServer(handle) as server:
+        for scale in args.scales:
+            results = {}
+            for mode in ('buffered', 'streaming'):
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--child', mode, f"{server.url}/carpark/{scale}"])
+                results[mode] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            if results['buffered']['rows'] != results['streaming']['rows']:
+                raise ValueError("The streaming mode returned a different number of rows")
+            print(f"{scale:>5} {len(payloads[scale]) / (1024 * 1024):>11.1f} {results['streaming']['rows']:>9,} "
+                  f"{results['buffered']['peak_rss_mb']:>12.1f} {results['streaming']['peak_rss_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
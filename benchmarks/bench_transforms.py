@@ -0,0 +1,230 @@
+"""
+Benchmark of the transform step of every helper, with no network or S3.
+
+It feeds the payloads of the data.gov.sg APIs through the transform of each helper:
+    - get_carpark:             flatten_carpark of the carpark availability response
+    - get_weather:             flatten_weather of a weather event response (air-temperature)
+    - get_carparkInfo:         transform_carpark_info of the carpark information records
+    - get_weatherStationInfo:  flatten_weather_stations of the stations metadata
+
+The payloads are synthetic by default, shaped like the API responses (~2,000 carparks and ~60 stations),
+or recorded responses saved from the APIs with --recorded. Each payload is scaled to 1x, 10x and 100x its
+carparks and stations by copying them under new ids. It reports the rows/sec, wall time (best of --repeat)
+and peak memory (traced in a separate run, so tracing does not slow down the timing) of each transform,
+and saves the results as JSON with the current commit in benchmarks/results/, which is not committed,
+to compare runs with --compare.
+
+Recorded payloads are the raw responses saved in one folder, e.g.
+    curl 'https://api.data.gov.sg/v1/transport/carpark-availability' > carpark-availability.json
+    curl 'https://api.data.gov.sg/v1/environment/air-temperature' > air-temperature.json
+    curl 'https://data.gov.sg/api/action/datastore_search?resource_id=139a3035-e624-4f56-b63f-89ae28d4ae4c&limit=5000' > carpark-info.json
+
+Usage:
+    python benchmarks/bench_transforms.py [--recorded DIR] [--scales 1 10 100] [--repeat 3]
+                                          [--output results.json] [--compare previous.json]
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.transforms import flatten_carpark, flatten_weather, flatten_weather_stations, transform_carpark_info
+
+from bench_carpark_flatten import EXECUTION_TIME, make_carpark_payload
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+
+def make_weather_payload(num_stations, seed=0):
+    """ Build a payload shaped like the weather event API responses, stations metadata included """
+    rng = random.Random(seed)
+    stations = [{
+        'id': 'S{:03d}'.format(i),
+        'device_id': 'S{:03d}'.format(i),
+        'name': 'Station {}'.format(i),
+        'location': {'latitude': round(rng.uniform(1.25, 1.45), 4), 'longitude': round(rng.uniform(103.65, 104.0), 4)},
+    } for i in range(num_stations)]
+    readings = [{'station_id': station['id'], 'value': round(rng.uniform(24, 34), 1)} for station in stations]
+    return {
+        'metadata': {'stations': stations, 'reading_type': 'DBT 1M F', 'reading_unit': 'deg C'},
+        'items': [{'timestamp': '2019-08-09T09:59:00+08:00', 'readings': readings}],
+    }
+
+
+def make_carpark_info_records(num_carparks, seed=0):
+    """ Build the records of the carpark information datastore, with their SVY21 coordinates as strings """
+    rng = random.Random(seed)
+    return [{
+        '_id': i + 1,
+        'car_park_no': 'CP{:04d}'.format(i),
+        'address': 'BLK {} SYNTHETIC STREET {}'.format(rng.randint(1, 999), rng.randint(1, 99)),
+        'x_coord': '{:.4f}'.format(rng.uniform(5000, 48000)),
+        'y_coord': '{:.4f}'.format(rng.uniform(25000, 49000)),
+        'car_park_type': 'MULTI-STOREY CAR PARK',
+        'type_of_parking_system': 'ELECTRONIC PARKING',
+        'short_term_parking': 'WHOLE DAY',
+        'free_parking': 'NO',
+        'night_parking': 'YES',
+    } for i in range(num_carparks)]
+
+
+def load_recorded(folder):
+    """ Load the recorded responses of the folder, see the usage """
+    def load(name):
+        with open(os.path.join(folder, name)) as f:
+            return json.load(f)
+
+    carpark_info = load('carpark-info.json')
+    if isinstance(carpark_info, dict):
+        # The datastore_search response, or its result.
+        carpark_info = carpark_info.get('result', carpark_info)['records']
+    return load('carpark-availability.json'), load('air-temperature.json'), carpark_info
+
+
+def scale_carpark(payload, scale):
+    """ Copy every carpark of the carpark availability payload `scale` times under new carpark numbers """
+    payload = copy.deepcopy(payload)
+    for item in payload['items']:
+        item['carpark_data'] = [dict(reading, carpark_number='{}-{}'.format(reading['carpark_number'], i) if i else reading['carpark_number'])
+                                for i in range(scale) for reading in item['carpark_data']]
+    return payload
+
+
+def scale_weather(payload, scale):
+    """ Copy every station of the weather payload, and its readings, `scale` times under new station ids """
+    def rename(station_id, i):
+        return '{}-{}'.format(station_id, i) if i else station_id
+
+    payload = copy.deepcopy(payload)
+    payload['metadata']['stations'] = [dict(station, id=rename(station['id'], i))
+                                       for i in range(scale) for station in payload['metadata']['stations']]
+    for item in payload['items']:
+        item['readings'] = [dict(reading, station_id=rename(reading['station_id'], i))
+                            for i in range(scale) for reading in item['readings']]
+    return payload
+
+
+def scale_carpark_info(records, scale):
+    """ Copy every carpark information record `scale` times under new carpark numbers """
+    return pd.DataFrame([dict(record, car_park_no='{}-{}'.format(record['car_park_no'], i) if i else record['car_park_no'])
+                         for i in range(scale) for record in records])
+
+
+def measure(transform, payload, repeat):
+    """ Return the rows, the best wall time over `repeat` runs, and the peak memory traced in one more run """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = len(transform(payload))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    transform(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, best, peak
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recorded', help="Folder of the recorded responses, synthetic payloads by default")
+    parser.add_argument('--carparks', type=int, default=2000, help="Carparks of the synthetic payloads at 1x")
+    parser.add_argument('--stations', type=int, default=60, help="Stations of the synthetic payloads at 1x")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="JSON file of the results. "
+                        "Default is bench_transforms_<commit>.json in benchmarks/results")
+    parser.add_argument('--compare', help="JSON file of a previous run, to print the change of each result")
+    args = parser.parse_args()
+
+    if args.recorded:
+        carpark, weather, carpark_info = load_recorded(args.recorded)
+        source = os.path.abspath(args.recorded)
+    else:
+        carpark = make_carpark_payload(args.carparks)
+        weather = make_weather_payload(args.stations)
+        carpark_info = make_carpark_info_records(args.carparks)
+        source = 'synthetic'
+
+    # The helper, its transform, and the payload at a given scale.
+    transforms = [
+        ('get_carpark', lambda payload: flatten_carpark(payload, EXECUTION_TIME), lambda scale: scale_carpark(carpark, scale)),
+        ('get_weather', flatten_weather, lambda scale: scale_weather(weather, scale)),
+        ('get_carparkInfo', transform_carpark_info, lambda scale: scale_carpark_info(carpark_info, scale)),
+        ('get_weatherStationInfo', lambda payload: flatten_weather_stations(payload['metadata']['stations']),
+         lambda scale: scale_weather(weather, scale)),
+    ]
+
+    commit = git_commit()
+    results = []
+    print(f"{'helper':<24} {'scale':>5} {'rows':>9} {'wall ms':>10} {'rows/s':>12} {'peak MB':>9}")
+    for helper, transform, make_payload in transforms:
+        for scale in args.scales:
+            payload = make_payload(scale)
+            rows, wall_time, peak = measure(transform, payload, args.repeat)
+            del payload
+            result = {
+                'helper': helper,
+                'scale': scale,
+                'rows': rows,
+                'wall_time_s': wall_time,
+                'rows_per_s': rows / wall_time if wall_time else None,
+                'peak_memory_bytes': peak,
+            }
+            results.append(result)
+            print(f"{helper:<24} {scale:>4}x {rows:>9,} {wall_time * 1000:>10.2f} {result['rows_per_s']:>12,.0f} {peak / 2**20:>9.1f}")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench_transforms_{commit or 'unknown'}.json")
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'source': source,
+            'repeat': args.repeat,
+            'results': results,
+        }, f, indent=2)
+    print(f"results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        before = {(result['helper'], result['scale']): result for result in previous['results']}
+        print(f"\nchange against {previous.get('commit')} (negative is faster or smaller)")
+        print(f"{'helper':<24} {'scale':>5} {'wall time':>10} {'peak memory':>12}")
+        for result in results:
+            old = before.get((result['helper'], result['scale']))
+            if old is None:
+                continue
+            print(f"{result['helper']:<24} {result['scale']:>4}x "
+                  f"{result['wall_time_s'] / old['wall_time_s'] - 1:>+10.1%} "
+                  f"{result['peak_memory_bytes'] / max(old['peak_memory_bytes'], 1) - 1:>+12.1%}")
+
+
+if __name__ == "__main__":
+    main()
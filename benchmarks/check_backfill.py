@@ -0,0 +1,121 @@
+"""
+Check that the backfill records the snapshots it could not fetch, and that a rerun resumes it.
+
+It starts a local moto S3 server and a stub of the carpark availability API, where a few execution times
+keep failing with a 500 after the retries of the HTTP client. The first backfill must save every batch,
+without the failed snapshots, and record the failed times of their batches in the _backfill_failed folder.
+Once the API recovers, the rerun must only fetch the batches with failed times again, skip the others,
+and remove the records, leaving every snapshot saved once.
+
+Requires moto[server].
+
+Usage:
+    python benchmarks/check_backfill.py [--snapshots 48] [--batch-size 12] [--carparks 50]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_carpark_flatten import make_carpark_payload
+from stub_server import StubServer
+
+BUCKET = 'check-backfill'
+S3_KEY = 'carpark_sg'
+
+
+def start_s3():
+    """ Start a local moto S3 server, and point s3fs and boto3 at it """
+    from moto.server import ThreadedMotoServer
+
+    # Hide the request log of the server.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    os.environ['AWS_ENDPOINT_URL_S3'] = f"http://{host}:{port}"
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshots', type=int, default=48)
+    parser.add_argument('--batch-size', type=int, default=12)
+    parser.add_argument('--carparks', type=int, default=50)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server = start_s3()
+    # Imported after the endpoint is set, so s3fs uses the local server.
+    import s3fs
+    from helpers import backfill as backfill_module, getCarpark, http_client
+
+    fs = s3fs.S3FileSystem()
+    fs.mkdir(BUCKET)
+
+    start = datetime(2019, 8, 1)
+    end = start + timedelta(minutes=10 * args.snapshots)
+    times = backfill_module.execution_times(start, end)
+    # Two failed times in the first batch and one in the third, the other batches are complete.
+    failing = {times[1], times[5], times[2 * args.batch_size + 3]}
+    fetched = []
+    payload = json.dumps(make_carpark_payload(args.carparks)).encode('utf-8')
+    rows_per_snapshot = len(backfill_module._transform('carpark', times[0], payload))
+
+    def handle(path, query):
+        execution_time = query['date_time'][0]
+        fetched.append(execution_time)
+        if execution_time in failing:
+            return 500, b'{"message": "internal error"}'
+        return 200, payload
+
+    with StubServer(handle) as api:
+        getCarpark.CARPARK_AVAILABILITY_URL = api.url + '/v1/transport/carpark-availability'
+        # Fewer and shorter retries than the default, so the failing times give up quickly.
+        http_client._client = http_client.HttpClient(max_retries=1, backoff_factor=0.01)
+
+        saved, failed = backfill_module.backfill('carpark', start, end, BUCKET, S3_KEY,
+                                                 batch_size=args.batch_size, transform_workers=2)
+        batches = (args.snapshots + args.batch_size - 1) // args.batch_size
+        if len(saved) != batches:
+            raise ValueError(f"The first backfill saved {len(saved)} of {batches} batches")
+        if sorted(failed) != sorted(failing):
+            raise ValueError(f"The first backfill reported {failed} as failed, instead of {sorted(failing)}")
+        recorded = sorted(fs.ls(f"{BUCKET}/{S3_KEY}/{backfill_module.FAILED_FOLDER}"))
+        recorded_times = sorted(time for path in recorded for time in json.loads(fs.cat(path)))
+        if len(recorded) != 2 or recorded_times != sorted(failing):
+            raise ValueError(f"The failed times are not recorded per batch: {recorded}")
+        print(f"first run: {len(saved)} files saved, {len(failed)} failed snapshots recorded in {len(recorded)} files")
+
+        failing.clear()
+        fetched.clear()
+        saved, failed = backfill_module.backfill('carpark', start, end, BUCKET, S3_KEY,
+                                                 batch_size=args.batch_size, transform_workers=2)
+        if failed or len(saved) != 2 or len(fetched) != 2 * args.batch_size:
+            raise ValueError(f"The rerun saved {saved} with {len(fetched)} calls, instead of the 2 batches with failed times")
+        if fs.exists(f"{BUCKET}/{S3_KEY}/{backfill_module.FAILED_FOLDER}") and \
+                fs.ls(f"{BUCKET}/{S3_KEY}/{backfill_module.FAILED_FOLDER}"):
+            raise ValueError("The records of the failed times are not removed by the rerun")
+        print(f"rerun: {len(saved)} files saved again with {len(fetched)} calls, the other batches skipped")
+
+    files = sorted(path for path in fs.ls(f"{BUCKET}/{S3_KEY}") if path.endswith('.csv'))
+    data = pd.concat([pd.read_csv(fs.open(path)) for path in files], ignore_index=True)
+    if len(files) != batches or len(data) != rows_per_snapshot * args.snapshots:
+        raise ValueError(f"{len(data)} rows in {len(files)} files, instead of "
+                         f"{rows_per_snapshot * args.snapshots} rows in {batches} files")
+    print(f"all {args.snapshots} snapshots saved once, {len(data)} rows in {len(files)} files")
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Check and time the paginated fetch of the carpark information dataset against a local CKAN stub.
+
+It starts a local stub of the CKAN datastore_search API serving a large number of synthetic carpark
+records, with latency on every call. Then it retrieves the whole dataset one page at a time and with
+concurrent pages, checks that both return every record once and in order, and reports the wall time.
+A single call without pagination, as the helper did before, only returns the first default page.
+
+Usage:
+    python benchmarks/check_carpark_info_pagination.py [--records 12000] [--page-size 1000] [--latency 0.1]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers.ckan import fetch_datastore
+from stub_server import StubServer
+
+RESOURCE_ID = '139a3035-e624-4f56-b63f-89ae28d4ae4c'
+# The default limit of the CKAN datastore_search API.
+CKAN_DEFAULT_LIMIT = 100
+
+
+def make_records(count):
+    """ Synthetic records with the fields of the carpark information dataset """
+    return [{
+        '_id': i + 1,
+        'car_park_no': f"CP{i:05d}",
+        'address': f"BLK {i} SYNTHETIC STREET",
+        'x_coord': str(30000 + i % 1000),
+        'y_coord': str(40000 + i // 1000),
+        'car_park_type': 'SURFACE CAR PARK',
+    } for i in range(count)]
+
+
+def make_handler(records):
+    def handle(path, query):
+        limit = int(query.get('limit', [CKAN_DEFAULT_LIMIT])[0])
+        offset = int(query.get('offset', [0])[0])
+        body = {'success': True, 'result': {
+            'resource_id': query['resource_id'][0],
+            'records': records[offset:offset + limit],
+            'total': len(records),
+            'limit': limit,
+            'offset': offset,
+        }}
+        return 200, json.dumps(body).encode('utf-8')
+    return handle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=12000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--workers', type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    expected = [record['car_park_no'] for record in records]
+    with StubServer(make_handler(records), latency=args.latency) as server:
+        url = server.url + '/api/action/datastore_search'
+
+        single = requests.get(url, {'resource_id': RESOURCE_ID}).json()['result']['records']
+        print(f"{'single call':>12}: {len(single):>6} of {args.records} records")
+
+        for name, workers, streaming in (('sequential', 1, False), ('concurrent', args.workers, False),
+                                         ('streaming', args.workers, True)):
+            start = time.perf_counter()
+            data = fetch_datastore(url, RESOURCE_ID, args.page_size, workers, streaming)
+            elapsed = time.perf_counter() - start
+            if list(data['car_park_no']) != expected:
+                raise ValueError(f"The {name} fetch did not return every record in order")
+            print(f"{name:>12}: {len(data):>6} of {args.records} records in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Check that the incremental mode of DailyFactsCalculatorOperator matches a full recompute.
+
+It loads random carpark availability snapshots into a scratch schema of a local Postgres (the pg-data
+container by default), through a staging table like the DAG, and runs the incremental merge after every batch.
+Some batches are new snapshots, some backfill older date_times, and some replace a date_time already loaded.
+Then it rebuilds the same table from scratch and compares both. It also reports the time of the last merge
+against the full rebuild.
+
+Usage:
+    python benchmarks/check_daily_facts_incremental.py [--dsn "host=localhost port=5439 user=postgres password=docker"]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.sql_queries import SqlQueries
+
+SCHEMA = 'check_daily_facts'
+ORIGIN = 'carpark_availability'
+STAGING = 'staging_carpark_availability'
+FACT_COLUMN = 'lots_available'
+GROUPBY_COLUMN = 'carpark_id'
+
+
+def rebuild_sql(destination_table):
+    """ Same statements as DailyFactsCalculatorOperator with incremental False """
+    return SqlQueries.daily_facts_rebuild.format(
+        destination_table=destination_table,
+        select=SqlQueries.daily_facts_select.format(
+            groupby_column=GROUPBY_COLUMN, fact_column=FACT_COLUMN, origin_table=ORIGIN, where=""))
+
+
+def merge_sql(destination_table):
+    """ Same statements as DailyFactsCalculatorOperator with incremental True """
+    return SqlQueries.daily_facts_merge.format(
+        destination_table=destination_table,
+        groupby_column=GROUPBY_COLUMN,
+        origin_table=ORIGIN,
+        staging_table=STAGING,
+        select=SqlQueries.daily_facts_select.format(
+            groupby_column=GROUPBY_COLUMN, fact_column=FACT_COLUMN, origin_table=ORIGIN,
+            where=SqlQueries.daily_facts_touched_filter.format(
+                destination_table=destination_table, groupby_column=GROUPBY_COLUMN, origin_table=ORIGIN)))
+
+
+def load_snapshots(cur, rng, start, count, carparks):
+    """
+    Stage `count` snapshots every 10 minutes from start, with some missing readings, and replace
+    their date_times in the origin table, the same as the replace_partition load of the fact table.
+    """
+    rows = []
+    for i in range(count):
+        date_time = start + timedelta(minutes=10 * i)
+        for carpark in range(carparks):
+            # CP0000 never reports, so its groups only have nulls.
+            lots = None if carpark == 0 or rng.random() < 0.01 else rng.randint(0, 500)
+            rows.append((date_time, f"CP{carpark:04d}", lots))
+    cur.execute(f"DELETE FROM {STAGING}")
+    cur.executemany(f"INSERT INTO {STAGING} VALUES (%s, %s, %s)", rows)
+    cur.execute(f"DELETE FROM {ORIGIN} USING (SELECT DISTINCT date_time FROM {STAGING}) AS s "
+                f"WHERE {ORIGIN}.date_time = s.date_time")
+    cur.execute(f"INSERT INTO {ORIGIN} SELECT * FROM {STAGING}")
+
+
+def fetch_sorted(cur, table):
+    cur.execute(f"SELECT * FROM {table} ORDER BY month, day, {GROUPBY_COLUMN}")
+    return [tuple(round(v, 9) if isinstance(v, float) else v for v in row) for row in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default="host=localhost port=5439 user=postgres password=docker")
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--carparks', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA};")
+    for table in (ORIGIN, STAGING):
+        cur.execute(f"CREATE TABLE {table} (date_time timestamptz NOT NULL, {GROUPBY_COLUMN} varchar, {FACT_COLUMN} integer)")
+    conn.commit()
+
+    # Initial history, then the first run builds the table.
+    start = datetime(2019, 1, 1)
+    load_snapshots(cur, rng, start, 144 * 3, args.carparks)
+    cur.execute(rebuild_sql('daily_stats_incremental'))
+    conn.commit()
+
+    # Batches of one snapshot (like every 10 minutes) or several (like a catch-up), crossing midnight,
+    # and now and then a backfill of older date_times or a replaced date_time.
+    next_time = start + timedelta(days=3)
+    merge_time = 0
+    for _ in range(args.batches):
+        kind = rng.choice(['new', 'new', 'new', 'backfill', 'replace'])
+        count = rng.choice([1, 1, 1, 6, 30])
+        if kind == 'new':
+            load_snapshots(cur, rng, next_time, count, args.carparks)
+            next_time += timedelta(minutes=10 * count)
+        elif kind == 'backfill':
+            # Before the history, or the same days of a previous year.
+            load_snapshots(cur, rng, start - timedelta(days=rng.choice([1, 365])), count, args.carparks)
+        else:
+            load_snapshots(cur, rng, start + timedelta(minutes=10 * rng.randrange(144 * 3)), 1, args.carparks)
+        started = time.perf_counter()
+        cur.execute(merge_sql('daily_stats_incremental'))
+        conn.commit()
+        merge_time = time.perf_counter() - started
+        # A second run of the same staged rows must not change anything.
+        cur.execute(merge_sql('daily_stats_incremental'))
+        conn.commit()
+
+    started = time.perf_counter()
+    cur.execute(rebuild_sql('daily_stats_full'))
+    conn.commit()
+    rebuild_time = time.perf_counter() - started
+
+    incremental = fetch_sorted(cur, 'daily_stats_incremental')
+    full = fetch_sorted(cur, 'daily_stats_full')
+    cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+    if incremental != full:
+        raise ValueError("The incremental daily facts do not match the full recompute")
+    print(f"{len(full)} daily groups match after {args.batches} incremental batches")
+    print(f"last merge: {merge_time * 1000:.1f} ms, full rebuild: {rebuild_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Check that the delta encoded carpark availability rebuilds the full snapshots, and compare its rows and COPY time.
+
+It simulates a day of snapshots every 10 minutes, where each reading changes with a small probability and
+a few carparks drop out of the API and come back, with an empty response and a missed run in between.
+Each snapshot is delta encoded with helpers.delta, against a state file in a temporary folder, the same as
+get_carpark with delta_state, and both the full snapshots and the deltas are copied into a scratch schema
+of a local Postgres (the pg-data container by default). The carpark_availability_rebuilt view and the
+carpark_availability_as_of query must return the full snapshot at every run, and at random times in between.
+
+Usage:
+    python benchmarks/check_delta_encoding.py [--dsn "host=localhost port=5439 user=postgres password=docker"]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pandas as pd
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.delta import DeltaState, encode_snapshot
+from helpers.postgres_loader import copy_dataframe
+from helpers.sql_queries import SqlQueries
+
+SCHEMA = 'check_delta_encoding'
+CREATE_TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'create_tables.sql')
+LOT_TYPES = {'C': 300, 'Y': 40, 'H': 10}
+
+
+def create_tables(cur):
+    cur.execute("""CREATE TABLE staging_carpark_availability (date_time timestamptz NOT NULL, carpark_id varchar,
+        lot_type varchar, lots_available integer, total_lots integer)""")
+    cur.execute("CREATE TABLE carpark_availability (LIKE staging_carpark_availability)")
+    cur.execute("CREATE TABLE staging_carpark_availability_delta (LIKE staging_carpark_availability)")
+    cur.execute("ALTER TABLE staging_carpark_availability_delta ADD COLUMN change_type varchar(1)")
+    cur.execute("""CREATE TABLE carpark_availability_delta (date_time timestamptz NOT NULL, carpark_id varchar,
+        lot_type varchar, lots_available integer, total_lots integer, change_type varchar(1) NOT NULL)""")
+    # The view of create_tables.sql, without its schema so it is created in the scratch schema.
+    with open(CREATE_TABLES) as f:
+        view = re.search(r"CREATE VIEW public\.carpark_availability_rebuilt AS.*?;", f.read(), re.S).group(0)
+    cur.execute(view.replace("public.", ""))
+
+
+def make_snapshots(rng, start, count, carparks, change_rate):
+    """ Return the flattened snapshots of every run, with the readings that change with the change rate """
+    keys = [(f"CP{carpark:04d}", lot_type) for carpark in range(carparks)
+            for lot_type in list(LOT_TYPES)[:1 + carpark % len(LOT_TYPES)]]
+    lots = {key: rng.randint(0, LOT_TYPES[key[1]]) for key in keys}
+    snapshots = []
+    for i in range(count):
+        date_time = start + timedelta(minutes=10 * i)
+        for key in keys:
+            if rng.random() < change_rate:
+                lots[key] = rng.randint(0, LOT_TYPES[key[1]])
+        # A few carparks are missing from some snapshots, and come back later.
+        missing = {f"CP{carpark:04d}" for carpark in rng.sample(range(carparks), 3)} if i % 12 == 5 else set()
+        # The API returned an empty list once.
+        listed = [] if i == 40 else [key for key in keys if key[0] not in missing]
+        snapshots.append((date_time, pd.DataFrame(OrderedDict([
+            ('timestamp', [date_time.strftime('%Y-%m-%dT%H:%M:%S')] * len(listed)),
+            ('carpark_number', [carpark for carpark, _ in listed]),
+            ('lot_type', [lot_type for _, lot_type in listed]),
+            ('lots_available', [lots[key] for key in listed]),
+            ('total_lots', [LOT_TYPES[key[1]] for key in listed]),
+        ]))))
+    return snapshots
+
+
+def state_at(snapshots, date_time):
+    """ The expected full snapshot at the time: the latest non-empty snapshot at or before it """
+    for snapshot_time, data in reversed(snapshots):
+        if snapshot_time <= date_time and not data.empty:
+            return sorted((row.carpark_number, row.lot_type, row.lots_available, row.total_lots)
+                          for row in data.itertuples())
+    return []
+
+
+def fetch_rebuilt(cur, date_time):
+    cur.execute(SqlQueries.carpark_availability_as_of.format(table='carpark_availability_delta'), {'as_of': date_time})
+    return sorted(row[1:] for row in cur.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default="host=localhost port=5439 user=postgres password=docker")
+    parser.add_argument('--carparks', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=144)
+    parser.add_argument('--change-rate', type=float, default=0.05,
+                        help="Probability that a reading changed since the previous run")
+    parser.add_argument('--checkpoint-minutes', type=int, default=360)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    start = datetime(2019, 8, 9)
+    snapshots = make_snapshots(rng, start, args.runs, args.carparks, args.change_rate)
+    # One run is missed, so the next one cannot be a delta of the state and is a checkpoint.
+    missed = snapshots[args.runs // 2][0]
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}; SET TIME ZONE 'UTC';")
+    create_tables(cur)
+    conn.commit()
+
+    full_rows = delta_rows = checkpoints = 0
+    full_copy = delta_copy = encode_time = 0
+    with tempfile.TemporaryDirectory() as directory:
+        state = DeltaState(os.path.join(directory, 'carpark_delta_state.json.gz')).load()
+        previous = None
+        for date_time, data in snapshots:
+            ts_nodash = date_time.strftime('%Y%m%dT%H%M%S')
+            if date_time == missed:
+                previous = ts_nodash
+                continue
+
+            started = time.perf_counter()
+            copy_dataframe(conn, data, 'staging_carpark_availability')
+            cur.execute(SqlQueries.carpark_availability_insert)
+            conn.commit()
+            full_copy += time.perf_counter() - started
+            full_rows += len(data)
+
+            started = time.perf_counter()
+            delta, values = encode_snapshot(data, state, previous, date_time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                            args.checkpoint_minutes)
+            encode_time += time.perf_counter() - started
+            started = time.perf_counter()
+            copy_dataframe(conn, delta, 'staging_carpark_availability_delta')
+            cur.execute(SqlQueries.carpark_availability_delta_insert)
+            conn.commit()
+            delta_copy += time.perf_counter() - started
+            state.save(ts_nodash, values)
+            delta_rows += len(delta)
+            checkpoints += int((delta['change_type'] == 'C').any())
+            previous = ts_nodash
+
+    # The state at every run, except the missed one, and at random times in between.
+    loaded = [snapshot for snapshot in snapshots if snapshot[0] != missed]
+    times = [date_time for date_time, _ in loaded]
+    times += [start + timedelta(seconds=rng.randint(0, 600 * (args.runs - 1))) for _ in range(20)]
+    for date_time in times:
+        if fetch_rebuilt(cur, date_time) != state_at(loaded, date_time):
+            raise ValueError(f"The delta encoded availability does not rebuild the snapshot at {date_time}")
+
+    cur.execute("SELECT date_time, carpark_id, lot_type, lots_available, total_lots FROM carpark_availability_rebuilt")
+    rebuilt = {}
+    for date_time, carpark_id, lot_type, lots_available, total_lots in cur.fetchall():
+        rebuilt.setdefault(date_time.replace(tzinfo=None), []).append((carpark_id, lot_type, lots_available, total_lots))
+    for date_time, rows in rebuilt.items():
+        if sorted(rows) != state_at(loaded, date_time):
+            raise ValueError(f"The carpark_availability_rebuilt view does not match the snapshot at {date_time}")
+
+    cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+    print(f"the delta encoded availability rebuilds all {len(times)} snapshots, "
+          f"the view matches at its {len(rebuilt)} date_time values")
+    print(f"rows: full {full_rows:,}, delta {delta_rows:,} ({full_rows / max(delta_rows, 1):.1f}x fewer), "
+          f"{checkpoints} checkpoints")
+    print(f"copy and insert: full {full_copy:.2f} s, delta {delta_copy:.2f} s, delta encoding {encode_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
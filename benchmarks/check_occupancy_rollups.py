@@ -0,0 +1,174 @@
+"""
+Check that the incremental occupancy rollups of OccupancyRollupOperator match a full recompute.
+
+It loads random carpark availability snapshots, with several lot types per carpark, into a scratch schema
+of a local Postgres (the pg-data container by default), through a staging table like the DAG, and runs the
+incremental rollups after every batch. Some batches are new snapshots, some backfill older date_times, and
+some replace a date_time already loaded. Then it recomputes the same rollups from scratch and compares both. It also reports the rows of each
+rollup against the fact table, and the time of a dashboard query on the fact table and on the daily rollup.
+
+Usage:
+    python benchmarks/check_occupancy_rollups.py [--dsn "host=localhost port=5439 user=postgres password=docker"]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+
+from helpers.sql_queries import SqlQueries
+
+SCHEMA = 'check_occupancy_rollups'
+ORIGIN = 'carpark_availability'
+STAGING = 'staging_carpark_availability'
+# Same grains as OccupancyRollupOperator, which cannot be imported without airflow.
+GRAINS = [("hourly", "hour"), ("daily", "day"), ("weekly", "week")]
+LOT_TYPES = {'C': 300, 'Y': 40, 'H': 10}
+
+
+def rollup_sql(table_prefix, incremental):
+    """ Same statements as OccupancyRollupOperator """
+    tables = [f"{table_prefix}_{name}" for name, _ in GRAINS]
+    if incremental:
+        statements = [SqlQueries.rollup_touched_from_staging.format(
+            table=tables[0], grain=GRAINS[0][1], staging_table=STAGING)]
+    else:
+        statements = [f"DELETE FROM {table};" for table in tables]
+        statements.append(SqlQueries.rollup_touched_from_origin.format(
+            table=tables[0], grain=GRAINS[0][1], origin_table=ORIGIN))
+    statements.append(SqlQueries.rollup_from_origin.format(
+        table=tables[0], grain=GRAINS[0][1], origin_table=ORIGIN, columns=SqlQueries.rollup_columns))
+    for source_table, table, (_, grain) in zip(tables, tables[1:], GRAINS[1:]):
+        statements.append(SqlQueries.rollup_from_finer.format(
+            table=table, grain=grain, source_table=source_table, columns=SqlQueries.rollup_columns))
+    statements.extend(f"DROP TABLE {table}_touched;" for table in tables)
+    return "\n".join(statements)
+
+
+def create_tables(cur, carparks):
+    for table in (ORIGIN, STAGING):
+        cur.execute(f"""CREATE TABLE {table} (date_time timestamptz NOT NULL, carpark_id varchar, lot_type varchar,
+                        lots_available integer, total_lots integer)""")
+    cur.execute("CREATE TABLE carpark (carpark_id varchar PRIMARY KEY, total_lots integer)")
+    # CP0001 has no total_lots, so it has no occupancy ratio.
+    cur.executemany("INSERT INTO carpark VALUES (%s, %s)",
+                    [(f"CP{carpark:04d}", None if carpark == 1 else LOT_TYPES['C']) for carpark in range(carparks)])
+    for table_prefix in ('incremental', 'full'):
+        for name, _ in GRAINS:
+            cur.execute(f"""CREATE TABLE {table_prefix}_{name} (
+                bucket timestamptz NOT NULL, carpark_id varchar NOT NULL,
+                min_lots_available integer, max_lots_available integer,
+                sum_lots_available bigint, count_lots_available bigint,
+                sum_occupied_lots bigint, sum_capacity_lots bigint, occupancy_ratio double precision)""")
+
+
+def load_snapshots(cur, rng, start, count, carparks):
+    """
+    Stage `count` snapshots every 10 minutes from start, one row per lot type, with some missing readings,
+    and replace their date_times in the origin table, the same as the replace_partition load of the fact table.
+    """
+    rows = []
+    for i in range(count):
+        date_time = start + timedelta(minutes=10 * i)
+        for carpark in range(carparks):
+            for lot_type, total in LOT_TYPES.items():
+                # CP0000 never reports, so its buckets only have nulls.
+                lots = None if carpark == 0 or rng.random() < 0.01 else rng.randint(0, total)
+                rows.append((date_time, f"CP{carpark:04d}", lot_type, lots, total))
+    cur.execute(f"DELETE FROM {STAGING}")
+    cur.executemany(f"INSERT INTO {STAGING} VALUES (%s, %s, %s, %s, %s)", rows)
+    cur.execute(f"DELETE FROM {ORIGIN} USING (SELECT DISTINCT date_time FROM {STAGING}) AS s "
+                f"WHERE {ORIGIN}.date_time = s.date_time")
+    cur.execute(f"INSERT INTO {ORIGIN} SELECT * FROM {STAGING}")
+
+
+def fetch_sorted(cur, table):
+    cur.execute(f"SELECT * FROM {table} ORDER BY bucket, carpark_id")
+    return [tuple(round(v, 9) if isinstance(v, float) else v for v in row) for row in cur.fetchall()]
+
+
+def timed(cur, sql):
+    started = time.perf_counter()
+    cur.execute(sql)
+    cur.fetchall()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default="host=localhost port=5439 user=postgres password=docker")
+    parser.add_argument('--batches', type=int, default=30)
+    parser.add_argument('--carparks', type=int, default=100)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA}; SET search_path TO {SCHEMA}; SET TIME ZONE 'UTC';")
+    create_tables(cur, args.carparks)
+    conn.commit()
+
+    # A week of history, then the first run builds the rollups.
+    start = datetime(2019, 1, 1)
+    load_snapshots(cur, rng, start, 144 * 7, args.carparks)
+    cur.execute(rollup_sql('incremental', False))
+    conn.commit()
+
+    # Batches of one snapshot (like every 10 minutes) or several (like a catch-up), crossing hours, days and weeks,
+    # and now and then a backfill of older date_times or a replaced date_time.
+    next_time = start + timedelta(days=7)
+    merge_time = 0
+    for _ in range(args.batches):
+        kind = rng.choice(['new', 'new', 'new', 'backfill', 'replace'])
+        count = rng.choice([1, 1, 1, 6, 30, 144])
+        if kind == 'new':
+            load_snapshots(cur, rng, next_time, count, args.carparks)
+            next_time += timedelta(minutes=10 * count)
+        elif kind == 'backfill':
+            load_snapshots(cur, rng, start - timedelta(days=rng.choice([1, 14])), count, args.carparks)
+        else:
+            load_snapshots(cur, rng, start + timedelta(minutes=10 * rng.randrange(144 * 7)), 1, args.carparks)
+        started = time.perf_counter()
+        cur.execute(rollup_sql('incremental', True))
+        conn.commit()
+        merge_time = time.perf_counter() - started
+        # A second run of the same staged rows must not change anything.
+        cur.execute(rollup_sql('incremental', True))
+        conn.commit()
+
+    started = time.perf_counter()
+    cur.execute(rollup_sql('full', False))
+    conn.commit()
+    rebuild_time = time.perf_counter() - started
+
+    for name, _ in GRAINS:
+        if fetch_sorted(cur, f"incremental_{name}") != fetch_sorted(cur, f"full_{name}"):
+            raise ValueError(f"The incremental {name} rollup does not match the full recompute")
+
+    cur.execute(f"SELECT COUNT(*) FROM {ORIGIN}")
+    counts = [f"facts {cur.fetchone()[0]:,}"]
+    for name, _ in GRAINS:
+        cur.execute(f"SELECT COUNT(*) FROM incremental_{name}")
+        counts.append(f"{name} {cur.fetchone()[0]:,}")
+    fact_query = timed(cur, f"""
+        SELECT DATE_TRUNC('day', a.date_time), a.carpark_id, MIN(a.lots_available), MAX(a.lots_available)
+        FROM {ORIGIN} a JOIN carpark c ON a.carpark_id = c.carpark_id WHERE a.lot_type = 'C' GROUP BY 1, 2""")
+    rollup_query = timed(cur, "SELECT bucket, carpark_id, min_lots_available, max_lots_available FROM incremental_daily")
+
+    cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    conn.commit()
+    conn.close()
+
+    print(f"hourly, daily and weekly rollups match after {args.batches} incremental batches")
+    print("rows: " + ", ".join(counts))
+    print(f"last merge: {merge_time * 1000:.1f} ms, full recompute: {rebuild_time * 1000:.1f} ms")
+    print(f"daily dashboard query: {fact_query * 1000:.1f} ms on the facts, {rollup_query * 1000:.1f} ms on the rollup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Local stub HTTP server for the benchmarks, standing in for the data.gov.sg APIs.
+
+Usage:
+    with StubServer(handle) as server:
+        requests.get(server.url + '/path')
+
+`handle(path, query)` returns (status, body bytes). The server can inject latency and failures,
+and counts the requests and the TCP connections it accepted, so connection reuse can be checked.
+"""
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer:
+    """
+    Args:
+        handle: Function of (path, query dict) returning (status, body bytes).
+        latency: Seconds to wait before every response.
+        fail_rate: Share of the requests answered with `fail_status` instead of calling `handle`.
+        fail_status: The status of the injected failures. Default is 503.
+        seed: Seed of the injected failures.
+    """
+    def __init__(self, handle, latency=0, fail_rate=0, fail_status=503, seed=0):
+        self.handle = handle
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.requests = 0
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1, so clients can keep the connection alive.
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body straight away on kept-alive connections.
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    failed = stub._random.random() < stub.fail_rate
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if failed:
+                    status, body = stub.fail_status, b'{"message": "injected failure"}'
+                else:
+                    url = urlparse(self.path)
+                    status, body = stub.handle(url.path, parse_qs(url.query))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -18,6 +18,15 @@ CREATE TABLE public.staging_carpark_availability (
         total_lots integer        
 );
 
+CREATE TABLE public.staging_carpark_availability_delta (
+        date_time timestamptz NOT NULL,
+        carpark_id varchar,
+        lot_type varchar,
+        lots_available integer,
+        total_lots integer,
+        change_type varchar(1)
+);
+
 CREATE TABLE public.staging_weather_station_info (
         station_id varchar,
         station_location varchar,
@@ -49,10 +58,80 @@ CREATE TABLE public.rainfall_events (
 CREATE TABLE public.carpark_availability (
         date_time timestamptz NOT NULL,
         carpark_id varchar,
+        lot_type varchar,
         lots_available integer,
+        total_lots integer,
         FOREIGN KEY (carpark_id) references carpark (carpark_id)
 ) diststyle KEY distkey (date_time) compound sortkey (date_time, carpark_id);
 
+-- Delta encoded carpark availability: the full snapshot at each checkpoint (change_type C), then only
+-- the readings that changed (U) and the carparks and lot types that are no longer listed (R).
+CREATE TABLE public.carpark_availability_delta (
+        date_time timestamptz NOT NULL,
+        carpark_id varchar,
+        lot_type varchar,
+        lots_available integer,
+        total_lots integer,
+        change_type varchar(1) NOT NULL
+) diststyle KEY distkey (date_time) compound sortkey (date_time, carpark_id);
+
+-- The full snapshot rebuilt at each date_time of the delta table: the latest reading of every carpark and
+-- lot type since the latest checkpoint. A run without any change has no row in the delta table, its snapshot
+-- is the one of the previous date_time. See SqlQueries.carpark_availability_as_of for any other time.
+CREATE VIEW public.carpark_availability_rebuilt AS
+SELECT date_time, carpark_id, lot_type, lots_available, total_lots
+FROM (
+        SELECT snapshots.date_time, d.carpark_id, d.lot_type, d.lots_available, d.total_lots, d.change_type,
+                ROW_NUMBER() OVER (PARTITION BY snapshots.date_time, d.carpark_id, d.lot_type
+                        ORDER BY d.date_time DESC) AS row_number
+        FROM (
+                SELECT s.date_time, MAX(c.date_time) AS checkpoint_time
+                FROM (SELECT DISTINCT date_time FROM public.carpark_availability_delta) AS s
+                JOIN (SELECT DISTINCT date_time FROM public.carpark_availability_delta WHERE change_type = 'C') AS c
+                ON c.date_time <= s.date_time
+                GROUP BY s.date_time
+        ) AS snapshots
+        JOIN public.carpark_availability_delta AS d
+        ON d.date_time >= snapshots.checkpoint_time AND d.date_time <= snapshots.date_time
+) AS readings
+WHERE row_number = 1 AND change_type <> 'R';
+
+CREATE TABLE public.carpark_occupancy_hourly (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);
+
+CREATE TABLE public.carpark_occupancy_daily (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);
+
+CREATE TABLE public.carpark_occupancy_weekly (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);
+
 CREATE TABLE public.weather_stations (
         station_id varchar NOT NULL,
         station_location varchar,
@@ -70,6 +149,24 @@ CREATE TABLE public.carpark (
         CONSTRAINT carpark_pkey PRIMARY KEY (carpark_id)
 );
 
+CREATE TABLE public.carpark_history (
+        carpark_id varchar NOT NULL,
+        carpark_location varchar,
+        carpark_latitude double precision,
+        carpark_longitude double precision,
+        total_lots integer,
+        row_hash varchar(32),
+        valid_from timestamptz NOT NULL,
+        valid_to timestamptz
+) compound sortkey (carpark_id, valid_from);
+
+CREATE TABLE public.carpark_station (
+        carpark_id varchar NOT NULL,
+        station_id varchar NOT NULL,
+        station_rank integer NOT NULL,
+        distance_km double precision
+) diststyle ALL compound sortkey (carpark_id, station_rank);
+
 CREATE TABLE public.time(
         date_time timestamptz PRIMARY KEY,
         hour integer,
@@ -78,4 +175,32 @@ CREATE TABLE public.time(
         month integer,
         year integer,
         weekday integer
-);
\ No newline at end of file
+) diststyle ALL sortkey (date_time);
+
+CREATE TABLE public.data_quality_history (
+        run_id varchar NOT NULL,
+        run_time timestamp NOT NULL,
+        execution_time timestamptz,
+        check_name varchar,
+        table_name varchar,
+        table_role varchar,
+        row_count bigint,
+        null_count bigint,
+        duplicate_count bigint,
+        min_value double precision,
+        max_value double precision
+) compound sortkey (run_time, check_name);
+
+CREATE TABLE public.load_fingerprints (
+        table_name varchar NOT NULL,
+        fingerprint varchar NOT NULL,
+        source varchar,
+        loaded_at timestamp
+);
+
+CREATE TABLE public.load_ledger (
+        table_name varchar NOT NULL,
+        s3_key varchar NOT NULL,
+        manifest_key varchar,
+        loaded_at timestamp
+) compound sortkey (table_name, s3_key);
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators.python_operator import PythonOperator
+
+from helpers.backfill import get_backfill
+
+# Manually triggered backfill of the datasets staged in Redshift, into the same S3 keys as the 10 minutes pipeline.
+# The time range is set in the conf of the run, e.g.
+#   airflow trigger_dag carpark_sg_backfill_dag -c '{"start": "2019-01-01T00:00:00", "end": "2019-02-01T00:00:00"}'
+# The conf can also override the other params of the backfill, e.g. "batch_size" or "output_format".
+# A failed task is retried with the same conf, and resumes the backfill, see helpers/backfill.py.
+
+default_args = {
+        'owner': 'Alex Ho',
+        'start_date': datetime(2019, 1, 1, 0, 0, 0, 0),
+        'depends_on_past': False,
+        'retries': 3,
+        'retry_delay': timedelta(minutes=15),
+}
+
+dag = DAG(
+        dag_id = "carpark_sg_backfill_dag",
+        schedule_interval = None, # Only triggered manually
+        default_args = default_args
+)
+
+start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
+
+backfill_carpark_availability = PythonOperator(
+        task_id='backfill_carpark_availability_to_s3',
+        python_callable=get_backfill,
+        provide_context=True,
+        params={
+                'dataset': 'carpark',
+                's3_bucket': 'udacity-dend-alex-ho',
+                's3_key': 'carpark_sg'
+        },
+        dag=dag
+)
+
+backfill_temperature = PythonOperator(
+        task_id='backfill_temperature_to_s3',
+        python_callable=get_backfill,
+        provide_context=True,
+        params={
+                'dataset': 'temperature',
+                's3_bucket': 'udacity-dend-alex-ho',
+                's3_key': 'weather_sg'
+        },
+        dag=dag
+)
+
+backfill_rainfall = PythonOperator(
+        task_id='backfill_rainfall_to_s3',
+        python_callable=get_backfill,
+        provide_context=True,
+        params={
+                'dataset': 'rainfall',
+                's3_bucket': 'udacity-dend-alex-ho',
+                's3_key': 'weather_sg'
+        },
+        dag=dag
+)
+
+end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
+
+start_operator >> [backfill_carpark_availability, backfill_temperature, backfill_rainfall] >> end_operator
@@ -2,47 +2,43 @@ from datetime import datetime, timedelta
 
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
-from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
+from airflow.operators.python_operator import PythonOperator
 from airflow.operators.postgres_operator import PostgresOperator
 from airflow.hooks import PostgresHook
 from airflow.hooks.S3_hook import S3Hook
 from airflow.models import Variable
 
-from helpers.getWeather import get_weather
+from helpers.getWeather import get_weather_datasets
 from helpers.getCarpark import get_carpark
-from helpers.getCarparkInfo import get_carparkInfo
-from helpers.getWeatherStation import get_weatherStationInfo
 from helpers.sql_queries import SqlQueries
 
-from operators.load_to_redshift import LoadS3ToRedshiftOperator
-from operators.load_fact import LoadFactOperator
 from operators.load_dimension import LoadDimensionOperator
-from operators.data_quality import DataQualityOperator
 from operators.facts_calculator import DailyFactsCalculatorOperator
 from operators.has_rows import HasRowsOperator
-
-def is_twentyfifth(*args, **kwargs):
-        """ Helper function to determine whether it is 25th of each month
-
-        The goal was to identify the time to trigger the downstream process.
-
-        So, the function extracts the execution time from the macros reference 'ts_nodash',
-        and convert it into datetime format. Then, compare it against the condition: 
-        3 a.m. on the 25th of the month. 
-
-        If it is true, return True, else False.        
-        """
-        execution_time = datetime.strptime(kwargs['ts_nodash'], '%Y%m%dT%H%M%S')
-        if (execution_time.day == 25 and 
-                execution_time.hour == 3 and 
-                        execution_time.minute == 0):
-        # Test whether the time is 3am on 25th of each month.
-                return True
-        else:
-                return False
-
-# Set ui color for Short Circuit Operator
-ShortCircuitOperator.ui_color = "#99ccff"
+from operators.occupancy_rollups import OccupancyRollupOperator
+from operators.stage_load_check import StageLoadCheckOperator
+
+# Opt-in offline mode, e.g. 'postgres': the helpers copy the fact datasets straight into the staging tables of this
+# Postgres connection instead of S3, and the fact tasks of the DAG use it instead of Redshift. See helpers/postgres_loader.py.
+# The carpark_sg_dimension_dag still goes through S3 and Redshift.
+OFFLINE_CONN_ID = None
+REDSHIFT_CONN_ID = OFFLINE_CONN_ID or 'redshift'
+# Opt-in raw archive, e.g. 'raw': the carpark availability and weather helpers keep every response in this folder of
+# the bucket, and the runs whose payload did not change since the previous run skip their transform, upload and load.
+# See helpers/raw_archive.py. The archive is kept in S3, so it is left None in the offline mode.
+RAW_ARCHIVE = None
+# Opt-in delta encoding of the carpark availability, e.g. '/usr/local/airflow/data/carpark_delta_state.json.gz'.
+# The helper then only saves the readings that changed, loaded into carpark_availability_delta. See helpers/delta.py.
+CARPARK_DELTA_STATE = None
+# The carpark availability read by the time dimension, the daily stats and the occupancy rollups: the full
+# snapshots, or in the delta mode the staged deltas and the carpark_availability_rebuilt view of the full snapshots.
+# The carpark dimension of the carpark_sg_dimension_dag reads the AVAILABILITY_TABLE too, keep its availability_table in line.
+if CARPARK_DELTA_STATE is None:
+        AVAILABILITY_TABLE = 'carpark_availability'
+        AVAILABILITY_STAGING_TABLE = 'staging_carpark_availability'
+else:
+        AVAILABILITY_TABLE = 'carpark_availability_rebuilt'
+        AVAILABILITY_STAGING_TABLE = 'staging_carpark_availability_delta'
 
 default_args = {
         'owner': 'Alex Ho',
@@ -58,30 +54,26 @@ dag = DAG(
         schedule_interval = '*/10 * * * *', # 10 mins interval
         max_active_runs=1,
         default_args = default_args
+        # The tasks record no metrics by default. To record them, set 'metrics' in the params of the DAG,
+        # e.g. params = {'metrics': {'statsd': 'localhost:8125'}}. See helpers/metrics.py.
 )
 
 start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
 
-load_temperature_to_s3 = PythonOperator(
-        task_id='get_temperature_from_api_to_s3',
-        python_callable=get_weather,
+# Retrieve all the weather datasets concurrently in one task, one file per dataset.
+# Temperature and rainfall are staged in Redshift, humidity and wind are kept in the S3 data lake.
+load_weather_to_s3 = PythonOperator(
+        task_id='get_weather_from_api_to_s3',
+        python_callable=get_weather_datasets,
         provide_context=True,
         params = {
-                'table': 'temperature',
+                'tables': ['temperature', 'rainfall', 'humidity', 'wind_direction', 'wind_speed'],
+                # Only the datasets staged downstream fail the task, the others are only logged when they fail.
+                'required_tables': ['temperature', 'rainfall'],
                 's3_bucket': 'udacity-dend-alex-ho',
-                's3_key': 'weather_sg'
-        },
-        dag=dag
-)
-
-load_rainfall_to_s3 = PythonOperator(
-        task_id='get_rainfall_from_api_to_s3',
-        python_callable=get_weather,
-        provide_context=True,
-        params = {
-                'table': 'rainfall',
-                's3_bucket': 'udacity-dend-alex-ho',
-                's3_key': 'weather_sg'
+                's3_key': 'weather_sg',
+                'postgres_conn_id': OFFLINE_CONN_ID,
+                'raw_archive': RAW_ARCHIVE
         },
         dag=dag
 )
@@ -92,211 +84,142 @@ load_carpark_availability_to_s3 = PythonOperator(
         provide_context=True,
         params={
                 's3_bucket': 'udacity-dend-alex-ho',
-                's3_key': 'carpark_sg'
-        },
-        dag=dag
-)
-
-is_time_of_month = ShortCircuitOperator(
-        task_id="is_time_of_month",
-        python_callable=is_twentyfifth,
-        provide_context=True,
-        dag=dag
-)
-
-load_carpark_info_to_s3 = PythonOperator(
-        task_id='get_carpark_info_from_api_to_s3',
-        python_callable=get_carparkInfo,
-        provide_context=True,
-        params={
-                's3_bucket': 'udacity-dend-alex-ho',
-                's3_key': 'carpark_sg'
+                # 'compression': 'gzip' uploads carpark_<ts_nodash>.csv.gz instead, the s3_key of its staging must match.
+                's3_key': 'carpark_sg',
+                'postgres_conn_id': OFFLINE_CONN_ID,
+                'raw_archive': RAW_ARCHIVE,
+                'delta_state': CARPARK_DELTA_STATE
         },
         dag=dag
 )
 
-load_weather_stations_info_to_s3 = PythonOperator(
-        task_id='get_weather_stations_info_from_api_to_s3',
-        python_callable=get_weatherStationInfo,
-        provide_context=True,
-        params={
-                's3_bucket': 'udacity-dend-alex-ho',
-                's3_key': 'weather_sg'
-        },
-        dag=dag
-)
-
-stage_temperature_from_s3_to_redshift = LoadS3ToRedshiftOperator(
-        task_id='stage_temp_from_s3_to_redshift',
+# Each fact dataset is staged, loaded and checked by one task, on one connection and in one transaction,
+# which is rolled back if a check fails.
+stage_load_check_temperature = StageLoadCheckOperator(
+        task_id='stage_load_check_temperature_events',
         aws_credentials_id='aws_credentials_id',
-        redshift_conn_id='redshift',
-        table='staging_temperature',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='temperature_events',
         s3_bucket='udacity-dend-alex-ho',
         s3_key='weather_sg/temperature_{{ ts_nodash }}.csv',
+        execution_time='{{ts_nodash}}',
+        # Offline, the helper already staged the rows.
+        stage=OFFLINE_CONN_ID is None,
+        archive_key=RAW_ARCHIVE and RAW_ARCHIVE + '/temperature/runs/{{ ts_nodash }}.json',
         dag=dag
 )
 
-stage_rainfall_from_s3_to_redshift = LoadS3ToRedshiftOperator(
-        task_id='stage_rainfall_from_s3_to_redshift',
+stage_load_check_rainfall = StageLoadCheckOperator(
+        task_id='stage_load_check_rainfall_events',
         aws_credentials_id='aws_credentials_id',
-        redshift_conn_id='redshift',
-        table='staging_rainfall',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        table='rainfall_events',
         s3_bucket='udacity-dend-alex-ho',
         s3_key='weather_sg/rainfall_{{ ts_nodash }}.csv',
-        dag=dag
-)
-
-stage_carpark_availability_from_s3_to_redshift = LoadS3ToRedshiftOperator(
-        task_id='stage_carpark_availability_from_s3_to_redshift',
-        aws_credentials_id='aws_credentials_id',
-        redshift_conn_id='redshift',
-        table='staging_carpark_availability',
-        s3_bucket='udacity-dend-alex-ho',
-        s3_key='carpark_sg/carpark_{{ ts_nodash }}.csv',
-        dag=dag
-)
-
-stage_carpark_info_from_s3_to_redshift = LoadS3ToRedshiftOperator(
-        task_id='stage_carpark_info_from_s3_to_redshift',
-        aws_credentials_id='aws_credentials_id',
-        redshift_conn_id='redshift',
-        table='staging_carpark_info',
-        s3_bucket='udacity-dend-alex-ho',
-        s3_key='carpark_sg/carpark_info_{{ ts_nodash }}.csv',
-        dag=dag
-)
-
-stage_weather_stations_info_from_s3_to_redshift = LoadS3ToRedshiftOperator(
-        task_id='stage_weather_stations_info_from_s3_to_redshift',
-        aws_credentials_id='aws_credentials_id',
-        redshift_conn_id='redshift',
-        table='staging_weather_station_info',
-        s3_bucket='udacity-dend-alex-ho',
-        s3_key='weather_sg/weather_stations_info_{{ ts_nodash }}.csv',
-        dag=dag
-)
-
-load_temperature_table = LoadFactOperator(
-        task_id='load_temperature_events_fact_table',
-        redshift_conn_id="redshift",
-        table='temperature_events',
-        append=True,
-        dag=dag
-)
-
-load_rainfall_table = LoadFactOperator(
-        task_id='load_rainfall_events_fact_table',
-        redshift_conn_id="redshift",
-        table='rainfall_events',
-        append=True,
-        dag=dag
-)
-
-load_carpark_availability_table = LoadFactOperator(
-        task_id='load_carpark_availability_fact_table',
-        redshift_conn_id="redshift",
-        table='carpark_availability',
-        append=True,
-        dag=dag
-)
-
-load_carpark_table = LoadDimensionOperator(
-        task_id='load_carpark_info_dimension_table',
-        redshift_conn_id="redshift",
-        table='carpark',
-        append=False,
-        dag=dag        
-)
-
-load_weather_station_table = LoadDimensionOperator(
-        task_id='load_weather_stations_info_dimension_table',
-        redshift_conn_id="redshift",
-        table='weather_stations',
-        append=False,
-        dag=dag        
-)
+        execution_time='{{ts_nodash}}',
+        # Offline, the helper already staged the rows.
+        stage=OFFLINE_CONN_ID is None,
+        archive_key=RAW_ARCHIVE and RAW_ARCHIVE + '/rainfall/runs/{{ ts_nodash }}.json',
+        dag=dag
+)
+
+if CARPARK_DELTA_STATE is None:
+        stage_load_check_carpark_availability = StageLoadCheckOperator(
+                task_id='stage_load_check_carpark_availability',
+                aws_credentials_id='aws_credentials_id',
+                redshift_conn_id=REDSHIFT_CONN_ID,
+                table='carpark_availability',
+                s3_bucket='udacity-dend-alex-ho',
+                s3_key='carpark_sg/carpark_{{ ts_nodash }}.csv',
+                execution_time='{{ts_nodash}}',
+                # Offline, the helper already staged the rows.
+                stage=OFFLINE_CONN_ID is None,
+                archive_key=RAW_ARCHIVE and RAW_ARCHIVE + '/carpark/runs/{{ ts_nodash }}.json',
+                # A run whose payload is identical to the previous run gets a copy of its rows.
+                carry_forward=True,
+                dag=dag
+        )
+else:
+        stage_load_check_carpark_availability = StageLoadCheckOperator(
+                task_id='stage_load_check_carpark_availability_delta',
+                aws_credentials_id='aws_credentials_id',
+                redshift_conn_id=REDSHIFT_CONN_ID,
+                table='carpark_availability_delta',
+                s3_bucket='udacity-dend-alex-ho',
+                s3_key='carpark_sg/carpark_delta_{{ ts_nodash }}.csv',
+                execution_time='{{ts_nodash}}',
+                # Offline, the helper already staged the rows.
+                stage=OFFLINE_CONN_ID is None,
+                archive_key=RAW_ARCHIVE and RAW_ARCHIVE + '/carpark/runs/{{ ts_nodash }}.json',
+                # No carry_forward, a run without any change has no row in the delta table.
+                dag=dag
+        )
 
 load_time_table = LoadDimensionOperator(
         task_id='load_time_dimension_table',
-        redshift_conn_id='redshift',
+        redshift_conn_id=REDSHIFT_CONN_ID,
         table='time',
         append=True,
-        dag=dag
-)
-
-run_quality_checks_fact = DataQualityOperator(
-        task_id='Run_data_quality_checks_fact',
-        redshift_conn_id="redshift",
-        execution_time='{{ts_nodash}}',
-        table_to_check='fact',
-        dag=dag
-)
-
-run_quality_checks_dimension = DataQualityOperator(
-        task_id='Run_data_quality_checks_dimension',
-        redshift_conn_id="redshift",
-        execution_time='{{ts_nodash}}',
-        table_to_check='dimension',
+        availability_table=AVAILABILITY_STAGING_TABLE,
         dag=dag
 )
 
 calculate_daily_carpark_stats = DailyFactsCalculatorOperator(
         task_id = "calculate_and_create_daily_carpark_availability_table",
         dag = dag,
-        redshift_conn_id="redshift",
-        origin_table="carpark_availability",
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        origin_table=AVAILABILITY_TABLE,
         destination_table="daily_carpark_stats",
         fact_column="lots_available",
-        groupby_column="carpark_id"
+        groupby_column="carpark_id",
+        incremental=True,
+        staging_table=AVAILABILITY_STAGING_TABLE
+)
+
+# The carpark and weather stations dimensions are loaded once a month by the carpark_sg_dimension_dag.
+# The occupancy ratio of the rollups uses the total_lots of the carpark dimension, so the rollups first wait for the
+# dimension run due before the execution time. They only wait on the few runs while that run is in progress.
+update_carpark_occupancy_rollups = OccupancyRollupOperator(
+        task_id='update_carpark_occupancy_rollups',
+        redshift_conn_id=REDSHIFT_CONN_ID,
+        origin_table=AVAILABILITY_TABLE,
+        table_prefix="carpark_occupancy",
+        incremental=True,
+        staging_table=AVAILABILITY_STAGING_TABLE,
+        dimension_dag_id='carpark_sg_dimension_dag',
+        # Same schedule as the carpark_sg_dimension_dag.
+        dimension_schedule='0 3 25 * *',
+        dag=dag
 )
 
 check_daily_carpark_stats = HasRowsOperator(
         task_id='check_daily_carpark_stats_data',
         dag=dag,
         provide_context=True,
-        redshift_conn_id='redshift',
+        redshift_conn_id=REDSHIFT_CONN_ID,
         table='daily_carpark_stats',
 )
 
 end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
 
+# Weather Workflow
+start_operator >> load_weather_to_s3
+
 # Temperature Workflow
-start_operator >> load_temperature_to_s3
-load_temperature_to_s3 >> stage_temperature_from_s3_to_redshift
-stage_temperature_from_s3_to_redshift >> load_temperature_table
-load_temperature_table >> run_quality_checks_fact
-run_quality_checks_fact >> end_operator
+load_weather_to_s3 >> stage_load_check_temperature
+stage_load_check_temperature >> end_operator
 
 # Rainfall Workflow
-start_operator >> load_rainfall_to_s3 
-load_rainfall_to_s3 >> stage_rainfall_from_s3_to_redshift
-stage_rainfall_from_s3_to_redshift >> load_rainfall_table 
-load_rainfall_table >> run_quality_checks_fact
-run_quality_checks_fact >> end_operator
+load_weather_to_s3 >> stage_load_check_rainfall
+stage_load_check_rainfall >> end_operator
 
 # Carpark Availability Workflow
 start_operator >> load_carpark_availability_to_s3 
-load_carpark_availability_to_s3 >> stage_carpark_availability_from_s3_to_redshift 
-stage_carpark_availability_from_s3_to_redshift >> load_carpark_table
-stage_carpark_availability_from_s3_to_redshift >> load_carpark_availability_table 
-stage_carpark_availability_from_s3_to_redshift >> load_time_table
-load_carpark_availability_table >> run_quality_checks_fact
-run_quality_checks_fact >> calculate_daily_carpark_stats
+load_carpark_availability_to_s3 >> stage_load_check_carpark_availability
+stage_load_check_carpark_availability >> load_time_table
+stage_load_check_carpark_availability >> calculate_daily_carpark_stats
+stage_load_check_carpark_availability >> update_carpark_occupancy_rollups
+update_carpark_occupancy_rollups >> end_operator
 calculate_daily_carpark_stats >> check_daily_carpark_stats
 check_daily_carpark_stats >> end_operator
 load_time_table >> end_operator
-
-# Carpark Information Workflow (Once a month)
-start_operator >> is_time_of_month 
-is_time_of_month >> load_carpark_info_to_s3
-load_carpark_info_to_s3 >> stage_carpark_info_from_s3_to_redshift
-stage_carpark_info_from_s3_to_redshift >> load_carpark_table 
-load_carpark_table >> run_quality_checks_dimension 
-run_quality_checks_dimension >> end_operator
-
-# Weather Station Information Workflow (Once a month)
-is_time_of_month >> load_weather_stations_info_to_s3
-load_weather_stations_info_to_s3 >> stage_weather_stations_info_from_s3_to_redshift
-stage_weather_stations_info_from_s3_to_redshift >> load_weather_station_table 
-load_weather_station_table >> run_quality_checks_dimension
-run_quality_checks_dimension >> end_operator
\ No newline at end of file
@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+
+from airflow import DAG
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators.python_operator import PythonOperator
+
+from helpers.getCarparkInfo import get_carparkInfo
+from helpers.getWeatherStation import get_weatherStationInfo
+
+from operators.load_to_redshift import LoadS3ToRedshiftOperator
+from operators.load_dimension import LoadDimensionOperator
+from operators.data_quality import DataQualityOperator
+from operators.nearest_station import NearestStationOperator
+
+# 3 a.m. on the 25th of each month. Airflow starts a run at the end of its interval, so the run starting on the
+# 25th of August has the execution date of the 25th of July, and its ts_nodash, e.g. in the S3 keys and the
+# data_quality_history, is a month before it actually runs. The occupancy rollups of the carpark_sg_dag wait for
+# the run due before their execution time, see OccupancyRollupOperator, so keep their dimension_schedule in line.
+DIMENSION_SCHEDULE = '0 3 25 * *'
+
+default_args = {
+        'owner': 'Alex Ho',
+        'start_date': datetime(2019, 1, 1, 0, 0, 0, 0),
+        'depends_on_past': True,
+        'retries': 5,
+        'retry_delay': timedelta(minutes=15),
+}
+
+dag = DAG(
+        dag_id = "carpark_sg_dimension_dag",
+        schedule_interval = DIMENSION_SCHEDULE,
+        max_active_runs=1,
+        default_args = default_args
+        # The tasks record no metrics by default. To record them, set 'metrics' in the params of the DAG,
+        # e.g. params = {'metrics': {'statsd': 'localhost:8125'}}. See helpers/metrics.py.
+)
+
+start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
+
+load_carpark_info_to_s3 = PythonOperator(
+        task_id='get_carpark_info_from_api_to_s3',
+        python_callable=get_carparkInfo,
+        provide_context=True,
+        params={
+                's3_bucket': 'udacity-dend-alex-ho',
+                's3_key': 'carpark_sg',
+                'fingerprint': True
+        },
+        dag=dag
+)
+
+load_weather_stations_info_to_s3 = PythonOperator(
+        task_id='get_weather_stations_info_from_api_to_s3',
+        python_callable=get_weatherStationInfo,
+        provide_context=True,
+        params={
+                's3_bucket': 'udacity-dend-alex-ho',
+                's3_key': 'weather_sg',
+                'fingerprint': True,
+                # The run starts a month after its execution time, ask for the stations reporting when it starts.
+                'end_of_interval': True
+        },
+        dag=dag
+)
+
+stage_carpark_info_from_s3_to_redshift = LoadS3ToRedshiftOperator(
+        task_id='stage_carpark_info_from_s3_to_redshift',
+        aws_credentials_id='aws_credentials_id',
+        redshift_conn_id='redshift',
+        table='staging_carpark_info',
+        s3_bucket='udacity-dend-alex-ho',
+        s3_key='carpark_sg/carpark_info_{{ ts_nodash }}.csv',
+        fingerprint=True,
+        dag=dag
+)
+
+stage_weather_stations_info_from_s3_to_redshift = LoadS3ToRedshiftOperator(
+        task_id='stage_weather_stations_info_from_s3_to_redshift',
+        aws_credentials_id='aws_credentials_id',
+        redshift_conn_id='redshift',
+        table='staging_weather_station_info',
+        s3_bucket='udacity-dend-alex-ho',
+        s3_key='weather_sg/weather_stations_info_{{ ts_nodash }}.csv',
+        fingerprint=True,
+        dag=dag
+)
+
+# The carpark dimension also takes total_lots from the carpark availability snapshot, which is not fingerprinted,
+# so only the changed rows are applied, but the diff runs every month. Their previous versions are kept in carpark_history.
+# It is the latest snapshot of each carpark in the carpark availability fact loaded by the carpark_sg_dag.
+load_carpark_table = LoadDimensionOperator(
+        task_id='load_carpark_info_dimension_table',
+        redshift_conn_id="redshift",
+        table='carpark',
+        append=False,
+        history=True,
+        # 'carpark_availability_rebuilt' when the carpark_sg_dag loads the delta encoded availability, see CARPARK_DELTA_STATE.
+        availability_table='carpark_availability',
+        dag=dag
+)
+
+load_weather_station_table = LoadDimensionOperator(
+        task_id='load_weather_stations_info_dimension_table',
+        redshift_conn_id="redshift",
+        table='weather_stations',
+        append=False,
+        diff=True,
+        fingerprint_tables=['staging_weather_station_info'],
+        dag=dag
+)
+
+run_quality_checks_dimension = DataQualityOperator(
+        task_id='Run_data_quality_checks_dimension',
+        redshift_conn_id="redshift",
+        execution_time='{{ts_nodash}}',
+        table_to_check='dimension',
+        dag=dag
+)
+
+build_carpark_station_bridge = NearestStationOperator(
+        task_id='build_carpark_station_bridge_table',
+        redshift_conn_id="redshift",
+        table='carpark_station',
+        k=3,
+        dag=dag
+)
+
+end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
+
+# Carpark Information Workflow
+start_operator >> load_carpark_info_to_s3
+load_carpark_info_to_s3 >> stage_carpark_info_from_s3_to_redshift
+stage_carpark_info_from_s3_to_redshift >> load_carpark_table
+load_carpark_table >> run_quality_checks_dimension
+run_quality_checks_dimension >> build_carpark_station_bridge
+build_carpark_station_bridge >> end_operator
+
+# Weather Station Information Workflow
+start_operator >> load_weather_stations_info_to_s3
+load_weather_stations_info_to_s3 >> stage_weather_stations_info_from_s3_to_redshift
+stage_weather_stations_info_from_s3_to_redshift >> load_weather_station_table
+load_weather_station_table >> run_quality_checks_dimension
+run_quality_checks_dimension >> end_operator
@@ -2,14 +2,25 @@
 staging_temperature_drop = "DROP TABLE IF EXISTS staging_temperature CASCADE"
 staging_rainfall_drop = "DROP TABLE IF EXISTS staging_rainfall CASCADE"
 staging_carpark_availability_drop = "DROP TABLE IF EXISTS staging_carpark_availability CASCADE"
+staging_carpark_availability_delta_drop = "DROP TABLE IF EXISTS staging_carpark_availability_delta CASCADE"
 staging_carpark_info_drop = "DROP TABLE IF EXISTS staging_carpark_info CASCADE"
 staging_weather_stations_info_drop = "DROP TABLE IF EXISTS staging_weather_station_info CASCADE"
 temperature_events_drop = "DROP TABLE IF EXISTS temperature_events CASCADE"
 rainfall_events_drop = "DROP TABLE IF EXISTS rainfall_events CASCADE"
 carpark_availability_drop = "DROP TABLE IF EXISTS carpark_availability CASCADE"
+carpark_availability_rebuilt_drop = "DROP VIEW IF EXISTS carpark_availability_rebuilt"
+carpark_availability_delta_drop = "DROP TABLE IF EXISTS carpark_availability_delta CASCADE"
+carpark_occupancy_hourly_drop = "DROP TABLE IF EXISTS carpark_occupancy_hourly CASCADE"
+carpark_occupancy_daily_drop = "DROP TABLE IF EXISTS carpark_occupancy_daily CASCADE"
+carpark_occupancy_weekly_drop = "DROP TABLE IF EXISTS carpark_occupancy_weekly CASCADE"
 weather_station_drop = "DROP TABLE IF EXISTS weather_stations CASCADE"
 carpark_drop = "DROP TABLE IF EXISTS carpark CASCADE"
+carpark_history_drop = "DROP TABLE IF EXISTS carpark_history CASCADE"
+carpark_station_drop = "DROP TABLE IF EXISTS carpark_station CASCADE"
 time_drop = "DROP TABLE IF EXISTS time CASCADE"
+data_quality_history_drop = "DROP TABLE IF EXISTS data_quality_history CASCADE"
+load_fingerprints_drop = "DROP TABLE IF EXISTS load_fingerprints CASCADE"
+load_ledger_drop = "DROP TABLE IF EXISTS load_ledger CASCADE"
 
 # CREATE TABLES
 staging_temperature_create = ("""CREATE TABLE public.staging_temperature (
@@ -32,6 +43,15 @@ staging_carpark_availability_create = ("""CREATE TABLE public.staging_carpark_av
         total_lots integer        
 );""")
 
+staging_carpark_availability_delta_create = ("""CREATE TABLE public.staging_carpark_availability_delta (
+        date_time timestamptz NOT NULL,
+        carpark_id varchar,
+        lot_type varchar,
+        lots_available integer,
+        total_lots integer,
+        change_type varchar(1)
+);""")
+
 staging_carpark_info_create = ("""CREATE TABLE public.staging_carpark_info (
         carpark_id varchar,
         carpark_location varchar,
@@ -65,11 +85,78 @@ rainfall_events_create = ("""CREATE TABLE public.rainfall_events (
 carpark_availability_create = ("""CREATE TABLE public.carpark_availability (
         date_time timestamptz NOT NULL,
         carpark_id varchar,
+        lot_type varchar,
         lots_available integer,
+        total_lots integer,
         FOREIGN KEY (carpark_id) references carpark (carpark_id)
 ) diststyle KEY distkey (date_time) compound sortkey (date_time, carpark_id);
 """)
 
+carpark_availability_delta_create = ("""CREATE TABLE public.carpark_availability_delta (
+        date_time timestamptz NOT NULL,
+        carpark_id varchar,
+        lot_type varchar,
+        lots_available integer,
+        total_lots integer,
+        change_type varchar(1) NOT NULL
+) diststyle KEY distkey (date_time) compound sortkey (date_time, carpark_id);
+""")
+
+carpark_availability_rebuilt_create = ("""CREATE VIEW public.carpark_availability_rebuilt AS
+SELECT date_time, carpark_id, lot_type, lots_available, total_lots
+FROM (
+        SELECT snapshots.date_time, d.carpark_id, d.lot_type, d.lots_available, d.total_lots, d.change_type,
+                ROW_NUMBER() OVER (PARTITION BY snapshots.date_time, d.carpark_id, d.lot_type
+                        ORDER BY d.date_time DESC) AS row_number
+        FROM (
+                SELECT s.date_time, MAX(c.date_time) AS checkpoint_time
+                FROM (SELECT DISTINCT date_time FROM public.carpark_availability_delta) AS s
+                JOIN (SELECT DISTINCT date_time FROM public.carpark_availability_delta WHERE change_type = 'C') AS c
+                ON c.date_time <= s.date_time
+                GROUP BY s.date_time
+        ) AS snapshots
+        JOIN public.carpark_availability_delta AS d
+        ON d.date_time >= snapshots.checkpoint_time AND d.date_time <= snapshots.date_time
+) AS readings
+WHERE row_number = 1 AND change_type <> 'R';
+""")
+
+carpark_occupancy_hourly_create = ("""CREATE TABLE public.carpark_occupancy_hourly (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);""")
+
+carpark_occupancy_daily_create = ("""CREATE TABLE public.carpark_occupancy_daily (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);""")
+
+carpark_occupancy_weekly_create = ("""CREATE TABLE public.carpark_occupancy_weekly (
+        bucket timestamptz NOT NULL,
+        carpark_id varchar NOT NULL,
+        min_lots_available integer,
+        max_lots_available integer,
+        sum_lots_available bigint,
+        count_lots_available bigint,
+        sum_occupied_lots bigint,
+        sum_capacity_lots bigint,
+        occupancy_ratio double precision
+) diststyle KEY distkey (carpark_id) compound sortkey (bucket, carpark_id);""")
+
 weather_station_create = ("""CREATE TABLE public.weather_stations (
         station_id varchar NOT NULL,
         station_location varchar,
@@ -87,6 +174,24 @@ carpark_create = ("""CREATE TABLE public.carpark (
         CONSTRAINT carpark_pkey PRIMARY KEY (carpark_id)
 );""")
 
+carpark_history_create = ("""CREATE TABLE public.carpark_history (
+        carpark_id varchar NOT NULL,
+        carpark_location varchar,
+        carpark_latitude double precision,
+        carpark_longitude double precision,
+        total_lots integer,
+        row_hash varchar(32),
+        valid_from timestamptz NOT NULL,
+        valid_to timestamptz
+) compound sortkey (carpark_id, valid_from);""")
+
+carpark_station_create = ("""CREATE TABLE public.carpark_station (
+        carpark_id varchar NOT NULL,
+        station_id varchar NOT NULL,
+        station_rank integer NOT NULL,
+        distance_km double precision
+) diststyle ALL compound sortkey (carpark_id, station_rank);""")
+
 time_create = ("""CREATE TABLE public.time(
         date_time timestamptz PRIMARY KEY,
         hour integer,
@@ -95,11 +200,46 @@ time_create = ("""CREATE TABLE public.time(
         month integer,
         year integer,
         weekday integer
-);""")
+) diststyle ALL sortkey (date_time);""")
+
+data_quality_history_create = ("""CREATE TABLE public.data_quality_history (
+        run_id varchar NOT NULL,
+        run_time timestamp NOT NULL,
+        execution_time timestamptz,
+        check_name varchar,
+        table_name varchar,
+        table_role varchar,
+        row_count bigint,
+        null_count bigint,
+        duplicate_count bigint,
+        min_value double precision,
+        max_value double precision
+) compound sortkey (run_time, check_name);
+""")
+
+load_fingerprints_create = ("""CREATE TABLE public.load_fingerprints (
+        table_name varchar NOT NULL,
+        fingerprint varchar NOT NULL,
+        source varchar,
+        loaded_at timestamp
+);
+""")
+
+load_ledger_create = ("""CREATE TABLE public.load_ledger (
+        table_name varchar NOT NULL,
+        s3_key varchar NOT NULL,
+        manifest_key varchar,
+        loaded_at timestamp
+) compound sortkey (table_name, s3_key);
+""")
 
 create_table_queries = [staging_temperature_create, staging_rainfall_create, staging_carpark_availability_create,
-staging_carpark_info_create, staging_weather_stations_info_create, weather_station_create, carpark_create, time_create,
-temperature_events_create, rainfall_events_create, carpark_availability_create]
+staging_carpark_availability_delta_create, staging_carpark_info_create, staging_weather_stations_info_create, weather_station_create, carpark_create, carpark_history_create, carpark_station_create, time_create,
+temperature_events_create, rainfall_events_create, carpark_availability_create, carpark_availability_delta_create, carpark_availability_rebuilt_create,
+carpark_occupancy_hourly_create, carpark_occupancy_daily_create, carpark_occupancy_weekly_create,
+data_quality_history_create, load_fingerprints_create, load_ledger_create]
 
-drop_table_queries = [staging_temperature_drop, staging_rainfall_drop, staging_carpark_availability_drop, staging_carpark_info_drop, staging_weather_stations_info_drop, 
-temperature_events_drop, rainfall_events_drop, carpark_availability_drop, weather_station_drop, carpark_drop, time_drop]
\ No newline at end of file
+drop_table_queries = [staging_temperature_drop, staging_rainfall_drop, staging_carpark_availability_drop, staging_carpark_availability_delta_drop, staging_carpark_info_drop, staging_weather_stations_info_drop, 
+temperature_events_drop, rainfall_events_drop, carpark_availability_drop, carpark_availability_rebuilt_drop,
+carpark_availability_delta_drop, carpark_occupancy_hourly_drop, carpark_occupancy_daily_drop, carpark_occupancy_weekly_drop,
+weather_station_drop, carpark_drop, carpark_history_drop, carpark_station_drop, time_drop, data_quality_history_drop, load_fingerprints_drop, load_ledger_drop]
\ No newline at end of file
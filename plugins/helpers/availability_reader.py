@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from helpers.sql_queries import SqlQueries
+
+# New carpark availability snapshots land every 10 minutes.
+INGEST_INTERVAL = 600
+
+
+class TTLCache:
+        """
+        Bounded least recently used cache, whose entries also expire after a time to live.
+
+        Args:
+                max_size: The maximum number of entries. The least recently used one is evicted first.
+                        0 disables the cache.
+                ttl: Seconds after which an entry expires.
+        """
+        def __init__(self, max_size=4096, ttl=INGEST_INTERVAL):
+                self.max_size = max_size
+                self.ttl = ttl
+                self._entries = OrderedDict()
+                self._lock = threading.Lock()
+
+        def get(self, key):
+                """ Return the value of the key, or None if it is missing or expired """
+                with self._lock:
+                        entry = self._entries.get(key)
+                        if entry is None:
+                                return None
+                        expires_at, value = entry
+                        if expires_at <= time.monotonic():
+                                del self._entries[key]
+                                return None
+                        self._entries.move_to_end(key)
+                        return value
+
+        def put(self, key, value):
+                if self.max_size <= 0:
+                        return
+                with self._lock:
+                        self._entries[key] = (time.monotonic() + self.ttl, value)
+                        self._entries.move_to_end(key)
+                        while len(self._entries) > self.max_size:
+                                self._entries.popitem(last=False)
+
+        def clear(self):
+                with self._lock:
+                        self._entries.clear()
+
+        def __len__(self):
+                return len(self._entries)
+
+
+class AvailabilityReader:
+        """
+        Read API of the carpark availability facts for the downstream apps.
+
+        It serves the latest availability and the recent history of carparks through a pool of connections,
+        and keeps the results in a bounded LRU cache, whose time to live follows the 10 minutes ingest cadence.
+        The latest date_time of the fact table is checked at most every `freshness_interval` seconds, and the
+        cache is cleared as soon as a new snapshot lands, so the apps never wait for the TTL to see it.
+        The lookups take several carparks at once, and the carparks missing in the cache are read in one query.
+
+        Only the car lots, lot type C, are read, as in the occupancy rollups.
+
+        Args:
+                dsn: The connection string of the warehouse, e.g. PostgresHook(...).get_uri().
+                table: The fact table. Default is carpark_availability
+                pool_size: The maximum number of connections in the pool.
+                cache_size: The maximum number of carpark lookups kept in the cache. 0 disables the cache.
+                ttl: Seconds after which a cached lookup expires. Default is the ingest interval.
+                freshness_interval: Seconds between two checks of the latest date_time of the fact table.
+        """
+        def __init__(self,
+                        dsn,
+                        table="carpark_availability",
+                        pool_size=5,
+                        cache_size=4096,
+                        ttl=INGEST_INTERVAL,
+                        freshness_interval=30):
+                self.table = table
+                self.freshness_interval = freshness_interval
+                self.cache = TTLCache(cache_size, ttl)
+                self.pool = ThreadedConnectionPool(1, pool_size, dsn)
+
+                self._latest_date_time = None
+                self._checked_at = None
+                self._freshness_lock = threading.Lock()
+
+        def close(self):
+                """ Close every connection of the pool """
+                self.pool.closeall()
+
+        def _query(self, sql, parameters=None):
+                """ Run the query on a pooled connection, and return its rows """
+                conn = self.pool.getconn()
+                try:
+                        with conn.cursor() as cursor:
+                                cursor.execute(sql, parameters)
+                                rows = cursor.fetchall()
+                        # End the read transaction, so the next query sees the new snapshots.
+                        conn.rollback()
+                        return rows
+                except Exception:
+                        conn.rollback()
+                        raise
+                finally:
+                        self.pool.putconn(conn)
+
+        def latest_date_time(self):
+                """
+                Return the latest date_time of the fact table. It is read again at most every freshness_interval
+                seconds, and the cache is cleared when it changed.
+                """
+                with self._freshness_lock:
+                        now = time.monotonic()
+                        if self._checked_at is None or now - self._checked_at >= self.freshness_interval:
+                                latest = self._query(SqlQueries.availability_latest_date_time.format(table=self.table))[0][0]
+                                if latest != self._latest_date_time:
+                                        if self._latest_date_time is not None:
+                                                logging.info(f"New carpark availability snapshot at {latest}, clearing the cache")
+                                        self.cache.clear()
+                                        self._latest_date_time = latest
+                                self._checked_at = now
+                        return self._latest_date_time
+
+        def _cached_lookup(self, kind, carpark_ids, fetch):
+                """
+                Return the cached value of every carpark, and read the missing ones with `fetch` in one query.
+                Every carpark gets an entry, so the carparks without rows are cached too.
+                """
+                results = {}
+                missing = []
+                for carpark_id in carpark_ids:
+                        value = self.cache.get((kind, carpark_id))
+                        if value is None:
+                                missing.append(carpark_id)
+                        else:
+                                results[carpark_id] = value
+                if missing:
+                        fetched = fetch(missing)
+                        for carpark_id in missing:
+                                results[carpark_id] = fetched.get(carpark_id, ())
+                                self.cache.put((kind, carpark_id), results[carpark_id])
+                return results
+
+        def latest(self, carpark_ids, lookback_hours=1):
+                """
+                The function returns the latest availability of the carparks.
+
+                Args:
+                        carpark_ids: The ids of the carparks.
+                        lookback_hours: The hours before the latest snapshot searched for the latest row of each carpark,
+                                so the query only reads the last snapshots. Default is 1
+
+                Returns a dict of each carpark id to its (date_time, lots_available), or () if it has no rows.
+                """
+                latest_date_time = self.latest_date_time()
+                if latest_date_time is None:
+                        return {carpark_id: () for carpark_id in carpark_ids}
+
+                def fetch(missing):
+                        rows = self._query(SqlQueries.availability_latest_select.format(table=self.table), {
+                                'carpark_ids': tuple(missing),
+                                'since': latest_date_time - timedelta(hours=lookback_hours),
+                        })
+                        return {carpark_id: (date_time, lots_available) for carpark_id, date_time, lots_available in rows}
+
+                return self._cached_lookup(('latest', lookback_hours), carpark_ids, fetch)
+
+        def recent(self, carpark_ids, hours=24):
+                """
+                The function returns the availability of the carparks over the hours before the latest snapshot.
+
+                Args:
+                        carpark_ids: The ids of the carparks.
+                        hours: The number of hours of history.
+
+                Returns a dict of each carpark id to its list of (date_time, lots_available), oldest first.
+                """
+                latest_date_time = self.latest_date_time()
+                if latest_date_time is None:
+                        return {carpark_id: () for carpark_id in carpark_ids}
+
+                def fetch(missing):
+                        rows = self._query(SqlQueries.availability_recent_select.format(table=self.table), {
+                                'carpark_ids': tuple(missing),
+                                'since': latest_date_time - timedelta(hours=hours),
+                        })
+                        history = {}
+                        for carpark_id, date_time, lots_available in rows:
+                                history.setdefault(carpark_id, []).append((date_time, lots_available))
+                        return {carpark_id: tuple(values) for carpark_id, values in history.items()}
+
+                return self._cached_lookup(('recent', hours), carpark_ids, fetch)
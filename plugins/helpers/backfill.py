@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import pandas as pd
+import s3fs
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# The helpers only import airflow where they set the AWS credentials, so the backfill also runs without it,
+# e.g. in benchmarks/check_backfill.py.
+from helpers import getCarpark, getWeather
+from helpers.http_client import get_http_client
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import COMPRESSION_EXTENSIONS, FILE_EXTENSIONS, save_dataframe
+from helpers.transforms import flatten_carpark, flatten_weather
+
+# Folder of the S3 key where the execution times that could not be fetched are recorded, one file per batch.
+# It is outside the prefix of the data files, so the staging COPY of a range does not load them.
+FAILED_FOLDER = '_backfill_failed'
+
+
+def _dataset_url(dataset):
+        """ Return the API url of the dataset, either 'carpark' or one of the weather datasets """
+        if dataset == 'carpark':
+                return getCarpark.CARPARK_AVAILABILITY_URL
+        if dataset in getWeather.WEATHER_DATASETS:
+                return getWeather.WEATHER_URL.format(getWeather.WEATHER_DATASETS[dataset])
+        raise ValueError(f"Unknown dataset: {dataset}")
+
+
+def _fetch(url, execution_time):
+        """
+        Retrieve the raw response body for one execution time. Runs in the pool of threads.
+        Returns None when the call still fails after the retries of the HTTP client, so the rest of the batch is saved.
+        """
+        try:
+                response = get_http_client().get(url, { 'date_time' : execution_time })
+        except Exception as e:
+                logging.warning(f"The API call for {execution_time} failed with {e!r}")
+                return None
+        if response.status_code != 200:
+                logging.warning(f"The API call for {execution_time} returned {response.status_code}")
+                return None
+        return response.content
+
+
+def _transform(dataset, execution_time, body):
+        """ Parse and flatten the raw response body for one execution time. Runs in the pool of processes. """
+        if body is None:
+                return None
+        json_data = json.loads(body.decode('utf-8'))
+        if dataset == 'carpark':
+                return flatten_carpark(json_data, execution_time)
+        return flatten_weather(json_data)
+
+
+def _ts_nodash(execution_time):
+        """ Convert the execution time to the format of ts_nodash used in the file names """
+        return datetime.strptime(execution_time, '%Y-%m-%dT%H:%M:%S').strftime('%Y%m%dT%H%M%S')
+
+
+def execution_times(start, end, interval=timedelta(minutes=10)):
+        """
+        Return the execution times from start up to and excluding end, every interval,
+        in the '%Y-%m-%dT%H:%M:%S' format used by the API.
+        """
+        times = []
+        current = start
+        while current < end:
+                times.append(current.strftime('%Y-%m-%dT%H:%M:%S'))
+                current += interval
+        return times
+
+
+def backfill(dataset, start, end, s3_bucket, s3_key,
+                interval=timedelta(minutes=10),
+                batch_size=144,
+                fetch_workers=5,
+                transform_workers=None,
+                output_format='csv',
+                compression=None):
+        """
+        The function retrieves a dataset for every execution time between start and end,
+        and saves them as a few batched files in the S3 bucket instead of one file per execution time.
+
+        The snapshots are fetched by a bounded pool of threads sharing the pooled HTTP client,
+        and parsed and flattened by a pool of processes as soon as they arrive. Each batch of
+        `batch_size` snapshots (one day by default) is saved as one file named after its first and
+        last execution time, e.g. carpark_20190101T000000_20190101T235000.csv. So the staging COPY
+        can load a whole range with its S3 key prefix, e.g. carpark_sg/carpark_201901.
+
+        The backfill can be rerun with the same arguments to resume it: the batches whose file already exists
+        are skipped. An execution time that still fails after the retries of the HTTP client does not stop the
+        backfill, the rest of its batch is saved, and the failed times are recorded as a json list in
+        `<s3_key>/_backfill_failed/<file name>.json`. The batches with failed times are fetched again on the next run,
+        which removes the record once the whole batch is saved.
+
+        Args:
+                dataset: 'carpark' or one of the weather datasets, e.g. 'temperature'.
+                start: The first execution time, as datetime.
+                end: The execution time to stop before, as datetime.
+                s3_bucket: The name of bucket.
+                s3_key: The folder to save the files.
+                interval: The time between execution times. Default is 10 minutes, the same as the dag.
+                batch_size: The number of execution times saved in each file.
+                fetch_workers: The number of API calls in flight at the same time, also bounded by the HTTP client.
+                transform_workers: The number of processes to transform the data. Default is the number of CPUs.
+                output_format: Either 'csv' or 'parquet'.
+                compression: None (default), 'gzip' or 'zstd' to compress the CSV files.
+
+        Returns the list of files saved, and the list of execution times that failed.
+        """
+        url = _dataset_url(dataset)
+        dtypes = getCarpark.PARQUET_DTYPES if dataset == 'carpark' else getWeather.PARQUET_DTYPES
+        times = execution_times(start, end, interval)
+        logging.info(f"Backfilling {len(times)} {dataset} snapshots from {start} to {end}")
+
+        fs = s3fs.S3FileSystem()
+        saved = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, \
+                        ProcessPoolExecutor(max_workers=transform_workers) as transform_pool:
+                for i in range(0, len(times), batch_size):
+                        batch = times[i:i + batch_size]
+                        file_name = f"{dataset}_{_ts_nodash(batch[0])}_{_ts_nodash(batch[-1])}.{FILE_EXTENSIONS[output_format]}"
+                        if compression is not None:
+                                file_name += f".{COMPRESSION_EXTENSIONS[compression]}"
+                        s3_path = "{}/{}/{}".format(s3_bucket, s3_key, file_name)
+                        failed_path = "{}/{}/{}/{}.json".format(s3_bucket, s3_key, FAILED_FOLDER, file_name)
+                        if fs.exists(s3_path) and not fs.exists(failed_path):
+                                logging.info(f"Skipping the {dataset} data between {batch[0]} and {batch[-1]}, already saved to {s3_path}")
+                                continue
+
+                        # The bodies are handed to the processes in order, as soon as each of them arrives.
+                        bodies = fetch_pool.map(_fetch, [url] * len(batch), batch)
+                        frames = list(transform_pool.map(_transform, [dataset] * len(batch), batch, bodies))
+                        batch_failed = [execution_time for execution_time, frame in zip(batch, frames) if frame is None]
+                        frames = [frame for frame in frames if frame is not None and not frame.empty]
+
+                        if frames:
+                                data = pd.concat(frames, ignore_index=True)
+                                # The transforms run in other processes, so only the rows of each batch are recorded.
+                                get_metrics().count('rows', len(data), source=dataset)
+                                logging.info(f"Saving {len(batch) - len(batch_failed)} snapshots of {dataset} data to {s3_path}")
+                                save_dataframe(data, "s3a://" + s3_path, output_format, dtypes, compression)
+                                saved.append("s3a://" + s3_path)
+                        else:
+                                logging.info(f"No {dataset} data between {batch[0]} and {batch[-1]}")
+
+                        if batch_failed:
+                                get_metrics().count('failed_snapshots', len(batch_failed), source=dataset)
+                                logging.warning(f"{len(batch_failed)} {dataset} snapshots between {batch[0]} and {batch[-1]} failed, "
+                                                f"recorded in {failed_path}")
+                                with fs.open(failed_path, 'w') as f:
+                                        json.dump(batch_failed, f)
+                                failed.extend(batch_failed)
+                        elif fs.exists(failed_path):
+                                fs.rm(failed_path)
+        return saved, failed
+
+
+@instrumented
+def get_backfill(*args, **kwargs):
+        """
+        The function backfills a dataset over a time range in one task. See `backfill`.
+
+        The params are 'dataset', 'start' and 'end' in '%Y-%m-%dT%H:%M:%S' format, 's3_bucket' and 's3_key',
+        and optionally 'batch_size', 'fetch_workers', 'transform_workers', 'output_format' and 'compression'.
+        The conf of a manually triggered run overrides them, see dags/carparksg_backfill_dag.py.
+
+        The task fails when some execution times could not be fetched, after saving everything else,
+        so its retry resumes the backfill with the batches that are missing or have failed times.
+        """
+        # Setting up credentials for AWS services
+        from airflow.contrib.hooks.aws_hook import AwsHook
+        aws_hook = AwsHook('aws_credentials_id')
+        credentials = aws_hook.get_credentials()
+        os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
+        os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
+
+        params = dict(kwargs['params'])
+        dag_run = kwargs.get('dag_run')
+        if dag_run is not None and dag_run.conf:
+                params.update(dag_run.conf)
+        saved, failed = backfill(params['dataset'],
+                        datetime.strptime(params['start'], '%Y-%m-%dT%H:%M:%S'),
+                        datetime.strptime(params['end'], '%Y-%m-%dT%H:%M:%S'),
+                        params['s3_bucket'],
+                        params['s3_key'],
+                        batch_size=params.get('batch_size', 144),
+                        fetch_workers=params.get('fetch_workers', 5),
+                        transform_workers=params.get('transform_workers'),
+                        output_format=params.get('output_format', 'csv'),
+                        compression=params.get('compression'))
+        if failed:
+                raise ValueError(f"{len(failed)} {params['dataset']} snapshots could not be fetched, "
+                                 f"see {params['s3_key']}/{FAILED_FOLDER}. Saved {len(saved)} files, rerun to resume.")
+        return saved
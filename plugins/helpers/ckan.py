@@ -0,0 +1,63 @@
+import logging
+
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers.http_client import get_http_client
+from helpers.streaming import iter_json_items
+from helpers.transforms import flatten_records
+
+# The CKAN datastore returns 100 records per page by default.
+DEFAULT_PAGE_SIZE = 1000
+
+
+def _fetch_page(url, resource_id, offset, page_size, streaming=False):
+        """ Retrieve one page of records of the datastore resource, starting at offset """
+        parameters = { 'resource_id': resource_id, 'limit': page_size, 'offset': offset }
+        response = get_http_client().get(url, parameters, stream=streaming)
+        if response.status_code != 200:
+                raise ValueError(f"Error in the API call for offset {offset}")
+        if streaming:
+                # The records are collected into columns while they are parsed.
+                return flatten_records(iter_json_items(response, 'result.records.item'))
+        return response.json()['result']['records']
+
+
+def fetch_datastore(url, resource_id, page_size=DEFAULT_PAGE_SIZE, workers=5, streaming=False):
+        """
+        The function retrieves all the records of a CKAN datastore resource, e.g. the carpark information of data.gov.sg.
+
+        The first page tells the `total` number of records. The remaining pages are then fetched
+        concurrently by a bounded pool of threads sharing the pooled HTTP client, one offset window each,
+        and assembled in order into one DataFrame.
+
+        Args:
+                url: The url of the datastore_search API.
+                resource_id: The id of the datastore resource.
+                page_size: The number of records per page, i.e. the `limit` of each call.
+                workers: The number of pages fetched at the same time, also bounded by the HTTP client.
+                streaming: If True, the pages after the first one are parsed incrementally.
+        """
+        response = get_http_client().get(url, { 'resource_id': resource_id, 'limit': page_size, 'offset': 0 })
+        if response.status_code != 200:
+                raise ValueError("Error in the API call")
+        result = response.json()['result']
+        total = result['total']
+        offsets = list(range(page_size, total, page_size))
+        logging.info(f"Retrieving {total} records of {resource_id} in {len(offsets) + 1} pages")
+
+        pages = [result['records']]
+        if offsets:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                        # map returns the pages in the order of the offsets, whatever order they arrive in.
+                        pages.extend(executor.map(
+                                lambda offset: _fetch_page(url, resource_id, offset, page_size, streaming), offsets))
+
+        frames = [pd.DataFrame(page) for page in pages if len(page)]
+        if not frames:
+                return pd.DataFrame()
+        data = pd.concat(frames, ignore_index=True, sort=False)
+        if len(data) != total:
+                logging.warning(f"Retrieved {len(data)} records of {resource_id}, expected {total}")
+        return data
@@ -0,0 +1,130 @@
+import gzip
+import json
+import logging
+import os
+
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+# Types of change of the rows of the delta encoded carpark availability.
+CHECKPOINT = 'C'
+UPDATE = 'U'
+REMOVED = 'R'
+
+# Minutes between two full checkpoints. Default is one a day, at midnight.
+DEFAULT_CHECKPOINT_MINUTES = 1440
+
+# Columns of the delta encoded snapshot, in the order of the staging table.
+DELTA_COLUMNS = ['timestamp', 'carpark_number', 'lot_type', 'lots_available', 'total_lots', 'change_type']
+
+
+class DeltaState:
+        """
+        Local state store of the latest carpark availability snapshot, one entry per carpark and lot type,
+        saved as a small gzip compressed json file, e.g. 2,000 carparks take a few tens of KB.
+
+        Args:
+                path: The path of the state file on the worker.
+        """
+        def __init__(self, path):
+                self.path = path
+                self.ts_nodash = None
+                self.values = {}
+
+        def load(self):
+                """ Read the state file, if there is one, and return the state """
+                if os.path.exists(self.path):
+                        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                                content = json.load(f)
+                        self.ts_nodash = content['ts_nodash']
+                        self.values = {key: tuple(value) for key, value in content['values'].items()}
+                return self
+
+        def save(self, ts_nodash, values):
+                """ Replace the state file with the snapshot of the run. The file is replaced at once, so it is never half written """
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                temporary = self.path + '.tmp'
+                with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+                        json.dump({'ts_nodash': ts_nodash, 'values': values}, f)
+                os.replace(temporary, self.path)
+                self.ts_nodash = ts_nodash
+                self.values = values
+
+
+def is_checkpoint_time(execution_time, checkpoint_minutes=DEFAULT_CHECKPOINT_MINUTES):
+        """ Return True if the execution time falls on a checkpoint, i.e. every checkpoint_minutes from midnight """
+        execution_time = datetime.strptime(execution_time, '%Y-%m-%dT%H:%M:%S')
+        return (execution_time.hour * 60 + execution_time.minute) % checkpoint_minutes == 0
+
+
+def delta_encode(carpark_data, previous, checkpoint):
+        """
+        The function keeps only the readings of the flattened snapshot that changed since the previous snapshot.
+
+        A reading changed when the lots available or total lots of its carpark and lot type differ from the previous
+        snapshot, or when the carpark and lot type are new. The carparks and lot types of the previous snapshot that
+        are missing in this one get a row without values, so the rebuilt state drops them. A checkpoint keeps every
+        reading, so the state can be rebuilt from the latest checkpoint, without the rows before it.
+
+        Args:
+                carpark_data: The DataFrame returned by `flatten_carpark`.
+                previous: The values of the previous snapshot, see `DeltaState.values`, or None for a checkpoint.
+                checkpoint: If True, every reading is kept as a checkpoint.
+
+        Returns the delta encoded DataFrame with the DELTA_COLUMNS, and the values of the snapshot for the state.
+        """
+        if carpark_data.empty:
+                # An empty response does not remove every carpark, the previous snapshot is kept as the state.
+                return pd.DataFrame(columns=DELTA_COLUMNS), dict(previous or {})
+
+        # The API may list a carpark twice, the last reading wins, the same as in the rebuilt state.
+        current = carpark_data[DELTA_COLUMNS[:-1]].drop_duplicates(['carpark_number', 'lot_type'], keep='last')
+        keys = current['carpark_number'].astype(str) + '|' + current['lot_type'].astype(str)
+        values = OrderedDict(zip(keys.tolist(), zip(current['lots_available'].tolist(), current['total_lots'].tolist())))
+
+        if checkpoint or previous is None:
+                delta = current.assign(change_type=CHECKPOINT)
+        else:
+                changed = [previous.get(key) != tuple(value) for key, value in values.items()]
+                delta = current[changed].assign(change_type=UPDATE)
+                removed = [key for key in previous if key not in values]
+                if removed:
+                        delta = pd.concat([delta, pd.DataFrame(OrderedDict([
+                                ('timestamp', [current['timestamp'].iloc[0]] * len(removed)),
+                                ('carpark_number', [key.split('|', 1)[0] for key in removed]),
+                                ('lot_type', [key.split('|', 1)[1] for key in removed]),
+                                ('lots_available', [None] * len(removed)),
+                                ('total_lots', [None] * len(removed)),
+                                ('change_type', [REMOVED] * len(removed)),
+                        ]))], ignore_index=True)
+
+        logging.info(f"Delta encoded {len(delta)} of {len(current)} readings"
+                     + (" as a checkpoint" if checkpoint or previous is None else ""))
+        return delta.reset_index(drop=True), values
+
+
+def encode_snapshot(carpark_data, state, prev_ts_nodash, execution_time, checkpoint_minutes=DEFAULT_CHECKPOINT_MINUTES):
+        """
+        The function delta encodes the snapshot of the run against the state of the previous run.
+
+        It is a full checkpoint at the checkpoint times, and whenever the state is not the one of the previous run,
+        e.g. on the first run, after a gap or when a run is cleared, so the deltas are always relative to the
+        snapshot loaded just before them.
+
+        Args:
+                carpark_data: The DataFrame returned by `flatten_carpark`.
+                state: The loaded DeltaState.
+                prev_ts_nodash: The execution time of the previous run, or None.
+                execution_time: The execution time in '%Y-%m-%dT%H:%M:%S' format.
+                checkpoint_minutes: The minutes between two checkpoints, from midnight.
+
+        Returns the delta encoded DataFrame, and the values of the snapshot to save in the state once it is loaded.
+        """
+        checkpoint = (is_checkpoint_time(execution_time, checkpoint_minutes)
+                      or state.ts_nodash is None
+                      or prev_ts_nodash is None
+                      or state.ts_nodash != prev_ts_nodash)
+        return delta_encode(carpark_data, None if checkpoint else state.values, checkpoint)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import logging
+
+import s3fs
+
+from helpers.output import output_file_name, save_dataframe
+
+# Suffix of the fingerprint file saved next to each dimension snapshot.
+FINGERPRINT_SUFFIX = '.fingerprint'
+
+
+def dataframe_fingerprint(data):
+        """
+        The function returns a content fingerprint of the DataFrame, i.e. the sha256 of its normalized records.
+
+        The records are normalized so the fingerprint does not change when the API returns the same
+        records in a different order: the columns are sorted by name, the values are converted to text
+        with missing values as empty strings and surrounding spaces removed, and the rows are sorted.
+
+        Args:
+                data: The DataFrame to fingerprint.
+        """
+        columns = sorted(data.columns)
+        normalized = data[columns].astype(object).where(data[columns].notnull(), '')
+        normalized = normalized.astype(str).apply(lambda column: column.str.strip())
+        normalized = normalized.sort_values(columns)
+        return hashlib.sha256(normalized.to_csv(index=False).encode('utf-8')).hexdigest()
+
+
+def read_fingerprint(s3_path):
+        """ Return the content of the fingerprint file at the S3 path, or None if there is no such file """
+        fs = s3fs.S3FileSystem()
+        path = s3_path.split('://', 1)[-1]
+        if not fs.exists(path):
+                return None
+        with fs.open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+
+
+def write_fingerprint(s3_path, fingerprint):
+        """ Save the fingerprint as a small json file at the S3 path """
+        fs = s3fs.S3FileSystem()
+        with fs.open(s3_path.split('://', 1)[-1], 'wb') as f:
+                f.write(json.dumps(fingerprint).encode('utf-8'))
+
+
+def save_dimension_snapshot(data, prefix, ts_nodash, s3_bucket, s3_key, output_format='csv', dtypes=None, compression=None):
+        """
+        The function saves a dimension snapshot to S3 only if its content changed since the previous run.
+
+        The fingerprint of the snapshot is compared with the latest one, saved in {prefix}_latest.fingerprint.
+        If it changed, the snapshot is saved as usual, e.g. carpark_info_20190825T030000.csv. If not, the file
+        is not written again. Either way, a fingerprint file is saved next to the file name of this run,
+        e.g. carpark_info_20190825T030000.csv.fingerprint, with the key of the file holding the content.
+        So the staging operator can skip the COPY when the fingerprint is already loaded.
+
+        Args:
+                data: The DataFrame of the dimension snapshot.
+                prefix: The prefix of the file name, e.g. carpark_info.
+                ts_nodash: The execution time of the run.
+                s3_bucket: The name of bucket.
+                s3_key: The folder to save the files.
+                output_format: Either 'csv' or 'parquet'.
+                dtypes: The types of the columns for Parquet. See `to_typed`.
+                compression: None (default), 'gzip' or 'zstd' to compress the CSV file.
+
+        Returns True if the snapshot changed and was saved, False otherwise.
+        """
+        file_name = output_file_name(prefix, ts_nodash, output_format, compression)
+        data_key = "{}/{}".format(s3_key, file_name)
+        latest_path = "s3a://{}/{}/{}_latest{}".format(s3_bucket, s3_key, prefix, FINGERPRINT_SUFFIX)
+
+        fingerprint = {
+                'fingerprint': dataframe_fingerprint(data),
+                'output_format': output_format,
+                'compression': compression,
+                'rows': len(data),
+        }
+        latest = read_fingerprint(latest_path)
+        changed = (latest is None
+                        or latest['fingerprint'] != fingerprint['fingerprint']
+                        or latest['output_format'] != output_format
+                        or latest.get('compression') != compression)
+
+        if changed:
+                s3_path = "s3a://{}/{}".format(s3_bucket, data_key)
+                logging.info(f"The {prefix} snapshot changed, saving it to { s3_path }")
+                save_dataframe(data, s3_path, output_format, dtypes, compression)
+                fingerprint['data_key'] = data_key
+                write_fingerprint(latest_path, fingerprint)
+        else:
+                logging.info(f"The {prefix} snapshot is unchanged since { latest['data_key'] }, skipping the upload")
+                fingerprint['data_key'] = latest['data_key']
+
+        write_fingerprint("s3a://{}/{}{}".format(s3_bucket, data_key, FINGERPRINT_SUFFIX), fingerprint)
+        return changed
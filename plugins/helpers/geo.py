@@ -0,0 +1,142 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# SVY21, the projection of the x_coord and y_coord of the carpark information dataset:
+# a transverse Mercator projection of the WGS84 ellipsoid.
+SVY21_A = 6378137.0
+SVY21_F = 1 / 298.257223563
+SVY21_ORIGIN_LAT = 1.366666
+SVY21_ORIGIN_LON = 103.833333
+SVY21_FALSE_NORTHING = 38744.572
+SVY21_FALSE_EASTING = 28001.642
+SVY21_SCALE = 1.0
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _meridian_distance(lat):
+        """ Distance along the meridian from the equator to the latitude in radians """
+        e2 = (2 * SVY21_F) - (SVY21_F * SVY21_F)
+        e4 = e2 * e2
+        e6 = e4 * e2
+        a0 = 1 - (e2 / 4) - (3 * e4 / 64) - (5 * e6 / 256)
+        a2 = (3. / 8) * (e2 + (e4 / 4) + (15 * e6 / 128))
+        a4 = (15. / 256) * (e4 + (3 * e6 / 4))
+        a6 = 35 * e6 / 3072
+        return SVY21_A * ((a0 * lat) - (a2 * np.sin(2 * lat)) + (a4 * np.sin(4 * lat)) - (a6 * np.sin(6 * lat)))
+
+
+def svy21_to_wgs84(northing, easting):
+        """
+        The function converts SVY21 coordinates to WGS84 latitudes and longitudes in degrees.
+
+        It is vectorized: the coordinates can be scalars, lists, numpy arrays or Series, and all of them
+        are converted at once with numpy, without a loop over the rows.
+
+        Args:
+                northing: The SVY21 northing in meters, i.e. the y_coord of the carpark information dataset.
+                easting: The SVY21 easting in meters, i.e. the x_coord of the carpark information dataset.
+
+        Returns the latitudes and the longitudes, as numpy arrays.
+        """
+        northing = np.asarray(northing, dtype='float64')
+        easting = np.asarray(easting, dtype='float64')
+
+        b = SVY21_A * (1 - SVY21_F)
+        e2 = (2 * SVY21_F) - (SVY21_F * SVY21_F)
+        n = (SVY21_A - b) / (SVY21_A + b)
+        n2, n3, n4 = n ** 2, n ** 3, n ** 4
+        g = SVY21_A * (1 - n) * (1 - n2) * (1 + (9 * n2 / 4) + (225 * n4 / 64)) * (np.pi / 180)
+
+        # Footpoint latitude, where the meridian distance equals the northing.
+        m_prime = _meridian_distance(np.radians(SVY21_ORIGIN_LAT)) + (northing - SVY21_FALSE_NORTHING) / SVY21_SCALE
+        sigma = (m_prime / g) * (np.pi / 180)
+        lat_prime = (sigma + ((3 * n / 2) - (27 * n3 / 32)) * np.sin(2 * sigma)
+                        + ((21 * n2 / 16) - (55 * n4 / 32)) * np.sin(4 * sigma)
+                        + (151 * n3 / 96) * np.sin(6 * sigma)
+                        + (1097 * n4 / 512) * np.sin(8 * sigma))
+
+        sin2 = np.sin(lat_prime) ** 2
+        rho = SVY21_A * (1 - e2) / np.power(1 - e2 * sin2, 1.5)
+        v = SVY21_A / np.sqrt(1 - e2 * sin2)
+        psi = v / rho
+        psi2, psi3, psi4 = psi ** 2, psi ** 3, psi ** 4
+        t = np.tan(lat_prime)
+        t2, t4, t6 = t ** 2, t ** 4, t ** 6
+
+        e_prime = easting - SVY21_FALSE_EASTING
+        x = e_prime / (SVY21_SCALE * v)
+        x3, x5, x7 = x ** 3, x ** 5, x ** 7
+
+        lat_factor = t / (SVY21_SCALE * rho)
+        lat = (lat_prime
+                - lat_factor * (e_prime * x / 2)
+                + lat_factor * (e_prime * x3 / 24) * ((-4 * psi2) + (9 * psi * (1 - t2)) + (12 * t2))
+                - lat_factor * (e_prime * x5 / 720) * ((8 * psi4 * (11 - 24 * t2)) - (12 * psi3 * (21 - 71 * t2))
+                        + (15 * psi2 * (15 - 98 * t2 + 15 * t4)) + (180 * psi * (5 * t2 - 3 * t4)) + (360 * t4))
+                + lat_factor * (e_prime * x7 / 40320) * (1385 - 3633 * t2 + 4095 * t4 + 1575 * t6))
+
+        sec_lat = 1 / np.cos(lat)
+        lon = (np.radians(SVY21_ORIGIN_LON)
+                + x * sec_lat
+                - (x3 * sec_lat / 6) * (psi + 2 * t2)
+                + (x5 * sec_lat / 120) * ((-4 * psi3 * (1 - 6 * t2)) + (psi2 * (9 - 68 * t2)) + (72 * psi * t2) + (24 * t4))
+                - (x7 * sec_lat / 5040) * (61 + 662 * t2 + 1320 * t4 + 720 * t6))
+
+        return np.degrees(lat), np.degrees(lon)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+        """
+        The function returns the great circle distances in km between every point 1 and every point 2,
+        as a matrix with one row per point 1 and one column per point 2.
+
+        Args:
+                lat1, lon1: The latitudes and longitudes of the points 1, in degrees.
+                lat2, lon2: The latitudes and longitudes of the points 2, in degrees.
+        """
+        lat1 = np.radians(np.asarray(lat1, dtype='float64'))[:, np.newaxis]
+        lon1 = np.radians(np.asarray(lon1, dtype='float64'))[:, np.newaxis]
+        lat2 = np.radians(np.asarray(lat2, dtype='float64'))[np.newaxis, :]
+        lon2 = np.radians(np.asarray(lon2, dtype='float64'))[np.newaxis, :]
+        h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def nearest_stations(carparks, stations, k=3):
+        """
+        The function finds the k nearest weather stations of every carpark, by haversine distance.
+
+        The distances of every carpark to every station are computed at once in a matrix, and the k
+        smallest of each row are selected with argpartition, so only the k nearest are sorted. With
+        ~2,000 carparks and ~60 stations the matrix has ~120,000 cells, which takes a few milliseconds,
+        less than building a spatial tree would. The carparks or stations without coordinates are left out.
+
+        Args:
+                carparks: A DataFrame with the carpark_id, carpark_latitude and carpark_longitude columns.
+                stations: A DataFrame with the station_id, station_latitude and station_longitude columns.
+                k: The number of stations per carpark.
+
+        Returns a DataFrame with the carpark_id, station_id, station_rank (1 for the nearest) and distance_km columns.
+        """
+        carparks = carparks.dropna(subset=['carpark_latitude', 'carpark_longitude'])
+        stations = stations.dropna(subset=['station_latitude', 'station_longitude'])
+        k = min(k, len(stations))
+        if carparks.empty or k == 0:
+                return pd.DataFrame(columns=['carpark_id', 'station_id', 'station_rank', 'distance_km'])
+
+        distances = haversine_km(carparks['carpark_latitude'].values, carparks['carpark_longitude'].values,
+                                 stations['station_latitude'].values, stations['station_longitude'].values)
+        rows = np.arange(len(carparks))[:, np.newaxis]
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        # Sort the k nearest of each carpark by distance.
+        nearest = nearest[rows, np.argsort(distances[rows, nearest], axis=1)]
+
+        return pd.DataFrame(OrderedDict([
+                ('carpark_id', np.repeat(np.asarray(carparks['carpark_id'], dtype=object), k)),
+                ('station_id', np.asarray(stations['station_id'], dtype=object)[nearest].ravel()),
+                ('station_rank', np.tile(np.arange(1, k + 1), len(carparks))),
+                ('distance_km', distances[rows, nearest].ravel()),
+        ]))
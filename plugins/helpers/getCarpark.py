@@ -1,13 +1,44 @@
-import requests
 import json
 import os
 import pandas as pd
 import logging
 
 from datetime import datetime
-from pandas.io.json import json_normalize
-from airflow.contrib.hooks.aws_hook import AwsHook
 
+from helpers.delta import DEFAULT_CHECKPOINT_MINUTES, DeltaState, encode_snapshot
+from helpers.http_client import get_http_client
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import output_file_name, save_dataframe
+from helpers.postgres_loader import save_to_staging
+from helpers.raw_archive import DEFAULT_ARCHIVE_PREFIX, archive_payload, read_archived_payload
+from helpers.streaming import iter_json_items
+from helpers.transforms import flatten_carpark, flatten_carpark_readings
+
+CARPARK_AVAILABILITY_URL = "https://api.data.gov.sg/v1/transport/carpark-availability?"
+
+# Types of the columns when the data is saved as Parquet. The lots are nullable, a reading may have no value.
+PARQUET_DTYPES = {
+        'timestamp': 'datetime',
+        'total_lots': 'Int32',
+        'lots_available': 'Int32',
+}
+
+# Types of the columns of the delta encoded file, the removed readings have no lots.
+DELTA_PARQUET_DTYPES = {
+        'timestamp': 'datetime',
+        'total_lots': 'Int32',
+        'lots_available': 'Int32',
+}
+
+
+def previous_ts_nodash(kwargs):
+        """ Return the execution time of the previous scheduled run in the ts_nodash format, or None """
+        prev_execution_date = kwargs.get('prev_execution_date')
+        if prev_execution_date is None:
+                return None
+        return datetime.strftime(prev_execution_date, '%Y%m%dT%H%M%S')
+
+@instrumented
 def get_carpark(*args, **kwargs):
         """
         The function calls the API from data.gov.sg to retrieve Carpark Availability dataset.
@@ -15,15 +46,20 @@ def get_carpark(*args, **kwargs):
         Lastly, the CSV file will be saved in the S3 bucket.
         
         """
-        # Setting up credentials for AWS services
-        aws_hook = AwsHook('aws_credentials_id')
-        credentials = aws_hook.get_credentials()
-        os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
-        os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
+        # Opt-in offline mode loads the data straight into the staging table of a Postgres database, instead of S3.
+        postgres_conn_id = kwargs['params'].get('postgres_conn_id')
+
+        if postgres_conn_id is None:
+                # Setting up credentials for AWS services
+                from airflow.contrib.hooks.aws_hook import AwsHook
+                aws_hook = AwsHook('aws_credentials_id')
+                credentials = aws_hook.get_credentials()
+                os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
+                os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
 
         # Retrieve S3 bucket and S3 key details from the dag config.
-        s3_bucket = kwargs['params']['s3_bucket']
-        s3_key = kwargs['params']['s3_key']
+        s3_bucket = kwargs['params'].get('s3_bucket')
+        s3_key = kwargs['params'].get('s3_key')
 
         logging.info("Connecting to API to query data...")
 
@@ -33,42 +69,97 @@ def get_carpark(*args, **kwargs):
         # Create the parameters to be used to draw data from the API for specific date and time.
         parameters = { 'date_time' : execution_time }
 
-        carpark = requests.get("https://api.data.gov.sg/v1/transport/carpark-availability?", parameters)
-        logging.info(f"Data for { execution_time }")
+        # Opt-in streaming mode parses the response incrementally instead of loading it all in memory.
+        streaming = kwargs['params'].get('streaming', False)
+        # Output format of the file saved in S3, either csv (default) or parquet.
+        output_format = kwargs['params'].get('output_format', 'csv')
+        # Optional compression of the CSV file, either gzip or zstd. Default is no compression.
+        compression = kwargs['params'].get('compression')
+
+        # Opt-in raw archive keeps every response compressed under its content hash, in this folder of the bucket,
+        # and skips the transform and upload of a run whose payload is identical to the previous run.
+        raw_archive = kwargs['params'].get('raw_archive')
+        # Opt-in replay transforms the payload archived for the run again, instead of calling the API.
+        replay = kwargs['params'].get('replay', False)
 
-        if carpark.status_code == 200:
+        # Opt-in delta encoding keeps the previous snapshot in this local state file, and only saves the readings
+        # that changed, plus a full checkpoint every checkpoint_minutes, for the carpark_availability_delta table.
+        delta_state = kwargs['params'].get('delta_state')
+        checkpoint_minutes = kwargs['params'].get('checkpoint_minutes', DEFAULT_CHECKPOINT_MINUTES)
+        state = DeltaState(delta_state).load() if delta_state is not None else None
+
+        if replay:
+                logging.info(f"Reading the archived payload of { execution_time }...")
+                body = read_archived_payload('carpark', kwargs['ts_nodash'], s3_bucket, raw_archive or DEFAULT_ARCHIVE_PREFIX)
+                streaming = False
+        else:
+                # The archive needs the whole body, so the response is not streamed when it is kept.
+                streaming = streaming and raw_archive is None
+                carpark = get_http_client().get(CARPARK_AVAILABILITY_URL, parameters, stream=streaming)
+                logging.info(f"Data for { execution_time }")
+                if carpark.status_code != 200:
+                        raise ValueError("Error in the API call")
+                body = None if streaming else carpark.content
+
+                if raw_archive is not None:
+                        record = archive_payload(body, 'carpark', kwargs['ts_nodash'], s3_bucket, raw_archive)
+                        if record['unchanged']:
+                                logging.info(f"The payload is identical to the previous run, skipping the transform and upload")
+                                if state is not None and state.ts_nodash == previous_ts_nodash(kwargs):
+                                        # The snapshot did not change, so the next run can still be a delta of it.
+                                        state.save(kwargs['ts_nodash'], state.values)
+                                return
+
+        metrics = get_metrics()
+        if streaming:
+                logging.info("Extracting and transforming data while streaming...")
+                # The body is read from the socket while it is transformed, so both are timed together.
+                with metrics.timer('transform', source='carpark'):
+                        readings = iter_json_items(carpark, 'items.item.carpark_data.item')
+                        carpark_data = flatten_carpark_readings(readings, execution_time)
+        else:
                 logging.info("Extracting data...")
-                carpark_data = carpark.json()
+                with metrics.timer('parse', source='carpark'):
+                        carpark_data = json.loads(body)
 
                 logging.info("Transforming data...")
-                # Take data from the items key
-                carpark_data = pd.DataFrame(carpark_data['items'])
-                if (carpark_data.empty != True):
-                        # Expand nested column - carpark_data into multiple rows and rename the columns.
-                        carpark_data = pd.DataFrame([(tup.timestamp, d) for tup in carpark_data.itertuples() for d in tup.carpark_data])
-                        carpark_data.rename(columns={0:'timestamp', 1:'readings'}, inplace=True)
-                        # Expand nested column - readings into multiple columns
-                        carpark_data = pd.concat([carpark_data['timestamp'], json_normalize(carpark_data['readings'])],axis=1)
-                        # Expand nested column - carpark_info into multiple rows and rename the columns
-                        carpark_data = pd.DataFrame([(execution_time, tup.carpark_number, d) for tup in carpark_data.itertuples() for d in tup.carpark_info])
-                        carpark_data.rename(columns={0:'timestamp', 1:'carpark_number', 2:'carpark_info'}, inplace=True)
-                        # Expand nested column - carpark_info into multiple columns
-                        carpark_data = pd.concat([pd.to_datetime(carpark_data['timestamp']), carpark_data['carpark_number'], json_normalize(carpark_data['carpark_info'])], axis=1)
-                        # Format the timestamp column
-                        carpark_data['timestamp'] = [x.strftime("%Y-%m-%d %H:%M:%S") for x in carpark_data['timestamp']]
-
-                logging.info("Prepare to save data...")
-                # Set the filename based on execution date
-                file_name = 'carpark_' + kwargs['ts_nodash'] + '.csv'
-                # full_path = os.path.join(os.path.dirname(__file__), 'data', file_name)
-                logging.info(f"Retrieve s3 info: {s3_bucket}/{s3_key}")
-                s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
-                
-                logging.info(f"Saving { parameters['date_time'] } carpark availability data to { s3_path }")
-
-                # Saving the data as CSV file directly to S3
-                carpark_data.to_csv(s3_path, index = False)
-                logging.info("Data saved")
-        else:
-                raise ValueError("Error in the API call")
+                # Flatten the nested items -> carpark_data -> carpark_info into rectangular format
+                with metrics.timer('transform', source='carpark'):
+                        carpark_data = flatten_carpark(carpark_data, execution_time)
+        metrics.count('rows', len(carpark_data), source='carpark')
+
+        staging_table = 'staging_carpark_availability'
+        file_prefix = 'carpark'
+        dtypes = PARQUET_DTYPES
+        if state is not None:
+                with metrics.timer('delta', source='carpark'):
+                        carpark_data, values = encode_snapshot(carpark_data, state, previous_ts_nodash(kwargs),
+                                                               execution_time, checkpoint_minutes)
+                metrics.count('delta_rows', len(carpark_data), source='carpark')
+                staging_table = 'staging_carpark_availability_delta'
+                file_prefix = 'carpark_delta'
+                dtypes = DELTA_PARQUET_DTYPES
+
+        if postgres_conn_id is not None:
+                logging.info(f"Copying { parameters['date_time'] } carpark availability data to { postgres_conn_id }")
+                save_to_staging(carpark_data, staging_table, postgres_conn_id)
+                if state is not None:
+                        state.save(kwargs['ts_nodash'], values)
+                return
+
+        logging.info("Prepare to save data...")
+        # Set the filename based on execution date
+        file_name = output_file_name(file_prefix, kwargs['ts_nodash'], output_format, compression)
+        # full_path = os.path.join(os.path.dirname(__file__), 'data', file_name)
+        logging.info(f"Retrieve s3 info: {s3_bucket}/{s3_key}")
+        s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
+        
+        logging.info(f"Saving { parameters['date_time'] } carpark availability data to { s3_path }")
+
+        # Saving the data as CSV or Parquet file directly to S3
+        save_dataframe(carpark_data, s3_path, output_format, dtypes, compression)
+        logging.info("Data saved")
 
+        if state is not None:
+                # The state only moves on once the delta is saved, so a failed run is encoded again from the same state.
+                state.save(kwargs['ts_nodash'], values)
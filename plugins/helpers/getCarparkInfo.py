@@ -1,4 +1,3 @@
-import requests
 import json
 import os
 import pandas as pd
@@ -6,53 +5,85 @@ import logging
 
 from airflow.contrib.hooks.aws_hook import AwsHook
 
+from helpers.ckan import DEFAULT_PAGE_SIZE, fetch_datastore
+from helpers.fingerprint import save_dimension_snapshot
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import output_file_name, save_dataframe
+from helpers.postgres_loader import save_to_staging
+from helpers.transforms import transform_carpark_info
+
+CARPARK_INFO_URL = 'https://data.gov.sg/api/action/datastore_search'
+CARPARK_INFO_RESOURCE_ID = '139a3035-e624-4f56-b63f-89ae28d4ae4c'
+
+# Types of the columns when the data is saved as Parquet.
+PARQUET_DTYPES = {
+        'carpark_latitude': 'float64',
+        'carpark_longitude': 'float64',
+}
+
+@instrumented
 def get_carparkInfo(*args, **kwargs):
         """
         The function calls the API from data.gov.sg to retrieve Carpark Information dataset.
         Then, transform the data into rectangular format before saving it as CSV format.
         Lastly, the CSV file will be saved in the S3 bucket.
         """
-        # Setting up credentials for AWS services
-        aws_hook = AwsHook('aws_credentials_id')
-        credentials = aws_hook.get_credentials()
-        os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
-        os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
+        # Opt-in offline mode loads the data straight into the staging table of a Postgres database, instead of S3.
+        postgres_conn_id = kwargs['params'].get('postgres_conn_id')
+
+        if postgres_conn_id is None:
+                # Setting up credentials for AWS services
+                aws_hook = AwsHook('aws_credentials_id')
+                credentials = aws_hook.get_credentials()
+                os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
+                os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
         
         # Retrieve S3 bucket and S3 key details from the dag config.
-        s3_bucket = kwargs['params']['s3_bucket']
-        s3_key = kwargs['params']['s3_key']
+        s3_bucket = kwargs['params'].get('s3_bucket')
+        s3_key = kwargs['params'].get('s3_key')
+
+        # Opt-in streaming mode parses the response incrementally instead of loading it all in memory.
+        streaming = kwargs['params'].get('streaming', False)
+        # Output format of the file saved in S3, either csv (default) or parquet.
+        output_format = kwargs['params'].get('output_format', 'csv')
+        # Optional compression of the CSV file, either gzip or zstd. Default is no compression.
+        compression = kwargs['params'].get('compression')
+        # Opt-in change detection only uploads the snapshot when its content changed since the previous run.
+        fingerprint = kwargs['params'].get('fingerprint', False)
+
+        # Number of records per call, and number of calls in flight, to retrieve the whole dataset.
+        page_size = kwargs['params'].get('page_size', DEFAULT_PAGE_SIZE)
+        workers = kwargs['params'].get('workers', 5)
 
         logging.info("Connecting to API to query data")
-        carpark_info = requests.get('https://data.gov.sg/api/action/datastore_search?resource_id=139a3035-e624-4f56-b63f-89ae28d4ae4c')
-
-        if carpark_info.status_code == 200:
-                logging.info("Extracting data...")
-                carpark_info_data = carpark_info.json()
-
-                logging.info("Transforming data...")
-                # Take data from results + records
-                carpark_info_data = pd.DataFrame(carpark_info_data['result']['records'])
-                if (carpark_info_data.empty != True):
-                        carpark_info_data = carpark_info_data[['car_park_no', 'address', 'y_coord', 'x_coord']]
-                        carpark_info_data.rename(columns={'car_park_no':'carpark_id',
-                                                        'address':'carpark_location',
-                                                        'y_coord':'carpark_latitude',
-                                                        'x_coord':'carpark_longitude'}, inplace=True)
-
-                        logging.info("Prepare the save data...")
-                        # Set the filename based on execution date
-                        file_name = 'carpark_info_' + kwargs['ts_nodash'] + '.csv'
-                        s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
-
-                        logging.info(f"Saving carpark information data to { s3_path }")
-                        # Saving the data as CSV file directly to S3
-                        carpark_info_data.to_csv(s3_path, index=False)
-
-                        logging.info("Data saved")
-                else:
-                        raise ValueError("There are no data returned")
-        else:
-                raise ValueError("Error in the API call")
+        # Take data from results + records of every page
+        carpark_info_data = fetch_datastore(CARPARK_INFO_URL, CARPARK_INFO_RESOURCE_ID, page_size, workers, streaming)
+
+        logging.info("Transforming data...")
+        metrics = get_metrics()
+        with metrics.timer('transform', source='carpark_info'):
+                carpark_info_data = transform_carpark_info(carpark_info_data)
+        metrics.count('rows', len(carpark_info_data), source='carpark_info')
+        if (carpark_info_data.empty != True):
+                if postgres_conn_id is not None:
+                        logging.info(f"Copying carpark information data to { postgres_conn_id }")
+                        save_to_staging(carpark_info_data, 'staging_carpark_info', postgres_conn_id)
+                        return
+
+                logging.info("Prepare the save data...")
+                if fingerprint:
+                        save_dimension_snapshot(carpark_info_data, 'carpark_info', kwargs['ts_nodash'],
+                                                s3_bucket, s3_key, output_format, PARQUET_DTYPES, compression)
+                        return
 
-                
+                # Set the filename based on execution date
+                file_name = output_file_name('carpark_info', kwargs['ts_nodash'], output_format, compression)
+                s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
 
+                logging.info(f"Saving carpark information data to { s3_path }")
+                # Saving the data as CSV or Parquet file directly to S3
+                save_dataframe(carpark_info_data, s3_path, output_format, PARQUET_DTYPES, compression)
+
+                logging.info("Data saved")
+        else:
+                raise ValueError("There are no data returned")
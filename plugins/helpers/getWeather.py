@@ -1,79 +1,246 @@
-import requests
 import json
 import os
 import pandas as pd
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pandas.io.json import json_normalize
-from airflow.contrib.hooks.aws_hook import AwsHook
 
-def get_weather(*args, **kwargs):
+from helpers.http_client import get_http_client
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import output_file_name, save_dataframe
+from helpers.postgres_loader import save_to_staging
+from helpers.raw_archive import DEFAULT_ARCHIVE_PREFIX, archive_payload, read_archived_payload
+from helpers.streaming import iter_json_items
+from helpers.transforms import flatten_weather, flatten_weather_items
+
+# Types of the columns when the data is saved as Parquet.
+PARQUET_DTYPES = {
+        'timestamp': 'datetime',
+        'value': 'float64',
+}
+
+WEATHER_URL = "https://api.data.gov.sg/v1/environment/{}?"
+
+# Parameters to retrieve different types of dataset from the same API
+WEATHER_DATASETS = {
+        'temperature':'air-temperature',
+        'rainfall':'rainfall',
+        'humidity':'relative-humidity',
+        'wind_direction':'wind-direction',
+        'wind_speed':'wind-speed'
+}
+
+# Datasets staged in Redshift downstream. By default, get_weather_datasets only fails when one of them fails.
+REQUIRED_TABLES = ['temperature', 'rainfall']
+
+# Staging table of the datasets loaded into the warehouse, used when loading straight into Postgres.
+WEATHER_STAGING_TABLES = {
+        'temperature': 'staging_temperature',
+        'rainfall': 'staging_rainfall',
+}
+
+def _request_weather(source, execution_time, streaming=False):
+        """ Call the API of the weather event dataset for the execution time, and return the response """
+        # Create the parameters to be used to draw data from the API for specific date and time.
+        parameters = { 'date_time' : execution_time }
+
+        logging.info(f"Connecting to API to query {source} data...")
+        results = get_http_client().get(WEATHER_URL.format(WEATHER_DATASETS[source]), parameters, stream=streaming)
+        
+        logging.info(f"Data for { execution_time }")
+        if results.status_code != 200:
+                raise ValueError("Error in the API call")
+        return results
+
+def parse_weather(source, body):
         """
-        The function calls the API from data.gov.sg to retrieve weather event dataset.
-        Then, transform the data into rectangular format before saving it as CSV format.
-        Lastly, the CSV file will be saved in the S3 bucket.
+        The function parses the body of a weather event response, and transforms the data into rectangular format.
+
+        Args:
+                source: The name of the dataset, one of the keys of WEATHER_DATASETS.
+                body: The bytes of the response body, from the API or the raw archive.
+        """
+        metrics = get_metrics()
+        logging.info("Extracting data...")
+        with metrics.timer('parse', source=source):
+                json_data = json.loads(body)
+
+        logging.info("Transforming data...")
+        # Flatten the nested items -> readings into rectangular format
+        with metrics.timer('transform', source=source):
+                weather_data = flatten_weather(json_data)
+        metrics.count('rows', len(weather_data), source=source)
+        return weather_data
+
+def fetch_weather(source, execution_time, streaming=False):
+        """
+        The function calls the API from data.gov.sg to retrieve one weather event dataset,
+        and transforms the data into rectangular format.
+
+        Args:
+                source: The name of the dataset, one of the keys of WEATHER_DATASETS.
+                execution_time: The execution time in '%Y-%m-%dT%H:%M:%S' format.
+                streaming: Parse the response incrementally instead of loading it all in memory.
+        """
+        results = _request_weather(source, execution_time, streaming)
+        if not streaming:
+                return parse_weather(source, results.content)
+
+        metrics = get_metrics()
+        logging.info("Extracting and transforming data while streaming...")
+        # The body is read from the socket while it is transformed, so both are timed together.
+        with metrics.timer('transform', source=source):
+                weather_data = flatten_weather_items(iter_json_items(results, 'items.item'))
+        metrics.count('rows', len(weather_data), source=source)
+        return weather_data
+
+def load_weather(source, ts_nodash, s3_bucket, s3_key, streaming=False, output_format='csv', compression=None,
+                postgres_conn_id=None, raw_archive=None, replay=False):
+        """
+        The function retrieves one weather event dataset for the execution time,
+        and saves it in the S3 bucket as CSV (default), optionally compressed, or Parquet format.
+        With postgres_conn_id, it is loaded straight into its staging table of that Postgres database instead,
+        and the datasets without a staging table are skipped.
+
+        With raw_archive, the response is kept in that folder of the raw archive of the bucket, and the run is skipped
+        when its payload is identical to the previous run. With replay, the archived payload is transformed again
+        instead of calling the API. See helpers/raw_archive.py.
         """
-        # Parameters to retrieve different types of dataset from the same API
-        settings = {
-                'temperature':'air-temperature',
-                'rainfall':'rainfall',
-                'humidity':'relative-humidity',
-                'wind_direction':'wind-direction',
-                'wind_speed':'wind-speed'
-        }
-
-        # Setting up credentials for AWS services
+        if postgres_conn_id is not None and source not in WEATHER_STAGING_TABLES:
+                logging.info(f"No staging table for {source}, skipping it")
+                return
+
+        # Extract the execution time, and convert it into the right format, and save it as string format.
+        execution_time = datetime.strftime(datetime.strptime(ts_nodash, '%Y%m%dT%H%M%S'), '%Y-%m-%dT%H:%M:%S')
+
+        if replay:
+                logging.info(f"Reading the archived {source} payload of { execution_time }...")
+                json_data = parse_weather(source, read_archived_payload(source, ts_nodash, s3_bucket,
+                                                                        raw_archive or DEFAULT_ARCHIVE_PREFIX))
+        elif raw_archive is not None:
+                # The archive needs the whole body, so the response is not streamed when it is kept.
+                body = _request_weather(source, execution_time).content
+                record = archive_payload(body, source, ts_nodash, s3_bucket, raw_archive)
+                if record['unchanged']:
+                        logging.info(f"The {source} payload is identical to the previous run, skipping the transform and upload")
+                        return
+                json_data = parse_weather(source, body)
+        else:
+                json_data = fetch_weather(source, execution_time, streaming)
+
+        if postgres_conn_id is not None:
+                logging.info(f"Copying { execution_time } {source} data to { postgres_conn_id }")
+                save_to_staging(json_data, WEATHER_STAGING_TABLES[source], postgres_conn_id)
+                return
+
+        logging.info("Prepare to save data...")
+        if json_data.empty:
+                logging.info(f"There are no {source} readings for { execution_time }")
+        else:
+                logging.info(f"The date_time: {json_data['timestamp'][0]}")
+        # Set the filename based on execution date
+        file_name = output_file_name(source, ts_nodash, output_format, compression)
+        logging.info(f"Retrieve s3 info: {s3_bucket}/{s3_key}")
+        s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
+        
+        logging.info(f"Saving { execution_time } {source} data to { s3_path }")
+
+        # Saving the data as CSV or Parquet file directly to S3
+        save_dataframe(json_data, s3_path, output_format, PARQUET_DTYPES, compression)
+        logging.info("Data saved")
+
+def _set_aws_credentials():
+        """ Setting up credentials for AWS services, used by s3fs to save the files """
+        from airflow.contrib.hooks.aws_hook import AwsHook
         aws_hook = AwsHook('aws_credentials_id')
         credentials = aws_hook.get_credentials() 
         os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
         os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
 
+@instrumented
+def get_weather(*args, **kwargs):
+        """
+        The function calls the API from data.gov.sg to retrieve weather event dataset.
+        Then, transform the data into rectangular format before saving it as CSV format.
+        Lastly, the CSV file will be saved in the S3 bucket.
+        """
+        # Opt-in offline mode loads the data straight into the staging table of a Postgres database, instead of S3.
+        postgres_conn_id = kwargs['params'].get('postgres_conn_id')
+        if postgres_conn_id is None:
+                _set_aws_credentials()
+
         # Retrieve S3 bucket and S3 key details from the dag config.
-        s3_bucket = kwargs['params']['s3_bucket']
-        s3_key = kwargs['params']['s3_key']
+        s3_bucket = kwargs['params'].get('s3_bucket')
+        s3_key = kwargs['params'].get('s3_key')
 
-        # Prepare parameters
-        source = kwargs["params"]["table"]
-        # Extract the execution time, and convert it into the right format, and save it as string format.
-        execution_time = datetime.strftime(datetime.strptime(kwargs['ts_nodash'], '%Y%m%dT%H%M%S'), '%Y-%m-%dT%H:%M:%S')
-        # Create the parameters to be used to draw data from the API for specific date and time.
-        parameters = { 'date_time' : execution_time }
+        # Opt-in streaming mode parses the response incrementally instead of loading it all in memory.
+        streaming = kwargs['params'].get('streaming', False)
+        # Output format of the file saved in S3, either csv (default) or parquet.
+        output_format = kwargs['params'].get('output_format', 'csv')
+        # Optional compression of the CSV file, either gzip or zstd. Default is no compression.
+        compression = kwargs['params'].get('compression')
 
-        logging.info("Connecting to API to query data...")
-        results = requests.get(f"https://api.data.gov.sg/v1/environment/{settings[source]}?", parameters)
-        
-        logging.info(f"Data for { execution_time }")
+        # Opt-in raw archive of the responses, and replay of the archived payloads. See helpers/raw_archive.py.
+        raw_archive = kwargs['params'].get('raw_archive')
+        replay = kwargs['params'].get('replay', False)
 
-        if results.status_code == 200:
-                logging.info("Extracting data...")
-                json_data = results.json()
-
-                logging.info("Transforming data...")
-                # Take data from the items key
-                json_data = pd.DataFrame(json_data['items'])
-                # Expand nested columns into multiple rows.
-                json_data = pd.DataFrame([(tup.timestamp, d) for tup in json_data.itertuples() for d in tup.readings])
-                # Rename the columns
-                json_data.rename(columns={0:'timestamp', 1:'readings'}, inplace=True)
-                # Expand nested columns into multiple columns.
-                json_data = pd.concat([pd.to_datetime(json_data['timestamp']), json_normalize(json_data['readings'])], axis=1)
-                # Format the timestamp column
-                json_data['timestamp'] = [x.strftime("%Y-%m-%d %H:%M:%S") for x in json_data['timestamp']]
-                
-                logging.info("Prepare to save data...")
-                logging.info(f"The date_time: {json_data['timestamp'][0]}")
-                # Set the filename based on execution date
-                file_name = source + '_' + kwargs['ts_nodash'] + '.csv'
-                # full_path = os.path.join(os.path.dirname(__file__), 'data', file_name)
-                logging.info(f"Retrieve s3 info: {s3_bucket}/{s3_key}")
-                s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
-                
-                logging.info(f"Saving { parameters['date_time'] } {source} data to { s3_path }")
-
-                # Saving the data as CSV file directly to S3
-                json_data.to_csv(s3_path, index = False)
-                logging.info("Data saved")
-        else:
-                raise ValueError("Error in the API call")
+        load_weather(kwargs["params"]["table"], kwargs['ts_nodash'], s3_bucket, s3_key, streaming, output_format, compression,
+                        postgres_conn_id, raw_archive, replay)
+
+def _try_load_weather(table, load_args):
+        """ Run load_weather for the table, and return the exception it raised, if any, so the other tables still finish """
+        try:
+                load_weather(table, *load_args)
+        except Exception as e:
+                return e
+        return None
+
+@instrumented
+def get_weather_datasets(*args, **kwargs):
+        """
+        The function retrieves several weather event datasets concurrently in a single task,
+        and saves one file per dataset in the S3 bucket, the same as get_weather does for each of them.
+        The total time is close to the slowest single call, rather than the sum of all of them.
+
+        The datasets are set by 'tables' in the params, and default to all the WEATHER_DATASETS.
+        The task only fails when one of the 'required_tables' fails, by default the REQUIRED_TABLES staged in Redshift.
+        The failures of the datasets only kept in S3 are logged, so they do not hold back the loads of the others.
+        """
+        postgres_conn_id = kwargs['params'].get('postgres_conn_id')
+        if postgres_conn_id is None:
+                _set_aws_credentials()
+
+        # Retrieve S3 bucket and S3 key details from the dag config.
+        s3_bucket = kwargs['params'].get('s3_bucket')
+        s3_key = kwargs['params'].get('s3_key')
+        tables = kwargs['params'].get('tables', list(WEATHER_DATASETS))
+        streaming = kwargs['params'].get('streaming', False)
+        output_format = kwargs['params'].get('output_format', 'csv')
+        compression = kwargs['params'].get('compression')
+        required_tables = kwargs['params'].get('required_tables', [table for table in tables if table in REQUIRED_TABLES])
+        raw_archive = kwargs['params'].get('raw_archive')
+        replay = kwargs['params'].get('replay', False)
+
+        unknown = [table for table in tables if table not in WEATHER_DATASETS]
+        if unknown:
+                raise ValueError(f"Unknown weather datasets: {unknown}")
+
+        logging.info(f"Retrieving {tables} concurrently")
+        load_args = (kwargs['ts_nodash'], s3_bucket, s3_key, streaming, output_format, compression, postgres_conn_id,
+                     raw_archive, replay)
+        with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+                # map returns the results in the order of the tables, whatever order they finish in.
+                results = list(executor.map(_try_load_weather, tables, [load_args] * len(tables)))
 
+        failed = []
+        for table, result in zip(tables, results):
+                if result is None:
+                        continue
+                if table in required_tables:
+                        logging.error(f"Failed to retrieve {table}: {result!r}")
+                        failed.append(table)
+                else:
+                        logging.warning(f"Failed to retrieve {table}, which is not required: {result!r}")
+        if failed:
+                raise ValueError(f"Error in the API call for {failed}")
@@ -1,13 +1,26 @@
-import requests
 import json
 import os
 import pandas as pd
 import logging
 
 from datetime import datetime
-from pandas.io.json import json_normalize
 from airflow.contrib.hooks.aws_hook import AwsHook
 
+from helpers.fingerprint import save_dimension_snapshot
+from helpers.http_client import get_http_client
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import output_file_name, save_dataframe
+from helpers.postgres_loader import save_to_staging
+from helpers.streaming import iter_json_items
+from helpers.transforms import flatten_weather_stations
+
+# Types of the columns when the data is saved as Parquet.
+PARQUET_DTYPES = {
+        'station_latitude': 'float64',
+        'station_longitude': 'float64',
+}
+
+@instrumented
 def get_weatherStationInfo(*args, **kwargs):
         """
         The function calls the API from data.gov.sg to retrieve Weather Stations Information dataset.
@@ -16,45 +29,77 @@ def get_weatherStationInfo(*args, **kwargs):
         """
         logging.info("Connecting to API to query data...")
         
-        # Setting up credentials for AWS services
-        aws_hook = AwsHook('aws_credentials_id')
-        credentials = aws_hook.get_credentials() 
-        os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
-        os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
+        # Opt-in offline mode loads the data straight into the staging table of a Postgres database, instead of S3.
+        postgres_conn_id = kwargs['params'].get('postgres_conn_id')
+
+        if postgres_conn_id is None:
+                # Setting up credentials for AWS services
+                aws_hook = AwsHook('aws_credentials_id')
+                credentials = aws_hook.get_credentials() 
+                os.environ['AWS_ACCESS_KEY_ID'] = credentials.access_key
+                os.environ['AWS_SECRET_ACCESS_KEY'] = credentials.secret_key
         
         # Retrieve S3 bucket and S3 key details from the dag config.
-        s3_bucket = kwargs['params']['s3_bucket']
-        s3_key = kwargs['params']['s3_key']
+        s3_bucket = kwargs['params'].get('s3_bucket')
+        s3_key = kwargs['params'].get('s3_key')
 
         # Extract the execution time, and convert it into the right format, and save it as string format.
         execution_time = datetime.strftime(datetime.strptime(kwargs['ts_nodash'], '%Y%m%dT%H%M%S'), '%Y-%m-%dT%H:%M:%S')
+        # A monthly DAG runs at the end of its interval, a month after its execution time,
+        # so it asks for the stations reporting at the end of the interval instead.
+        if kwargs['params'].get('end_of_interval', False):
+                execution_time = datetime.strftime(kwargs['next_execution_date'], '%Y-%m-%dT%H:%M:%S')
         # Create the parameters to be used to draw data from the API for specific date and time.
         parameters = { 'date_time' : execution_time }
 
-        results = requests.get("https://api.data.gov.sg/v1/environment/relative-humidity?", parameters)
+        # Opt-in streaming mode parses the response incrementally instead of loading it all in memory.
+        streaming = kwargs['params'].get('streaming', False)
+        # Output format of the file saved in S3, either csv (default) or parquet.
+        output_format = kwargs['params'].get('output_format', 'csv')
+        # Optional compression of the CSV file, either gzip or zstd. Default is no compression.
+        compression = kwargs['params'].get('compression')
+        # Opt-in change detection only uploads the snapshot when its content changed since the previous run.
+        fingerprint = kwargs['params'].get('fingerprint', False)
+
+        results = get_http_client().get("https://api.data.gov.sg/v1/environment/relative-humidity?", parameters, stream=streaming)
 
         if results.status_code == 200:
                 logging.info("Extracting data...")
-                json_data = results.json()
+                metrics = get_metrics()
+                if streaming:
+                        # The stations are flattened while they are parsed, without a list of them,
+                        # so the parse is timed with the transform.
+                        stations = iter_json_items(results, 'metadata.stations.item')
+                else:
+                        with metrics.timer('parse', source='weather_stations'):
+                                stations = results.json()['metadata']['stations']
 
                 logging.info("Transforming data...")
-                # Take data from the metadata + stations key
-                weather_stations = pd.DataFrame(json_data['metadata']['stations'])
-                # Expand nested column - location, and combine with other columns
-                weather_stations_info = pd.concat([weather_stations.id, weather_stations.name, json_normalize(weather_stations.location)], axis=1)
-                # Rename the columns with appropriate names
-                weather_stations_info.rename(columns={'id':'station_id', 'name':'station_location', 'latitude':'station_latitude', 'longitude':'station_longitude'}, inplace=True)
+                # Expand the nested location of the metadata + stations key into rectangular format
+                with metrics.timer('transform', source='weather_stations'):
+                        weather_stations_info = flatten_weather_stations(stations)
+                metrics.count('rows', len(weather_stations_info), source='weather_stations')
+
+                if postgres_conn_id is not None:
+                        logging.info(f"Copying weather stations information data to { postgres_conn_id }")
+                        save_to_staging(weather_stations_info, 'staging_weather_station_info', postgres_conn_id)
+                        return
 
                 logging.info("Prepare to save data...")
+                if fingerprint:
+                        save_dimension_snapshot(weather_stations_info, 'weather_stations_info', kwargs['ts_nodash'],
+                                                s3_bucket, s3_key, output_format, PARQUET_DTYPES, compression)
+                        return
+
                 # Set the filename based on execution date
-                file_name = 'weather_stations_info_' + kwargs['ts_nodash'] + '.csv'
+                file_name = output_file_name('weather_stations_info', kwargs['ts_nodash'], output_format, compression)
                 logging.info(f"Retrieve s3 info: {s3_bucket}/{s3_key}")
                 
                 s3_path = "s3a://{}/{}/{}".format(s3_bucket, s3_key, file_name)
                 logging.info(f"Saving { parameters['date_time'] } weather stations information data to { s3_path }")
 
-                # Saving the data as CSV file directly to S3
-                weather_stations_info.to_csv(s3_path, index = False)
+                # Saving the data as CSV or Parquet file directly to S3
+                save_dataframe(weather_stations_info, s3_path, output_format, PARQUET_DTYPES, compression)
                 logging.info("Data saved")
         else:
                 raise ValueError("Error in the API call")
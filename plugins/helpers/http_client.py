@@ -0,0 +1,168 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from helpers.metrics import get_metrics
+
+# Status codes that are worth retrying: rate limited, or a transient error on the server.
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+class HttpClient:
+        """
+        HTTP client shared by the data.gov.sg helpers.
+
+        It keeps a pool of keep-alive connections per host, so consecutive calls reuse the TLS connection.
+        Every call has a connect and read timeout, and is retried with jittered exponential backoff
+        on connection errors, 429 and 5xx responses. The number of calls in flight to the same host
+        is limited, so concurrent fetches do not overwhelm the API.
+
+        Args:
+                pool_size: The number of keep-alive connections kept per host.
+                connect_timeout: Seconds to wait for the connection to be established.
+                read_timeout: Seconds to wait for the server to send data.
+                max_retries: The number of retries after the first attempt.
+                backoff_factor: The base of the exponential backoff in seconds, i.e. backoff_factor * 2 ** attempt.
+                max_backoff: The maximum seconds to wait between retries.
+                max_per_host: The maximum number of calls in flight to the same host.
+                        Default is 5, so all the weather datasets can be fetched at the same time.
+        """
+        def __init__(self,
+                        pool_size=10,
+                        connect_timeout=5,
+                        read_timeout=30,
+                        max_retries=5,
+                        backoff_factor=0.5,
+                        max_backoff=30,
+                        max_per_host=5):
+                self.timeout = (connect_timeout, read_timeout)
+                self.max_retries = max_retries
+                self.backoff_factor = backoff_factor
+                self.max_backoff = max_backoff
+                self.max_per_host = max_per_host
+
+                self.session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                self.session.mount('http://', adapter)
+                self.session.mount('https://', adapter)
+
+                self._host_limits = {}
+                self._lock = threading.Lock()
+
+        def _host_limit(self, url):
+                """ Return the semaphore limiting the calls in flight to the host of the url """
+                host = urlparse(url).netloc
+                with self._lock:
+                        if host not in self._host_limits:
+                                self._host_limits[host] = threading.BoundedSemaphore(self.max_per_host)
+                        return self._host_limits[host]
+
+        def _backoff(self, attempt, response=None):
+                """ Seconds to wait before the next attempt, honouring Retry-After when the server sends one """
+                if response is not None and response.headers.get('Retry-After', '').isdigit():
+                        return min(float(response.headers['Retry-After']), self.max_backoff)
+                # Full jitter, so concurrent retries do not hit the API at the same time.
+                return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+        def get(self, url, params=None, stream=False):
+                """
+                Send a GET request, retrying on connection errors, 429 and 5xx responses.
+
+                Returns the response of the last attempt, so the caller can check the status code as before.
+                Raises the connection error if the last attempt could not connect at all.
+
+                A streamed response keeps its slot of the host until it is closed, so the limit also covers the
+                transfer of the body, e.g. `iter_json_items` closes it once the body is parsed.
+
+                The time of the call, its retries and the bytes of the body are recorded in the metrics of the task,
+                tagged with the last part of the url path, e.g. carpark-availability. The bytes of a streamed body
+                are only known once it is read, see `iter_json_items`.
+                """
+                metrics = get_metrics()
+                endpoint = endpoint_name(url)
+                with metrics.timer('fetch', endpoint=endpoint):
+                        response = self._get(url, params, stream)
+                if not stream:
+                        metrics.count('http_bytes', len(response.content), endpoint=endpoint)
+                return response
+
+        def _get(self, url, params=None, stream=False):
+                """ Send the GET request with the retries of `get` """
+                host_limit = self._host_limit(url)
+                attempt = 0
+                while True:
+                        try:
+                                response = self._send(url, params, stream, host_limit)
+                        except (requests.ConnectionError, requests.Timeout) as e:
+                                if attempt >= self.max_retries:
+                                        raise
+                                wait = self._backoff(attempt)
+                                logging.warning(f"Request to {url} failed with {e!r}, retrying in {wait:.1f}s")
+                        else:
+                                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                                        return response
+                                wait = self._backoff(attempt, response)
+                                logging.warning(f"Request to {url} returned {response.status_code}, retrying in {wait:.1f}s")
+                                # Release the connection back to the pool before waiting.
+                                response.close()
+                        attempt += 1
+                        get_metrics().count('http_retries', endpoint=endpoint_name(url))
+                        time.sleep(wait)
+
+        def _send(self, url, params, stream, host_limit):
+                """ Send one request within the limit of calls in flight to the host """
+                host_limit.acquire()
+                try:
+                        response = self.session.get(url, params=params, stream=stream, timeout=self.timeout)
+                except BaseException:
+                        host_limit.release()
+                        raise
+                if not stream:
+                        host_limit.release()
+                elif response.status_code != 200:
+                        # The body of an error is small, it is read now, so the caller can raise without closing it.
+                        response.content
+                        response.close()
+                        host_limit.release()
+                else:
+                        _release_on_close(response, host_limit)
+                return response
+
+
+def _release_on_close(response, host_limit):
+        """ Release the slot of the host once the streamed response is closed, only once however often it is closed """
+        close = response.close
+        released = []
+
+        def close_and_release():
+                try:
+                        close()
+                finally:
+                        if not released:
+                                released.append(True)
+                                host_limit.release()
+
+        response.close = close_and_release
+
+
+def endpoint_name(url):
+        """ Return the last part of the url path, e.g. air-temperature for the air temperature API """
+        return urlparse(url).path.rstrip('/').rsplit('/', 1)[-1] or urlparse(url).netloc
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+        """ Return the HttpClient shared by all the helpers in this process """
+        global _client
+        with _client_lock:
+                if _client is None:
+                        _client = HttpClient()
+                return _client
@@ -0,0 +1,244 @@
+import functools
+import json
+import logging
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Types of the metrics, with their StatsD suffix.
+TIMER = 'ms'
+COUNTER = 'c'
+GAUGE = 'g'
+
+
+def metric_key(name, tags):
+        """
+        Return the flat name of the metric, its tag values followed by its name,
+        e.g. staging_temperature.copy_ms for the copy_ms timer of the staging_temperature table.
+        """
+        return ".".join([str(value) for value in tags.values()] + [name])
+
+
+class StatsdSink:
+        """
+        Sends every metric to a StatsD compatible server over UDP, e.g. statsd_exporter or the Datadog agent,
+        as <prefix>.<dag_id>.<task_id>.<key>:<value>|<type>. UDP never blocks the task, and a lost packet
+        only loses that metric.
+
+        Args:
+                host: The host of the StatsD server.
+                port: The UDP port of the StatsD server. Default is 8125
+                prefix: The prefix of every metric name. Default is carpark_sg
+        """
+        def __init__(self, host='localhost', port=8125, prefix='carpark_sg'):
+                self.address = (host, int(port))
+                self.prefix = prefix
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        def emit(self, metric):
+                name = ".".join(part for part in (self.prefix, metric['dag_id'], metric['task_id'], metric['key']) if part)
+                try:
+                        self._socket.sendto(f"{name}:{metric['value']}|{metric['type']}".encode('utf-8'), self.address)
+                except OSError as e:
+                        logging.warning(f"Could not send {name} to StatsD: {e!r}")
+
+        def close(self):
+                self._socket.close()
+
+
+class JsonLinesSink:
+        """
+        Appends every metric as one json line to a local file, e.g. in the airflow logs folder.
+        Each line is written in one call, so the tasks running at the same time can share the file.
+
+        Args:
+                path: The path of the file.
+        """
+        def __init__(self, path):
+                self.path = path
+                self._lock = threading.Lock()
+
+        def emit(self, metric):
+                line = json.dumps(metric, default=str) + "\n"
+                with self._lock:
+                        with open(self.path, 'a') as f:
+                                f.write(line)
+
+        def close(self):
+                pass
+
+
+class XComSink:
+        """
+        Adds up the metrics of the task, and pushes them as one dict to XCom when the task ends,
+        so they are shown with the task instance in the Airflow UI. The timers and counters are summed,
+        and the last value of each gauge is kept.
+
+        Args:
+                task_instance: The task instance of the context, i.e. context['ti'].
+                key: The XCom key. Default is metrics
+        """
+        def __init__(self, task_instance, key='metrics'):
+                self.task_instance = task_instance
+                self.key = key
+                self.summary = OrderedDict()
+                self._lock = threading.Lock()
+
+        def emit(self, metric):
+                with self._lock:
+                        if metric['type'] == GAUGE:
+                                self.summary[metric['key']] = metric['value']
+                        else:
+                                self.summary[metric['key']] = self.summary.get(metric['key'], 0) + metric['value']
+
+        def close(self):
+                self.task_instance.xcom_push(key=self.key, value=dict(self.summary))
+
+
+class LoggingSink:
+        """ Logs every metric, so the durations and sizes are in the task log next to the other lines """
+        def emit(self, metric):
+                logging.info(f"Metric {metric['key']}: {metric['value']}{' ms' if metric['type'] == TIMER else ''}")
+
+        def close(self):
+                pass
+
+
+class Metrics:
+        """
+        Records the timers, counters and gauges of a task, and sends each of them to every sink.
+        Without sinks, nothing is recorded, so the instrumented code costs close to nothing.
+
+        Args:
+                sinks: The list of sinks, see StatsdSink, JsonLinesSink, XComSink and LoggingSink.
+                dag_id: The dag of the task, added to every metric.
+                task_id: The task, added to every metric.
+        """
+        def __init__(self, sinks=None, dag_id=None, task_id=None):
+                self.sinks = sinks or []
+                self.dag_id = dag_id
+                self.task_id = task_id
+
+        @property
+        def enabled(self):
+                return bool(self.sinks)
+
+        def emit(self, name, value, kind, **tags):
+                """ Send the metric to every sink. The tags are kept in the order they are given """
+                if not self.sinks:
+                        return
+                metric = {
+                        'time': datetime.utcnow().isoformat(),
+                        'dag_id': self.dag_id,
+                        'task_id': self.task_id,
+                        'key': metric_key(name, tags),
+                        'name': name,
+                        'value': value,
+                        'type': kind,
+                        'tags': tags,
+                }
+                for sink in self.sinks:
+                        try:
+                                sink.emit(metric)
+                        except Exception as e:
+                                # A broken sink must not fail the task.
+                                logging.warning(f"Could not record {metric['key']} in {type(sink).__name__}: {e!r}")
+
+        def count(self, name, value=1, **tags):
+                self.emit(name, value, COUNTER, **tags)
+
+        def gauge(self, name, value, **tags):
+                self.emit(name, value, GAUGE, **tags)
+
+        @contextmanager
+        def timer(self, stage, **tags):
+                """
+                Time the block as the <stage>_ms timer, e.g. with metrics.timer('copy', table=table): ...
+                The timer is recorded even when the block raises, so the slow failures are measured too.
+                """
+                started = time.perf_counter()
+                try:
+                        yield
+                finally:
+                        self.emit(f"{stage}_ms", round((time.perf_counter() - started) * 1000, 3), TIMER, **tags)
+
+        def close(self):
+                for sink in self.sinks:
+                        try:
+                                sink.close()
+                        except Exception as e:
+                                logging.warning(f"Could not close {type(sink).__name__}: {e!r}")
+
+
+# The metrics of the running task, shared by every helper and thread of the task. See `task_metrics`.
+_metrics = Metrics()
+
+
+def get_metrics():
+        """ Return the metrics of the running task, which record nothing outside of `task_metrics` """
+        return _metrics
+
+
+def metrics_from_context(context):
+        """
+        The function builds the Metrics of a task from the 'metrics' of its params, e.g. set for every task
+        in the params of the DAG:
+
+                'metrics': {'statsd': 'localhost:8125', 'jsonl': '/usr/local/airflow/logs/metrics.jsonl', 'xcom': True}
+
+        statsd is the host:port of a StatsD server, jsonl the path of a json lines file and xcom pushes
+        the metrics of the task to XCom. 'log': True also logs every metric. Without 'metrics', nothing is recorded.
+
+        Args:
+                context: The Airflow context of the task, i.e. the kwargs of a PythonOperator or the context of an operator.
+        """
+        config = (context.get('params') or {}).get('metrics') or {}
+        sinks = []
+        if config.get('statsd'):
+                host, _, port = config['statsd'].partition(':')
+                sinks.append(StatsdSink(host, port or 8125, config.get('statsd_prefix', 'carpark_sg')))
+        if config.get('jsonl'):
+                sinks.append(JsonLinesSink(config['jsonl']))
+        if config.get('xcom') and context.get('ti') is not None:
+                sinks.append(XComSink(context['ti']))
+        if config.get('log'):
+                sinks.append(LoggingSink())
+
+        task = context.get('task')
+        return Metrics(sinks,
+                       dag_id=getattr(task, 'dag_id', None),
+                       task_id=getattr(task, 'task_id', None))
+
+
+@contextmanager
+def task_metrics(context):
+        """
+        Make the metrics of the task, built from its context, the ones returned by `get_metrics`
+        while the block runs, and time the whole block as the task_ms timer.
+        """
+        global _metrics
+        previous = _metrics
+        _metrics = metrics_from_context(context)
+        try:
+                with _metrics.timer('task'):
+                        yield _metrics
+        finally:
+                _metrics.close()
+                _metrics = previous
+
+
+def instrumented(function):
+        """
+        Decorator recording the metrics of a PythonOperator callable, or of the execute method of an operator,
+        with `task_metrics`. The context is the kwargs of the callable, or the last argument of execute.
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+                context = kwargs if 'params' in kwargs or not args else args[-1]
+                with task_metrics(context):
+                        return function(*args, **kwargs)
+        return wrapper
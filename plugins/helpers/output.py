@@ -0,0 +1,148 @@
+import gzip
+import io
+import logging
+import re
+
+import pandas as pd
+import s3fs
+
+from helpers.metrics import get_metrics
+
+# File extension for each supported output format.
+FILE_EXTENSIONS = {
+        'csv': 'csv',
+        'parquet': 'parquet',
+}
+
+# File extension added for each supported compression of the CSV files.
+COMPRESSION_EXTENSIONS = {
+        'gzip': 'gz',
+        'zstd': 'zst',
+}
+
+
+def to_typed(data, dtypes):
+        """
+        The function casts the columns of the DataFrame to the given types, so they are stored typed in Parquet
+        instead of the text in the json payload. Columns with the 'datetime' type are parsed into timestamps,
+        so that Redshift does not need to parse them again from strings. Columns that are not in the DataFrame are ignored.
+
+        Args:
+                data: The DataFrame to cast.
+                dtypes: A dict of column name to type, e.g. {'timestamp': 'datetime', 'lots_available': 'Int32'}.
+        """
+        data = data.copy()
+        for column, dtype in dtypes.items():
+                if column not in data.columns:
+                        continue
+                if dtype == 'datetime':
+                        data[column] = pd.to_datetime(data[column])
+                elif dtype in ('Int32', 'Int64'):
+                        # Nullable integers, the readings without a value are kept as nulls.
+                        data[column] = pd.to_numeric(data[column]).astype(dtype)
+                else:
+                        data[column] = data[column].astype(dtype)
+        return data
+
+
+def _compressed_writer(raw, compression):
+        """ Wrap the binary file object with a streaming compressor for the compression """
+        if compression == 'gzip':
+                # Level 6, as the gzip command line, is much faster than the default 9 for almost the same size.
+                return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+        if compression == 'zstd':
+                # zstandard is only needed when the zstd compression is used.
+                import zstandard
+                return zstandard.ZstdCompressor().stream_writer(raw)
+        raise ValueError(f"Unknown compression: {compression}")
+
+
+def save_compressed_csv(data, s3_path, compression):
+        """
+        The function saves the DataFrame as a compressed CSV file to the S3 path.
+
+        The CSV is compressed while it is written, and s3fs uploads the compressed output
+        in parts of a few MB as a multipart upload, so the full file is never built in memory.
+
+        Args:
+                data: The DataFrame to save.
+                s3_path: The full path of the file, e.g. s3a://bucket/key/file.csv.gz
+                compression: Either 'gzip' or 'zstd'.
+        """
+        fs = s3fs.S3FileSystem()
+        with fs.open(s3_path.split('://', 1)[-1], 'wb') as raw:
+                with _compressed_writer(raw, compression) as compressed:
+                        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+                        data.to_csv(text, index=False)
+                        text.flush()
+                        text.detach()
+
+
+def save_dataframe(data, s3_path, output_format='csv', dtypes=None, compression=None):
+        """
+        The function saves the DataFrame to the S3 path in the given output format.
+
+        CSV is the default, and writes the DataFrame as it is, optionally compressed with gzip or zstd.
+        Parquet casts the columns with `dtypes` and writes a typed, snappy compressed file.
+
+        Args:
+                data: The DataFrame to save.
+                s3_path: The full path of the file, e.g. s3a://bucket/key/file.csv
+                output_format: Either 'csv' or 'parquet'.
+                dtypes: The types of the columns for Parquet. See `to_typed`.
+                compression: None (default), 'gzip' or 'zstd' to compress the CSV file. See `save_compressed_csv`.
+        """
+        if compression is not None and output_format != 'csv':
+                raise ValueError(f"Compression is only supported for csv, {output_format} files are compressed internally")
+        if output_format not in FILE_EXTENSIONS:
+                raise ValueError(f"Unknown output format: {output_format}")
+
+        metrics = get_metrics()
+        dataset = file_prefix(s3_path)
+        with metrics.timer('upload', dataset=dataset, format=output_format):
+                if output_format == 'csv':
+                        if compression is None:
+                                data.to_csv(s3_path, index=False)
+                        else:
+                                save_compressed_csv(data, s3_path, compression)
+                else:
+                        data = to_typed(data, dtypes or {})
+                        # Redshift reads Parquet timestamps in micro seconds, not the nano seconds used by pandas.
+                        data.to_parquet(s3_path, engine='pyarrow', compression='snappy', index=False,
+                                        coerce_timestamps='us', allow_truncated_timestamps=True)
+        metrics.count('rows_uploaded', len(data), dataset=dataset, format=output_format)
+        if metrics.enabled:
+                # The size of the object costs one more request to S3, so it is only read when the metrics are recorded.
+                # The file is already saved, so a failed lookup only loses the metric.
+                try:
+                        size = s3fs.S3FileSystem().size(s3_path.split('://', 1)[-1])
+                except Exception as e:
+                        logging.warning(f"Could not read the size of {s3_path} for the metrics: {e!r}")
+                else:
+                        metrics.count('s3_bytes', size, dataset=dataset, format=output_format)
+        logging.info(f"Saved {len(data)} rows as {output_format}" + (f" compressed with {compression}" if compression else ""))
+
+
+def output_file_name(prefix, ts_nodash, output_format='csv', compression=None):
+        """
+        The function returns the file name based on execution date, output format and compression,
+        e.g. carpark_20190809T100000.csv or carpark_20190809T100000.csv.gz
+        """
+        if output_format not in FILE_EXTENSIONS:
+                raise ValueError(f"Unknown output format: {output_format}")
+        if compression is not None and compression not in COMPRESSION_EXTENSIONS:
+                raise ValueError(f"Unknown compression: {compression}")
+        file_name = prefix + '_' + ts_nodash + '.' + FILE_EXTENSIONS[output_format]
+        if compression is not None:
+                file_name += '.' + COMPRESSION_EXTENSIONS[compression]
+        return file_name
+
+
+def file_prefix(s3_path):
+        """
+        The function returns the prefix of a file named by `output_file_name` or by the backfill, e.g. carpark
+        for s3a://bucket/key/carpark_20190809T100000.csv.gz, or the whole file name for other names.
+        """
+        file_name = s3_path.rsplit('/', 1)[-1]
+        match = re.match(r'(.+?)_\d{8}T\d{6}[_.]', file_name)
+        return match.group(1) if match else file_name
@@ -0,0 +1,107 @@
+import io
+import logging
+
+from helpers.metrics import get_metrics
+from helpers.sql_queries import SqlQueries
+
+# Columns of each staging table, and the column of the helper's DataFrame each of them is loaded from.
+STAGING_COLUMNS = {
+        'staging_temperature': [
+                ('timestamp', 'date_time'),
+                ('station_id', 'station_id'),
+                ('value', 'temperature'),
+        ],
+        'staging_rainfall': [
+                ('timestamp', 'date_time'),
+                ('station_id', 'station_id'),
+                ('value', 'rainfall'),
+        ],
+        'staging_carpark_availability': [
+                ('timestamp', 'date_time'),
+                ('carpark_number', 'carpark_id'),
+                ('lot_type', 'lot_type'),
+                ('lots_available', 'lots_available'),
+                ('total_lots', 'total_lots'),
+        ],
+        'staging_carpark_availability_delta': [
+                ('timestamp', 'date_time'),
+                ('carpark_number', 'carpark_id'),
+                ('lot_type', 'lot_type'),
+                ('lots_available', 'lots_available'),
+                ('total_lots', 'total_lots'),
+                ('change_type', 'change_type'),
+        ],
+        'staging_carpark_info': [
+                ('carpark_id', 'carpark_id'),
+                ('carpark_location', 'carpark_location'),
+                ('carpark_latitude', 'carpark_latitude'),
+                ('carpark_longitude', 'carpark_longitude'),
+        ],
+        'staging_weather_station_info': [
+                ('station_id', 'station_id'),
+                ('station_location', 'station_location'),
+                ('station_latitude', 'station_latitude'),
+                ('station_longitude', 'station_longitude'),
+        ],
+}
+
+
+def copy_dataframe(conn, data, table, chunk_rows=100000):
+        """
+        The function loads the DataFrame into the staging table of a PostgreSQL database with COPY FROM STDIN.
+
+        The rows are written as CSV into an in-memory buffer, one chunk of rows at a time, and streamed
+        to the server, so no file is written to disk or S3. The staging table is cleared first, the same as
+        the LoadS3ToRedshiftOperator does, and everything is committed in one transaction.
+
+        Args:
+                conn: A psycopg2 connection, e.g. PostgresHook(...).get_conn().
+                data: The DataFrame returned by the helper.
+                table: The staging table, one of the keys of STAGING_COLUMNS.
+                chunk_rows: The number of rows written to the buffer at a time.
+
+        Returns the number of rows loaded.
+        """
+        if table not in STAGING_COLUMNS:
+                raise ValueError(f"Unknown staging table: {table}")
+        sources = [source for source, _ in STAGING_COLUMNS[table]]
+        targets = [target for _, target in STAGING_COLUMNS[table]]
+        copy_sql = SqlQueries.staging_copy_stdin.format(table=table, columns=", ".join(targets))
+
+        frame = data[sources]
+        metrics = get_metrics()
+        cursor = conn.cursor()
+        try:
+                with metrics.timer('copy', table=table):
+                        cursor.execute("DELETE FROM {}".format(table))
+                        for start in range(0, len(frame), chunk_rows):
+                                buffer = io.StringIO()
+                                frame.iloc[start:start + chunk_rows].to_csv(buffer, index=False, header=False)
+                                buffer.seek(0)
+                                cursor.copy_expert(copy_sql, buffer)
+                        conn.commit()
+        except Exception:
+                conn.rollback()
+                raise
+        metrics.count('rows_copied', len(frame), table=table)
+        logging.info(f"Copied {len(frame)} rows to {table}")
+        return len(frame)
+
+
+def save_to_staging(data, table, postgres_conn_id):
+        """
+        The function loads the DataFrame straight into the staging table of the Postgres connection,
+        instead of saving it to S3. See `copy_dataframe`.
+
+        Args:
+                data: The DataFrame returned by the helper.
+                table: The staging table, one of the keys of STAGING_COLUMNS.
+                postgres_conn_id: The Airflow connection of the database, e.g. the pg-data container.
+        """
+        from airflow.hooks.postgres_hook import PostgresHook
+
+        conn = PostgresHook(postgres_conn_id=postgres_conn_id).get_conn()
+        try:
+                return copy_dataframe(conn, data, table)
+        finally:
+                conn.close()
@@ -0,0 +1,222 @@
+import uuid
+
+
+# Declarative registry of the data quality checks run by the DataQualityOperator.
+#
+# Each check compares a staging table with the table it is loaded into. Both tables are profiled
+# in a single scan each (row count, null count, duplicate keys, min/max of a value column), all
+# the scans are sent to Redshift in one round trip, and the metrics are saved in the
+# data_quality_history table before they are checked.
+#
+# Keys of a check:
+#     name: The name of the check, saved in the history.
+#     staging_table: The staging table the target table is loaded from.
+#     target_table: The fact or dimension table.
+#     key_columns: The columns identifying a row in the target table, used to count duplicate keys.
+#     not_null_columns: The columns of the target table that must not be null.
+#     value_column: The column to compute the min and max of, or None.
+#     min_value, max_value: The allowed range of the value column, None for no bound.
+#     partitioned: If True, only the rows of the target table at the execution time are profiled.
+#     unique: If True, the target table must not contain duplicate keys.
+#     match_on: 'rows' compares the staging rows with the target rows,
+#               'keys' compares the distinct keys of both tables.
+#     staging_columns: Optional, the name in the staging table of the columns above, when it differs.
+#                      The staging table is profiled with the same columns as the target, under these names.
+QUALITY_CHECKS = {
+        'fact': [
+                {
+                        'name': 'rainfall',
+                        'staging_table': 'staging_rainfall',
+                        'target_table': 'rainfall_events',
+                        'key_columns': ['date_time', 'station_id'],
+                        'not_null_columns': ['date_time', 'station_id'],
+                        'value_column': 'rainfall',
+                        'min_value': 0,
+                        'max_value': None,
+                        'partitioned': True,
+                        'unique': True,
+                        'match_on': 'rows',
+                },
+                {
+                        'name': 'temperature',
+                        'staging_table': 'staging_temperature',
+                        'target_table': 'temperature_events',
+                        'key_columns': ['date_time', 'station_id'],
+                        'not_null_columns': ['date_time', 'station_id'],
+                        'value_column': 'temperature',
+                        'min_value': None,
+                        'max_value': None,
+                        'partitioned': True,
+                        'unique': True,
+                        'match_on': 'rows',
+                },
+                {
+                        'name': 'carpark_availability',
+                        'staging_table': 'staging_carpark_availability',
+                        'target_table': 'carpark_availability',
+                        'key_columns': ['date_time', 'carpark_id', 'lot_type'],
+                        'not_null_columns': ['date_time', 'carpark_id', 'lot_type'],
+                        'value_column': 'lots_available',
+                        'min_value': 0,
+                        'max_value': None,
+                        'partitioned': True,
+                        'unique': True,
+                        'match_on': 'rows',
+                },
+                {
+                        'name': 'carpark_availability_delta',
+                        'staging_table': 'staging_carpark_availability_delta',
+                        'target_table': 'carpark_availability_delta',
+                        # Only the changed readings are loaded, a run without any change loads no row.
+                        # The removed readings have no lots, so only the keys and change type must be set.
+                        'key_columns': ['date_time', 'carpark_id', 'lot_type'],
+                        'not_null_columns': ['date_time', 'carpark_id', 'lot_type', 'change_type'],
+                        'value_column': 'lots_available',
+                        'min_value': 0,
+                        'max_value': None,
+                        'partitioned': True,
+                        'unique': True,
+                        'match_on': 'rows',
+                },
+        ],
+        'dimension': [
+                {
+                        'name': 'carpark',
+                        'staging_table': 'staging_carpark_info',
+                        'target_table': 'carpark',
+                        'key_columns': ['carpark_id'],
+                        'not_null_columns': ['carpark_id'],
+                        'value_column': None,
+                        'min_value': None,
+                        'max_value': None,
+                        'partitioned': False,
+                        'unique': True,
+                        'match_on': 'keys',
+                },
+                {
+                        'name': 'weather_stations',
+                        'staging_table': 'staging_weather_station_info',
+                        'target_table': 'weather_stations',
+                        'key_columns': ['station_id'],
+                        'not_null_columns': ['station_id'],
+                        'value_column': None,
+                        'min_value': None,
+                        'max_value': None,
+                        'partitioned': False,
+                        'unique': True,
+                        'match_on': 'rows',
+                },
+        ],
+}
+
+# Columns of the data_quality_history table filled by the profile.
+HISTORY_COLUMNS = ("run_id, run_time, execution_time, check_name, table_name, table_role, "
+                   "row_count, null_count, duplicate_count, min_value, max_value")
+
+# Statements to save the metrics again after the transaction that profiled the tables was rolled back,
+# e.g. by the StageLoadCheckOperator when a check fails, so the failed run stays in the history.
+HISTORY_SELECT = f"SELECT {HISTORY_COLUMNS} FROM data_quality_history WHERE run_id = %(run_id)s"
+HISTORY_INSERT = f"INSERT INTO data_quality_history ({HISTORY_COLUMNS}) VALUES ({', '.join(['%s'] * 11)})"
+
+
+def _profile_sql(check, table, role, not_null_columns, key_columns, value_column, where):
+        """ Single scan SELECT returning one row of metrics for the table """
+        if not_null_columns:
+                null_count = " + ".join(f"COALESCE(SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END), 0)" for column in not_null_columns)
+        else:
+                null_count = "0"
+        if key_columns:
+                key = " || '|' || ".join(f"COALESCE(CAST({column} AS VARCHAR), '')" for column in key_columns)
+                duplicate_count = f"COUNT(*) - COUNT(DISTINCT {key})"
+        else:
+                duplicate_count = "0"
+        if value_column:
+                min_value = f"CAST(MIN({value_column}) AS DOUBLE PRECISION)"
+                max_value = f"CAST(MAX({value_column}) AS DOUBLE PRECISION)"
+        else:
+                min_value = max_value = "CAST(NULL AS DOUBLE PRECISION)"
+
+        return f"""
+                SELECT %(run_id)s, %(run_time)s, CAST(%(execution_time)s AS TIMESTAMPTZ), '{check['name']}', '{table}', '{role}',
+                        COUNT(*), {null_count}, {duplicate_count}, {min_value}, {max_value}
+                FROM {table} {where}"""
+
+
+def _staging_columns(check, columns):
+        """ The names of the columns of the target table in the staging table of the check """
+        staging_columns = check.get('staging_columns', {})
+        return [staging_columns.get(column, column) for column in columns]
+
+
+def profile_sql(checks):
+        """
+        Build the statements that profile the staging and target tables of every check in one round trip:
+        an INSERT of the metrics into data_quality_history, followed by a SELECT of the metrics just saved.
+
+        The statements take the parameters run_id, run_time and execution_time.
+        """
+        profiles = []
+        for check in checks:
+                value_column = _staging_columns(check, [check['value_column']])[0] if check['value_column'] else None
+                profiles.append(_profile_sql(check, check['staging_table'], 'staging',
+                                             _staging_columns(check, check['not_null_columns']),
+                                             _staging_columns(check, check['key_columns']), value_column, ""))
+                where = "WHERE date_time = %(execution_time)s" if check['partitioned'] else ""
+                profiles.append(_profile_sql(check, check['target_table'], 'target',
+                                             check['not_null_columns'], check['key_columns'], check['value_column'], where))
+
+        return f"""
+                INSERT INTO data_quality_history ({HISTORY_COLUMNS})
+                {" UNION ALL ".join(profiles)};
+                SELECT check_name, table_role, row_count, null_count, duplicate_count, min_value, max_value
+                FROM data_quality_history
+                WHERE run_id = %(run_id)s;
+        """
+
+
+def new_run_id():
+        """ Unique id of a data quality run in data_quality_history """
+        return str(uuid.uuid4())
+
+
+def evaluate(checks, records):
+        """
+        Compare the metrics returned by `profile_sql` against the checks.
+
+        Returns the list of failures, empty if every check passed.
+        """
+        metrics = {(name, role): {
+                'row_count': row_count,
+                'null_count': null_count,
+                'duplicate_count': duplicate_count,
+                'min_value': min_value,
+                'max_value': max_value,
+        } for name, role, row_count, null_count, duplicate_count, min_value, max_value in records}
+
+        failures = []
+        for check in checks:
+                name = check['name']
+                if (name, 'staging') not in metrics or (name, 'target') not in metrics:
+                        failures.append(f"{name}: no metrics returned")
+                        continue
+                staging = metrics[(name, 'staging')]
+                target = metrics[(name, 'target')]
+
+                staging_count = staging['row_count']
+                target_count = target['row_count']
+                if check['match_on'] == 'keys':
+                        # COUNT(DISTINCT key) of both tables, e.g. the dimension collapses the duplicate staging rows.
+                        staging_count = staging['row_count'] - staging['duplicate_count']
+                        target_count = target['row_count'] - target['duplicate_count']
+                if staging_count != target_count:
+                        failures.append(f"{name}: {staging_count} {check['match_on']} in {check['staging_table']}, "
+                                        f"{target_count} {check['match_on']} in {check['target_table']}")
+                if target['null_count']:
+                        failures.append(f"{name}: {target['null_count']} nulls in {check['not_null_columns']} of {check['target_table']}")
+                if check['unique'] and target['duplicate_count']:
+                        failures.append(f"{name}: {target['duplicate_count']} duplicate keys {check['key_columns']} in {check['target_table']}")
+                if check['min_value'] is not None and target['min_value'] is not None and target['min_value'] < check['min_value']:
+                        failures.append(f"{name}: min {check['value_column']} {target['min_value']} is below {check['min_value']}")
+                if check['max_value'] is not None and target['max_value'] is not None and target['max_value'] > check['max_value']:
+                        failures.append(f"{name}: max {check['value_column']} {target['max_value']} is above {check['max_value']}")
+        return failures
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import json
+import logging
+
+import s3fs
+
+from helpers.metrics import get_metrics
+
+# Folder of the raw archive in the bucket, set by `raw_archive` in the params of the helpers.
+DEFAULT_ARCHIVE_PREFIX = 'raw'
+
+
+def payload_key(prefix, dataset, digest):
+        """ Return the key of the compressed payload with the sha256 digest, e.g. raw/carpark/ab/ab12....json.gz """
+        return "{}/{}/{}/{}.json.gz".format(prefix, dataset, digest[:2], digest)
+
+
+def run_key(prefix, dataset, ts_nodash):
+        """ Return the key of the record of the payload of one run, e.g. raw/carpark/runs/20190809T100000.json """
+        return "{}/{}/runs/{}.json".format(prefix, dataset, ts_nodash)
+
+
+def _read_json(fs, path):
+        """ Return the decoded json file at the path, or None if there is no such file """
+        if not fs.exists(path):
+                return None
+        with fs.open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+
+
+def _write_json(fs, path, content):
+        with fs.open(path, 'wb') as f:
+                f.write(json.dumps(content).encode('utf-8'))
+
+
+def archive_payload(body, dataset, ts_nodash, s3_bucket, prefix=DEFAULT_ARCHIVE_PREFIX):
+        """
+        The function saves the raw API response in the archive of the bucket, gzip compressed under its content hash,
+        so the history can be transformed again without calling the API. A payload already in the archive is not
+        written again, and a record of the run points to it, e.g. raw/carpark/runs/20190809T100000.json.
+
+        The record tells whether the payload is identical to the one of the latest previous run, saved in
+        raw/{dataset}/latest.json, and the execution time of that run, so the transform and upload of the run
+        can be skipped, and its load can copy the rows of the previous run. A retried run finds its own record,
+        and keeps the same answer.
+
+        Args:
+                body: The bytes of the response body, i.e. response.content.
+                dataset: The name of the dataset, e.g. carpark or temperature.
+                ts_nodash: The execution time of the run.
+                s3_bucket: The name of bucket.
+                prefix: The folder of the archive in the bucket. Default is raw
+
+        Returns the record of the run, with the sha256, key and size of the payload, whether it is unchanged,
+        and the ts_nodash of the previous run it is identical to.
+        """
+        fs = s3fs.S3FileSystem()
+        record_path = "{}/{}".format(s3_bucket, run_key(prefix, dataset, ts_nodash))
+        record = _read_json(fs, record_path)
+        digest = hashlib.sha256(body).hexdigest()
+        if record is not None and record['sha256'] == digest:
+                logging.info(f"The {dataset} payload of {ts_nodash} is already archived as {record['key']}")
+                return record
+
+        key = payload_key(prefix, dataset, digest)
+        metrics = get_metrics()
+        if not fs.exists("{}/{}".format(s3_bucket, key)):
+                with metrics.timer('archive', dataset=dataset):
+                        compressed = gzip.compress(body, compresslevel=6)
+                        with fs.open("{}/{}".format(s3_bucket, key), 'wb') as f:
+                                f.write(compressed)
+                metrics.count('archive_bytes', len(compressed), dataset=dataset)
+                logging.info(f"Archived the {len(body)} bytes {dataset} payload as {key} ({len(compressed)} bytes compressed)")
+
+        latest_path = "{}/{}/{}/latest.json".format(s3_bucket, prefix, dataset)
+        latest = _read_json(fs, latest_path)
+        # Only a payload of an earlier run counts, so a backfill of older runs is never skipped.
+        unchanged = latest is not None and latest['sha256'] == digest and latest['ts_nodash'] < ts_nodash
+        record = {
+                'sha256': digest,
+                'key': key,
+                'bytes': len(body),
+                'ts_nodash': ts_nodash,
+                'unchanged': unchanged,
+                'previous_ts_nodash': latest['ts_nodash'] if unchanged else None,
+        }
+        _write_json(fs, record_path, record)
+        if latest is None or latest['ts_nodash'] <= ts_nodash:
+                _write_json(fs, latest_path, {'sha256': digest, 'ts_nodash': ts_nodash})
+        if record['unchanged']:
+                metrics.count('unchanged_payloads', dataset=dataset)
+        return record
+
+
+def read_archived_payload(dataset, ts_nodash, s3_bucket, prefix=DEFAULT_ARCHIVE_PREFIX):
+        """
+        The function returns the raw response body archived for the run, to transform it again without the API.
+
+        The replay saves the file of the run even if its payload was identical to the previous run, so the record
+        of the run is rewritten as changed, and the load of the run does not skip the file.
+
+        Args:
+                dataset: The name of the dataset, e.g. carpark or temperature.
+                ts_nodash: The execution time of the run.
+                s3_bucket: The name of bucket.
+                prefix: The folder of the archive in the bucket. Default is raw
+        """
+        fs = s3fs.S3FileSystem()
+        record_path = "{}/{}".format(s3_bucket, run_key(prefix, dataset, ts_nodash))
+        record = _read_json(fs, record_path)
+        if record is None:
+                raise ValueError(f"No archived {dataset} payload for {ts_nodash}")
+        with fs.open("{}/{}".format(s3_bucket, record['key']), 'rb') as f:
+                body = gzip.decompress(f.read())
+        if hashlib.sha256(body).hexdigest() != record['sha256']:
+                raise ValueError(f"The archived {dataset} payload {record['key']} does not match its hash")
+        if record.get('unchanged', False):
+                record.update({'unchanged': False, 'previous_ts_nodash': None})
+                _write_json(fs, record_path, record)
+        return body
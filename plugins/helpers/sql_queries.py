@@ -17,30 +17,357 @@ class SqlQueries:
         """)      
 
         carpark_availability_insert = ("""
-                INSERT INTO carpark_availability (date_time, carpark_id, lots_available)
-                SELECT date_time, carpark_id, lots_available
+                INSERT INTO carpark_availability (date_time, carpark_id, lot_type, lots_available, total_lots)
+                SELECT date_time, carpark_id, lot_type, lots_available, total_lots
                 FROM staging_carpark_availability
         """)
 
+        # The rows of the previous run copied to the execution time, for a run whose payload is identical to it.
+        carpark_availability_carry_forward = ("""
+                INSERT INTO carpark_availability (date_time, carpark_id, lot_type, lots_available, total_lots)
+                SELECT CAST(%(date_time)s AS TIMESTAMPTZ), carpark_id, lot_type, lots_available, total_lots
+                FROM carpark_availability
+                WHERE date_time = %(previous)s
+        """)
+
+        carpark_availability_delta_insert = ("""
+                INSERT INTO carpark_availability_delta (date_time, carpark_id, lot_type, lots_available, total_lots, change_type)
+                SELECT date_time, carpark_id, lot_type, lots_available, total_lots, change_type
+                FROM staging_carpark_availability_delta
+        """)
+
+        # The full snapshot of the delta encoded table at any time: the latest reading of every carpark and lot type
+        # since the latest checkpoint at or before the time, without the ones that are no longer listed.
+        # Only the date_time range from the checkpoint is scanned, using the sort key.
+        carpark_availability_as_of = ("""
+                SELECT date_time, carpark_id, lot_type, lots_available, total_lots
+                FROM (
+                        SELECT date_time, carpark_id, lot_type, lots_available, total_lots, change_type,
+                                ROW_NUMBER() OVER (PARTITION BY carpark_id, lot_type ORDER BY date_time DESC) AS row_number
+                        FROM {table}
+                        WHERE date_time <= %(as_of)s
+                        AND date_time >= (
+                                SELECT MAX(date_time) FROM {table}
+                                WHERE change_type = 'C' AND date_time <= %(as_of)s
+                        )
+                ) AS readings
+                WHERE row_number = 1 AND change_type <> 'R'
+                ORDER BY carpark_id, lot_type
+        """)
+
+        # Delete the rows of the date_time values in the staging table, so they can be replaced by the new ones.
+        # It only touches the staged date_time slice, using the date_time sort key of the fact tables.
+        fact_partition_delete = ("""
+                DELETE FROM {table}
+                USING (SELECT DISTINCT date_time FROM {staging_table}) AS staged
+                WHERE {table}.date_time = staged.date_time
+        """)
+
+        # One row per carpark. The total_lots is the number of car lots (lot type C) in the latest snapshot of the
+        # carpark in {availability_table}, or the total_lots of the current carpark row if it is not in the snapshot.
+        # The motorcycle and heavy vehicle lots are left out, so the capacity is not a mix of lot types that cannot
+        # park the same vehicles.
+        carpark_select = ("""
+                SELECT ci.carpark_id, ci.carpark_location, ci.carpark_latitude, ci.carpark_longitude,
+                        COALESCE(lots.total_lots, current_carpark.total_lots) AS total_lots
+                FROM (
+                        SELECT carpark_id, carpark_location, carpark_latitude, carpark_longitude,
+                                ROW_NUMBER() OVER (PARTITION BY carpark_id
+                                        ORDER BY carpark_location, carpark_latitude, carpark_longitude) AS row_number
+                        FROM staging_carpark_info
+                ) AS ci
+                LEFT JOIN (
+                        SELECT ca.carpark_id, MAX(ca.total_lots) AS total_lots
+                        FROM {availability_table} ca
+                        JOIN (
+                                SELECT carpark_id, MAX(date_time) AS date_time
+                                FROM {availability_table}
+                                WHERE lot_type = 'C'
+                                GROUP BY carpark_id
+                        ) AS latest
+                        ON ca.carpark_id = latest.carpark_id AND ca.date_time = latest.date_time
+                        WHERE ca.lot_type = 'C'
+                        GROUP BY ca.carpark_id
+                ) AS lots
+                ON ci.carpark_id = lots.carpark_id
+                LEFT JOIN carpark AS current_carpark
+                ON ci.carpark_id = current_carpark.carpark_id
+                WHERE ci.row_number = 1
+        """)
+
         carpark_insert = ("""
                 INSERT INTO carpark (carpark_id, carpark_location, carpark_latitude, carpark_longitude, total_lots)
-                SELECT ci.carpark_id, ci.carpark_location, ci.carpark_latitude, ci.carpark_longitude, ca.total_lots
-                FROM staging_carpark_info ci
-                LEFT JOIN staging_carpark_availability ca
-                ON ci.carpark_id = ca.carpark_id               
+        """ + carpark_select)
+
+        weather_stations_select = ("""
+                SELECT station_id, station_location, station_latitude, station_longitude
+                FROM staging_weather_station_info               
         """)
 
         weather_stations_insert = ("""
                 INSERT INTO weather_stations (station_id, station_location, station_latitude, station_longitude)
-                SELECT station_id, station_location, station_latitude, station_longitude
-                FROM staging_weather_station_info               
+        """ + weather_stations_select)
+
+        # Row-level diff of a dimension table against its select from the staging tables.
+        # The rows are compared by the md5 of all their columns ({row_hash}), so only the rows
+        # that changed are deleted and inserted, and an unchanged dimension is not written at all.
+        dimension_diff = ("""
+                CREATE TEMP TABLE {table}_desired AS
+                SELECT DISTINCT * FROM ({select}) AS s;
+
+                DELETE FROM {table}
+                WHERE MD5({row_hash}) NOT IN (SELECT MD5({row_hash}) FROM {table}_desired);
+
+                INSERT INTO {table} ({columns})
+                SELECT {columns}
+                FROM {table}_desired
+                WHERE MD5({row_hash}) NOT IN (SELECT MD5({row_hash}) FROM {table});
+
+                DROP TABLE {table}_desired;
+        """)
+
+        # Type 2 history of a dimension table, applied after its diff. The current version of each {key} in
+        # {table}_history has no valid_to. The versions no longer in the dimension table are closed, and
+        # the new or changed rows of the dimension table are added as the current versions.
+        dimension_history = ("""
+                UPDATE {table}_history
+                SET valid_to = '{valid_from}'
+                WHERE valid_to IS NULL
+                AND {key} || '|' || row_hash NOT IN (SELECT {key} || '|' || MD5({row_hash}) FROM {table});
+
+                INSERT INTO {table}_history ({columns}, row_hash, valid_from, valid_to)
+                SELECT {columns}, MD5({row_hash}), '{valid_from}', NULL
+                FROM {table}
+                WHERE {key} || '|' || MD5({row_hash}) NOT IN (
+                        SELECT {key} || '|' || row_hash FROM {table}_history WHERE valid_to IS NULL);
+        """)
+
+        ## Bridge of the carparks and their nearest weather stations (NearestStationOperator)
+        carpark_coordinates_select = ("""
+                SELECT carpark_id, carpark_latitude, carpark_longitude
+                FROM carpark
+        """)
+
+        weather_stations_coordinates_select = ("""
+                SELECT station_id, station_latitude, station_longitude
+                FROM weather_stations
+        """)
+
+        carpark_station_insert = ("""
+                INSERT INTO {table} (carpark_id, station_id, station_rank, distance_km)
+                VALUES {values}
+        """)
+
+        ## Batched COPY of the staging tables (LoadS3ToRedshiftOperator with batch)
+        # The keys under the prefix already loaded in the staging table.
+        load_ledger_select = ("""
+                SELECT s3_key
+                FROM load_ledger
+                WHERE table_name = %s
+                AND s3_key LIKE %s
+        """)
+
+        load_ledger_insert = ("""
+                INSERT INTO load_ledger (table_name, s3_key, manifest_key, loaded_at)
+                VALUES {values}
+        """)
+
+        ## Change detection of the dimension snapshots
+        # The fingerprint of the content last loaded in each staging or dimension table.
+        load_fingerprint_select = ("""
+                SELECT table_name, fingerprint
+                FROM load_fingerprints
+                WHERE table_name IN ({tables})
         """)
 
-        time_table_insert = ("""
+        load_fingerprint_record = ("""
+                DELETE FROM load_fingerprints WHERE table_name = '{table}';
+                INSERT INTO load_fingerprints (table_name, fingerprint, source, loaded_at)
+                VALUES ('{table}', '{fingerprint}', '{source}', '{loaded_at}');
+        """)
+
+        # Calendar of the time dimension at the 10 minutes grain of the snapshots, from start to end.
+        # The slots are numbered by a cross join of tables of the digits 0-9, which also works in Redshift,
+        # and the slots already in the table are skipped, so the date_time keys are never duplicated.
+        time_table_extend = ("""
                 INSERT INTO time (date_time, hour, day, week, month, year, weekday)
-                SELECT date_time, extract(hour from date_time), extract(day from date_time), extract(week from date_time), 
-                extract(month from date_time), extract(year from date_time), extract(dayofweek from date_time)
-                FROM staging_carpark_availability
+                SELECT slot.date_time, extract(hour from slot.date_time), extract(day from slot.date_time), extract(week from slot.date_time),
+                extract(month from slot.date_time), extract(year from slot.date_time), extract(dow from slot.date_time)
+                FROM (
+                        SELECT CAST('{start}' AS TIMESTAMPTZ) + ({slot_number}) * INTERVAL '10 minutes' AS date_time
+                        FROM {digits}
+                ) AS slot
+                LEFT JOIN time ON time.date_time = slot.date_time
+                WHERE slot.date_time <= CAST('{end}' AS TIMESTAMPTZ)
+                AND time.date_time IS NULL
+        """)
+
+        # Range of the calendar already in the time table, and of the staged snapshots in {availability_table} it must cover.
+        time_table_range = ("""
+                SELECT 'time', MIN(date_time), MAX(date_time) FROM time
+                UNION ALL
+                SELECT 'staging', MIN(date_time), MAX(date_time) FROM {availability_table}
+        """)
+
+        ## Daily facts calculator (DailyFactsCalculatorOperator)
+        # The month and day are extracted from date_time, so no join to the time table is needed.
+        daily_facts_select = ("""
+                SELECT
+                        CAST(extract(month from date_time) AS INTEGER) AS month,
+                        CAST(extract(day from date_time) AS INTEGER) AS day,
+                        {groupby_column},
+                        MAX({fact_column}) AS max_{fact_column},
+                        MIN({fact_column}) AS min_{fact_column},
+                        AVG({fact_column}) AS average_{fact_column}
+                FROM {origin_table}
+                {where}
+                GROUP BY 1, 2, {groupby_column}
+        """)
+
+        # Full recompute. The new table is built aside and swapped in within the same transaction,
+        # so the destination table never disappears while it is rebuilt.
+        daily_facts_rebuild = ("""
+                DROP TABLE IF EXISTS {destination_table}_rebuild;
+                CREATE TABLE {destination_table}_rebuild AS {select};
+                DROP TABLE IF EXISTS {destination_table};
+                ALTER TABLE {destination_table}_rebuild RENAME TO {destination_table};
+        """)
+
+        # Incremental update. The (month, day, groupby_column) groups of the origin rows at the date_times of the
+        # staging table, i.e. the date_times loaded by this run, are deleted and recomputed from the origin table.
+        # So backfilled or replaced date_times are recomputed as well, not only the newest ones. The groups are read
+        # from the origin table, so a staging table of deltas, without the unchanged rows, touches every group too.
+        daily_facts_merge = ("""
+                CREATE TEMP TABLE {destination_table}_touched AS
+                SELECT DISTINCT
+                        CAST(extract(month from o.date_time) AS INTEGER) AS month,
+                        CAST(extract(day from o.date_time) AS INTEGER) AS day,
+                        o.{groupby_column}
+                FROM {origin_table} AS o
+                JOIN (SELECT DISTINCT date_time FROM {staging_table}) AS staged
+                ON o.date_time = staged.date_time;
+
+                DELETE FROM {destination_table}
+                USING {destination_table}_touched AS t
+                WHERE {destination_table}.month = t.month
+                AND {destination_table}.day = t.day
+                AND {destination_table}.{groupby_column} = t.{groupby_column};
+
+                INSERT INTO {destination_table} {select};
+
+                DROP TABLE {destination_table}_touched;
+        """)
+
+        # Rows of the origin table in the groups touched by the staging table, for the select of the incremental update.
+        daily_facts_touched_filter = ("""WHERE EXISTS (
+                        SELECT 1 FROM {destination_table}_touched AS t
+                        WHERE t.month = CAST(extract(month from {origin_table}.date_time) AS INTEGER)
+                        AND t.day = CAST(extract(day from {origin_table}.date_time) AS INTEGER)
+                        AND t.{groupby_column} = {origin_table}.{groupby_column})""")
+
+        ## Occupancy rollups (OccupancyRollupOperator)
+        # The buckets of each grain touched by the date_times in the staging table, i.e. the ones loaded by this run,
+        # are recomputed, the finest one from the fact table, and each coarser one from the grain below it.
+        # The sums and counts are kept next to the ratio, so a coarser bucket is recomputed from
+        # the finer buckets without scanning the fact table again.
+        rollup_columns = ("bucket, carpark_id, min_lots_available, max_lots_available, sum_lots_available, "
+                          "count_lots_available, sum_occupied_lots, sum_capacity_lots, occupancy_ratio")
+
+        # The buckets of the finest grain touched by the staging table, or every bucket of the fact table.
+        rollup_touched_from_staging = ("""
+                CREATE TEMP TABLE {table}_touched AS
+                SELECT DISTINCT DATE_TRUNC('{grain}', date_time) AS bucket
+                FROM {staging_table};
+        """)
+
+        rollup_touched_from_origin = ("""
+                CREATE TEMP TABLE {table}_touched AS
+                SELECT DISTINCT DATE_TRUNC('{grain}', date_time) AS bucket
+                FROM {origin_table};
+        """)
+
+        # Only the car lots, lot type C, are rolled up, as the total_lots of the carpark dimension only counts them.
+        rollup_from_origin = ("""
+                DELETE FROM {table}
+                USING {table}_touched AS t
+                WHERE {table}.bucket = t.bucket;
+
+                INSERT INTO {table} ({columns})
+                SELECT s.bucket, s.carpark_id,
+                        MIN(s.lots_available),
+                        MAX(s.lots_available),
+                        SUM(s.lots_available),
+                        COUNT(s.lots_available),
+                        SUM(CASE WHEN c.total_lots > 0 THEN c.total_lots - s.lots_available END),
+                        SUM(CASE WHEN c.total_lots > 0 AND s.lots_available IS NOT NULL THEN c.total_lots END),
+                        CAST(SUM(CASE WHEN c.total_lots > 0 THEN c.total_lots - s.lots_available END) AS DOUBLE PRECISION)
+                                / NULLIF(SUM(CASE WHEN c.total_lots > 0 AND s.lots_available IS NOT NULL THEN c.total_lots END), 0)
+                FROM (
+                        SELECT DATE_TRUNC('{grain}', a.date_time) AS bucket, a.carpark_id, a.lots_available
+                        FROM {origin_table} AS a
+                        JOIN {table}_touched AS t
+                        ON DATE_TRUNC('{grain}', a.date_time) = t.bucket
+                        WHERE a.date_time >= (SELECT MIN(bucket) FROM {table}_touched)
+                        AND a.lot_type = 'C'
+                ) AS s
+                LEFT JOIN carpark AS c
+                ON s.carpark_id = c.carpark_id
+                GROUP BY s.bucket, s.carpark_id;
+        """)
+
+        rollup_from_finer = ("""
+                CREATE TEMP TABLE {table}_touched AS
+                SELECT DISTINCT DATE_TRUNC('{grain}', bucket) AS bucket
+                FROM {source_table}_touched;
+
+                DELETE FROM {table}
+                USING {table}_touched AS t
+                WHERE {table}.bucket = t.bucket;
+
+                INSERT INTO {table} ({columns})
+                SELECT DATE_TRUNC('{grain}', f.bucket), f.carpark_id,
+                        MIN(f.min_lots_available),
+                        MAX(f.max_lots_available),
+                        SUM(f.sum_lots_available),
+                        SUM(f.count_lots_available),
+                        SUM(f.sum_occupied_lots),
+                        SUM(f.sum_capacity_lots),
+                        CAST(SUM(f.sum_occupied_lots) AS DOUBLE PRECISION) / NULLIF(SUM(f.sum_capacity_lots), 0)
+                FROM {source_table} AS f
+                JOIN {table}_touched AS t
+                ON DATE_TRUNC('{grain}', f.bucket) = t.bucket
+                GROUP BY 1, 2;
+        """)
+
+        ## Read API of the carpark availability (helpers.availability_reader)
+        availability_latest_date_time = ("""
+                SELECT MAX(date_time) FROM {table}
+        """)
+
+        # Only the car lots, lot type C, are read. The date_time range uses the sort key.
+        availability_latest_select = ("""
+                SELECT a.carpark_id, a.date_time, a.lots_available
+                FROM {table} AS a
+                JOIN (
+                        SELECT carpark_id, MAX(date_time) AS date_time
+                        FROM {table}
+                        WHERE carpark_id IN %(carpark_ids)s
+                        AND date_time >= %(since)s
+                        AND lot_type = 'C'
+                        GROUP BY carpark_id
+                ) AS latest
+                ON a.carpark_id = latest.carpark_id AND a.date_time = latest.date_time
+                WHERE a.date_time >= %(since)s
+                AND a.lot_type = 'C'
+        """)
+
+        availability_recent_select = ("""
+                SELECT carpark_id, date_time, lots_available
+                FROM {table}
+                WHERE carpark_id IN %(carpark_ids)s
+                AND date_time > %(since)s
+                AND lot_type = 'C'
+                ORDER BY carpark_id, date_time
         """)
 
         ## Old implementation for PostgreSQL (Dev Environment)
@@ -62,3 +389,9 @@ class SqlQueries:
         WITH (FORMAT CSV, HEADER TRUE)
         """)
 
+        # Streamed from the client instead of a file on the server, used by the postgres_loader helper.
+        staging_copy_stdin = ("""
+        COPY {table} ({columns})
+        FROM STDIN
+        WITH (FORMAT CSV)
+        """)
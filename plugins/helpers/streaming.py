@@ -0,0 +1,29 @@
+import ijson
+
+from helpers.http_client import endpoint_name
+from helpers.metrics import get_metrics
+
+
+def iter_json_items(response, prefix):
+        """
+        The function parses the body of a streamed `requests` response incrementally from the socket,
+        and yields the objects found under `prefix` one at a time, e.g. 'items.item.carpark_data.item'.
+
+        Neither the full response body nor the fully decoded json is held in memory,
+        so the memory used stays roughly constant regardless of the size of the payload.
+        The response must be requested with `stream=True`.
+
+        The bytes read from the socket are recorded as the http_bytes of the url once the body is parsed.
+
+        Args:
+                response: The response returned by `requests.get(..., stream=True)`.
+                prefix: The ijson prefix of the objects to yield.
+        """
+        # Let urllib3 decompress gzip/deflate encoded bodies while reading.
+        response.raw.decode_content = True
+        try:
+                for record in ijson.items(response.raw, prefix, use_float=True):
+                        yield record
+        finally:
+                get_metrics().count('http_bytes', response.raw.tell(), endpoint=endpoint_name(response.url))
+                response.close()
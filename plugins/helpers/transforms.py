@@ -0,0 +1,182 @@
+from collections import OrderedDict
+
+import pandas as pd
+
+from helpers.geo import svy21_to_wgs84
+
+
+def _collect_columns(records):
+        """
+        Collect an iterable of flat dicts into one list per key, in a single pass.
+
+        The keys are kept in the order they are first seen, the same as json_normalize.
+        Missing keys are padded with None, so they are left empty in the output.
+
+        Returns the ordered columns and the number of rows collected.
+        """
+        columns = OrderedDict()
+        num_rows = 0
+        for record in records:
+                for key, value in record.items():
+                        column = columns.get(key)
+                        if column is None:
+                                # New key, pad the rows that came before it.
+                                column = columns[key] = [None] * num_rows
+                        column.append(value)
+                num_rows += 1
+                if len(record) != len(columns):
+                        # Some keys are missing from this record, pad them.
+                        for column in columns.values():
+                                if len(column) < num_rows:
+                                        column.append(None)
+        return columns, num_rows
+
+
+def flatten_records(records):
+        """
+        The function builds the DataFrame of an iterable of flat records, e.g. a streaming json parser,
+        in a single pass, without keeping the records themselves in memory. See `_collect_columns`.
+
+        Args:
+                records: An iterable of flat dicts.
+        """
+        columns, _ = _collect_columns(records)
+        return pd.DataFrame(columns)
+
+
+def flatten_carpark_readings(readings, execution_time):
+        """
+        The function flattens an iterable of carpark readings (the entries of carpark_data)
+        into rectangular format in a single pass over the records.
+
+        Every column is collected into its own list, and the DataFrame is only built once at the end,
+        so no intermediate DataFrames are created. The timestamp is formatted once for the whole snapshot,
+        because every row of the snapshot is stamped with the execution time.
+
+        The columns are timestamp, carpark_number, followed by the keys of carpark_info sorted by name,
+        i.e. lot_type, lots_available and total_lots, the column order of staging_carpark_availability.
+        The json_normalize of the previous implementation sorted them the same way. Missing keys are left empty.
+
+        Args:
+                readings: An iterable of carpark readings, e.g. a list or a streaming json parser.
+                execution_time: The execution time in '%Y-%m-%dT%H:%M:%S' format.
+        """
+        carpark_numbers = []
+
+        def carpark_info():
+                for reading in readings:
+                        carpark_number = reading['carpark_number']
+                        for info in reading['carpark_info']:
+                                carpark_numbers.append(carpark_number)
+                                yield info
+
+        info_columns, num_rows = _collect_columns(carpark_info())
+        if num_rows == 0:
+                # The same empty frame as `flatten_carpark` without items, so both modes save the same file.
+                return pd.DataFrame()
+
+        timestamp = pd.to_datetime(execution_time).strftime("%Y-%m-%d %H:%M:%S")
+        columns = OrderedDict([('timestamp', [timestamp] * num_rows), ('carpark_number', carpark_numbers)])
+        for key in sorted(info_columns):
+                columns[key] = info_columns[key]
+        return pd.DataFrame(columns)
+
+
+def flatten_carpark(json_data, execution_time):
+        """
+        The function flattens the Carpark Availability payload (items -> carpark_data -> carpark_info)
+        into rectangular format. See `flatten_carpark_readings`.
+
+        Args:
+                json_data: The decoded json response from the carpark availability API.
+                execution_time: The execution time in '%Y-%m-%dT%H:%M:%S' format.
+        """
+        items = json_data['items']
+        if not items:
+                return pd.DataFrame(items)
+
+        readings = (reading for item in items for reading in item['carpark_data'])
+        return flatten_carpark_readings(readings, execution_time)
+
+
+def flatten_weather_items(items):
+        """
+        The function flattens an iterable of weather items (items -> readings) into rectangular format
+        in a single pass over the records. Each reading is stamped with the timestamp of its item.
+
+        Args:
+                items: An iterable of weather items, e.g. a list or a streaming json parser.
+        """
+        item_timestamps = []
+        item_rows = []
+
+        def readings():
+                for item in items:
+                        num_readings = len(item['readings'])
+                        item_timestamps.append(item['timestamp'])
+                        item_rows.append(num_readings)
+                        for reading in item['readings']:
+                                yield reading
+
+        reading_columns, num_rows = _collect_columns(readings())
+
+        # Format the timestamp once per item instead of once per reading.
+        formatted = [x.strftime("%Y-%m-%d %H:%M:%S") for x in pd.to_datetime(pd.Series(item_timestamps))]
+        timestamps = []
+        for timestamp, rows in zip(formatted, item_rows):
+                timestamps.extend([timestamp] * rows)
+
+        columns = OrderedDict([('timestamp', timestamps)])
+        columns.update(reading_columns)
+        return pd.DataFrame(columns)
+
+
+def flatten_weather(json_data):
+        """
+        The function flattens the weather payload (items -> readings) into rectangular format.
+        See `flatten_weather_items`.
+
+        Args:
+                json_data: The decoded json response from the weather API.
+        """
+        return flatten_weather_items(json_data['items'])
+
+
+def flatten_weather_stations(stations):
+        """
+        The function flattens the weather stations (metadata -> stations) into rectangular format,
+        expanding the nested location of each station into its latitude and longitude.
+
+        Args:
+                stations: An iterable of weather stations, e.g. a list or a streaming json parser.
+        """
+        columns = OrderedDict([('station_id', []), ('station_location', []),
+                               ('station_latitude', []), ('station_longitude', [])])
+        for station in stations:
+                location = station.get('location') or {}
+                columns['station_id'].append(station.get('id'))
+                columns['station_location'].append(station.get('name'))
+                columns['station_latitude'].append(location.get('latitude'))
+                columns['station_longitude'].append(location.get('longitude'))
+        return pd.DataFrame(columns)
+
+
+def transform_carpark_info(records):
+        """
+        The function keeps the columns of the Carpark Information records used by the warehouse,
+        and converts their SVY21 coordinates (x_coord and y_coord, in meters) to latitudes and longitudes.
+
+        Args:
+                records: The DataFrame of the datastore records, see `helpers.ckan.fetch_datastore`.
+        """
+        if records.empty:
+                return records
+
+        latitudes, longitudes = svy21_to_wgs84(pd.to_numeric(records['y_coord'], errors='coerce'),
+                                               pd.to_numeric(records['x_coord'], errors='coerce'))
+        return pd.DataFrame(OrderedDict([
+                ('carpark_id', records['car_park_no'].values),
+                ('carpark_location', records['address'].values),
+                ('carpark_latitude', latitudes),
+                ('carpark_longitude', longitudes),
+        ]))
@@ -4,6 +4,9 @@ from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.metrics import get_metrics, instrumented
+from helpers.sql_queries import SqlQueries
+
 
 class DailyFactsCalculatorOperator(BaseOperator):
     """
@@ -18,23 +21,18 @@ class DailyFactsCalculatorOperator(BaseOperator):
         destination_table: The table where results will be saved into.
         fact_column: The column in the origin_table to run the calculation
         groupby_column: The column to be used for group calculation.
+        incremental: If incremental is True, only the daily groups of the rows in the staging_table, i.e. the
+                     date_times loaded by this run, are recalculated from the origin_table, whether they are new,
+                     backfilled or replaced. The first run, without a destination table yet, recalculates everything.
+        staging_table: The staging table of the origin_table, only needed when incremental is True.
 
     """
     ui_color = '#5934eb'
     # SQL statement template, grouping by month and day to summarise the data daily for every month.
-    facts_sql_template = """
-    DROP TABLE IF EXISTS {destination_table};
-    CREATE TABLE {destination_table} AS
-    SELECT
-        t.month, t.day, {groupby_column},
-        MAX({fact_column}) AS max_{fact_column},
-        MIN({fact_column}) AS min_{fact_column},
-        AVG({fact_column}) AS average_{fact_column}
-    FROM {origin_table}
-    LEFT JOIN time AS t
-    ON t.date_time = {origin_table}.date_time
-    GROUP BY t.month, t.day, {groupby_column};
-    """
+    # The table is rebuilt aside and swapped in, so it does not disappear while it is recalculated.
+    facts_sql_template = SqlQueries.daily_facts_rebuild
+    # SQL statement template to only recalculate the daily groups touched by the staging table.
+    incremental_sql_template = SqlQueries.daily_facts_merge
 
     @apply_defaults
     def __init__(self,
@@ -43,28 +41,63 @@ class DailyFactsCalculatorOperator(BaseOperator):
                  destination_table="",
                  fact_column="",
                  groupby_column="",
+                 incremental=False,
+                 staging_table="",
                  *args, **kwargs):
 
         super(DailyFactsCalculatorOperator, self).__init__(*args, **kwargs)
+        if incremental and not staging_table:
+            raise ValueError("The incremental mode needs the staging_table of the origin_table")
         self.redshift_conn_id = redshift_conn_id
         self.origin_table = origin_table
         self.destination_table = destination_table
         self.fact_column = fact_column
         self.groupby_column = groupby_column
-        
+        self.incremental = incremental
+        self.staging_table = staging_table
 
+    def _can_merge(self, redshift):
+        """ The incremental mode needs the destination table from a previous run """
+        tables = redshift.get_records(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = %s", parameters=(self.destination_table,))
+        return tables[0][0] > 0
+
+    @instrumented
     def execute(self, context):
         # Fetch the redshift hook
         redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
 
-        # Use the `facts_sql_template` and run the query against redshift
-        self.log.info("Running the facts table calculations")
-        formatted_sql = DailyFactsCalculatorOperator.facts_sql_template.format(
-            destination_table = self.destination_table,
-            groupby_column = self.groupby_column,
-            fact_column = self.fact_column,
-            origin_table = self.origin_table
-        )
-               
-        redshift.run(formatted_sql)
-        
+        if self.incremental and self._can_merge(redshift):
+            self.log.info(f"Recalculating the daily groups of the rows in {self.staging_table}")
+            formatted_sql = DailyFactsCalculatorOperator.incremental_sql_template.format(
+                destination_table = self.destination_table,
+                groupby_column = self.groupby_column,
+                origin_table = self.origin_table,
+                staging_table = self.staging_table,
+                select = SqlQueries.daily_facts_select.format(
+                    groupby_column = self.groupby_column,
+                    fact_column = self.fact_column,
+                    origin_table = self.origin_table,
+                    where = SqlQueries.daily_facts_touched_filter.format(
+                        destination_table = self.destination_table,
+                        groupby_column = self.groupby_column,
+                        origin_table = self.origin_table
+                    )
+                )
+            )
+        else:
+            # Use the `facts_sql_template` and run the query against redshift
+            self.log.info("Running the facts table calculations")
+            formatted_sql = DailyFactsCalculatorOperator.facts_sql_template.format(
+                destination_table = self.destination_table,
+                select = SqlQueries.daily_facts_select.format(
+                    groupby_column = self.groupby_column,
+                    fact_column = self.fact_column,
+                    origin_table = self.origin_table,
+                    where = ""
+                )
+            )
+
+        # All the statements run in one transaction.
+        with get_metrics().timer('insert', table=self.destination_table):
+            redshift.run(formatted_sql, autocommit=False)
@@ -4,6 +4,8 @@ from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.metrics import get_metrics, instrumented
+
 
 class HasRowsOperator(BaseOperator):
     """
@@ -27,12 +29,14 @@ class HasRowsOperator(BaseOperator):
         self.table = table
         self.redshift_conn_id = redshift_conn_id
 
+    @instrumented
     def execute(self, context):
         # Fetch the redshift hook
         redshift_hook = PostgresHook(self.redshift_conn_id)
 
         # Run the SQL statement to count the rows in table. And, throw errors if it is empty or no rows.
-        records = redshift_hook.get_records(f"SELECT COUNT(*) FROM {self.table}")
+        with get_metrics().timer('check', table=self.table):
+            records = redshift_hook.get_records(f"SELECT COUNT(*) FROM {self.table}")
         if len(records) < 1 or len(records[0]) < 1:
             raise ValueError(f"Data quality check failed. {self.table} returned no results")
         num_records = records[0][0]
@@ -1,7 +1,10 @@
+from datetime import datetime, timedelta
+
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.metrics import get_metrics, instrumented
 from helpers.sql_queries import SqlQueries
 
 class LoadDimensionOperator(BaseOperator):
@@ -14,34 +17,202 @@ class LoadDimensionOperator(BaseOperator):
         table: The name of the table to run the ingestion
         append: If append is True, it will append the data from staging to dimension table. 
                 Else, it will clear all the data, before putting data into dimension table.
+        diff: If diff is True, it only deletes the rows that are no longer in the staging tables and inserts
+              the new or changed rows, in one transaction. So an unchanged dimension is not rewritten.
+              It takes precedence over append.
+        history: If history is True, the diff is applied, then the versions of the rows are kept in the
+              {table}_history table, valid from the execution time until the run in which they changed (type 2).
+        fingerprint_tables: The staging tables loaded with fingerprints that the dimension is built from.
+              If the fingerprints of all of them are the same as the last time the dimension was loaded,
+              the load is skipped.
+        calendar_start: The first day of the calendar of the time table, in '%Y-%m-%d' format.
+        calendar_days: The number of days of the calendar generated ahead of the latest staged snapshot,
+              so the time table is only extended once in a while.
+        availability_table: The table of the carpark availability snapshots that the time table must cover,
+              and that the carpark table takes its total_lots from. Default is staging_carpark_availability
     """
     ui_color = '#80BD9E'
+    # The select and the columns of each dimension table that can be loaded with a diff.
+    dimension_selects = {
+        "carpark": SqlQueries.carpark_select,
+        "weather_stations": SqlQueries.weather_stations_select,
+    }
+    dimension_keys = {
+        "carpark": "carpark_id",
+        "weather_stations": "station_id",
+    }
+    dimension_columns = {
+        "carpark": ["carpark_id", "carpark_location", "carpark_latitude", "carpark_longitude", "total_lots"],
+        "weather_stations": ["station_id", "station_location", "station_latitude", "station_longitude"],
+    }
+    # Grain of the time table, the interval between two snapshots.
+    time_slot = timedelta(minutes=10)
+    digits_select = "(SELECT 0 AS n" + "".join(f" UNION ALL SELECT {digit}" for digit in range(1, 10)) + ")"
 
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  table="",
                  append=True,
+                 diff=False,
+                 history=False,
+                 fingerprint_tables=None,
+                 calendar_start="2019-01-01",
+                 calendar_days=30,
+                 availability_table="staging_carpark_availability",
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
         self.redshift_conn_id = redshift_conn_id
         self.table = table
         self.append = append
+        self.diff = diff
+        self.history = history
+        self.fingerprint_tables = fingerprint_tables or []
+        self.calendar_start = calendar_start
+        self.calendar_days = calendar_days
+        self.availability_table = availability_table
+
+    def staged_fingerprint(self, redshift):
+        """ Return the fingerprint of the content of the staging tables, and the one last loaded in the table """
+        tables = [self.table] + self.fingerprint_tables
+        loaded = dict(redshift.get_records(SqlQueries.load_fingerprint_select.format(
+            tables=", ".join(f"'{table}'" for table in tables))))
+        if any(table not in loaded for table in self.fingerprint_tables):
+            return None, loaded.get(self.table)
+        return "|".join(loaded[table] for table in self.fingerprint_tables), loaded.get(self.table)
+
+    def fingerprint_record_sql(self, fingerprint):
+        """ Return the statements recording the fingerprint of the content loaded in the table """
+        return SqlQueries.load_fingerprint_record.format(
+            table=self.table,
+            fingerprint=fingerprint,
+            source=", ".join(self.fingerprint_tables),
+            loaded_at=datetime.utcnow().isoformat(),
+        )
+
+    @staticmethod
+    def time_extend_sql(start, end):
+        """ Return the statement adding the 10 minutes slots from start to end that are missing in the time table """
+        slots = int((end - start) / LoadDimensionOperator.time_slot) + 1
+        digits = len(str(max(slots - 1, 1)))
+        return SqlQueries.time_table_extend.format(
+            start=start.isoformat(),
+            end=end.isoformat(),
+            slot_number=" + ".join(f"{10 ** i} * d{i}.n" for i in range(digits)),
+            digits=" CROSS JOIN ".join(f"{LoadDimensionOperator.digits_select} AS d{i}" for i in range(digits)),
+        )
+
+    def time_ranges(self, time_range, staged_range):
+        """
+        Return the (start, end) ranges of the calendar missing in the time table, given the range of the
+        calendar already in the table and the range of the staged snapshots.
+
+        The calendar runs from calendar_start to calendar_days after the latest staged snapshot. It is only
+        extended when a staged snapshot falls outside of it, e.g. every calendar_days days, or on a backfill.
+        """
+        time_min, time_max = time_range
+        staged_min, staged_max = staged_range
+        if staged_max is None:
+            return []
+        # Align the snapshots on the 10 minutes grain of the calendar.
+        staged_min, staged_max = [value - timedelta(minutes=value.minute % 10, seconds=value.second, microseconds=value.microsecond)
+                                  for value in (staged_min, staged_max)]
+        end = staged_max + timedelta(days=self.calendar_days)
+
+        if time_max is None:
+            start = datetime.strptime(self.calendar_start, '%Y-%m-%d').replace(tzinfo=staged_min.tzinfo)
+            return [(min(start, staged_min), end)]
+        ranges = []
+        if staged_min < time_min:
+            ranges.append((staged_min, time_min - LoadDimensionOperator.time_slot))
+        if staged_max > time_max:
+            ranges.append((time_max + LoadDimensionOperator.time_slot, end))
+        return ranges
+
+    def load_time(self, redshift):
+        """ Extend the calendar of the time table to cover the staged snapshots. If append is False, it is rebuilt. """
+        records = {name: (low, high) for name, low, high in redshift.get_records(
+            SqlQueries.time_table_range.format(availability_table=self.availability_table))}
+        time_range = records['time']
+        staged_range = records['staging']
 
+        statements = []
+        if (self.append == False):
+            statements.append("DELETE FROM time")
+            # The rebuilt calendar covers both the staged snapshots and the previous calendar.
+            values = [value for value in staged_range + time_range if value is not None]
+            staged_range = (min(values), max(values)) if values else (None, None)
+            time_range = (None, None)
+
+        ranges = self.time_ranges(time_range, staged_range)
+        if not ranges:
+            self.log.info(f"The time table already covers the staged snapshots up to {staged_range[1]}")
+            return
+        for start, end in ranges:
+            self.log.info(f"Adding the time slots from {start} to {end} to the time table")
+            statements.append(LoadDimensionOperator.time_extend_sql(start, end))
+        with get_metrics().timer('insert', table=self.table):
+            redshift.run(statements, autocommit=False)
+
+    @instrumented
     def execute(self, context):
         redshift = PostgresHook(postgres_conn_id = self.redshift_conn_id)
+        metrics = get_metrics()
         
+        staged_fingerprint = None
+        if self.fingerprint_tables:
+            staged_fingerprint, loaded_fingerprint = self.staged_fingerprint(redshift)
+            if staged_fingerprint is not None and staged_fingerprint == loaded_fingerprint:
+                self.log.info(f"The staging tables {self.fingerprint_tables} did not change, skipping the { self.table } dimension table")
+                return
+
+        if (self.diff == True or self.history == True):
+            if self.table not in LoadDimensionOperator.dimension_selects:
+                raise ValueError(f"No diff found for table: {self.table}")
+            columns = LoadDimensionOperator.dimension_columns[self.table]
+            row_hash = " || '|' || ".join(f"COALESCE(CAST({column} AS VARCHAR), '<null>')" for column in columns)
+            statements = [SqlQueries.dimension_diff.format(
+                table=self.table,
+                select=LoadDimensionOperator.dimension_selects[self.table].format(
+                    availability_table=self.availability_table),
+                columns=", ".join(columns),
+                row_hash=row_hash,
+            )]
+            if (self.history == True):
+                statements.append(SqlQueries.dimension_history.format(
+                    table=self.table,
+                    key=LoadDimensionOperator.dimension_keys[self.table],
+                    columns=", ".join(columns),
+                    row_hash=row_hash,
+                    valid_from=context['ts'],
+                ))
+            if staged_fingerprint is not None:
+                statements.append(self.fingerprint_record_sql(staged_fingerprint))
+            self.log.info(f"Applying the changed rows to the { self.table } dimension table")
+            # The diff, the history and the fingerprint are committed together, so a failed diff is retried in full.
+            with metrics.timer('insert', table=self.table):
+                redshift.run(statements, autocommit=False)
+            return
+
+        if (self.table == "time"):
+            self.load_time(redshift)
+            return
+
         if (self.append == False):
             self.log.info(f"Clearing data from Redshift {self.table} table")
             redshift.run("DELETE FROM {}".format(self.table))
                 
         self.log.info(f"Start loading the { self.table } fact table")
         if (self.table == "carpark"):
-            redshift.run(SqlQueries.carpark_insert)
+            with metrics.timer('insert', table=self.table):
+                redshift.run(SqlQueries.carpark_insert.format(availability_table=self.availability_table))
         elif(self.table == "weather_stations"):
-            redshift.run(SqlQueries.weather_stations_insert)
-        elif(self.table == "time"):
-            redshift.run(SqlQueries.time_table_insert)
+            with metrics.timer('insert', table=self.table):
+                redshift.run(SqlQueries.weather_stations_insert)
         else:
-            self.log("No table is found.")
\ No newline at end of file
+            self.log("No table is found.")
+            return
+
+        if staged_fingerprint is not None:
+            redshift.run(self.fingerprint_record_sql(staged_fingerprint))
\ No newline at end of file
@@ -2,6 +2,7 @@ from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.metrics import get_metrics, instrumented
 from helpers.sql_queries import SqlQueries
 
 class LoadFactOperator(BaseOperator):
@@ -14,35 +15,75 @@ class LoadFactOperator(BaseOperator):
                 table: The name of the table to run the ingestion
                 append: If append is True, it will append the data from staging to dimension table. 
                         Else, it will clear all the data, before putting data into dimension table.
+                replace_partition: If replace_partition is True, it will only delete the rows with the date_time values
+                        in the staging table, and insert the new ones in the same transaction. So a retried task
+                        does not insert the same date_time twice. It takes precedence over append.
         """
         template_fields = ("table",)
         ui_color = '#F98866'
+        # The staging table each fact table is loaded from.
+        staging_tables = {
+                "temperature_events": "staging_temperature",
+                "rainfall_events": "staging_rainfall",
+                "carpark_availability": "staging_carpark_availability",
+                "carpark_availability_delta": "staging_carpark_availability_delta",
+        }
 
         @apply_defaults
         def __init__(self,
                         redshift_conn_id="",
                         table="",
                         append=True,
+                        replace_partition=False,
                         *args, **kwargs):
                 
                 super(LoadFactOperator, self).__init__(*args, **kwargs)
                 self.redshift_conn_id = redshift_conn_id
                 self.table = table
                 self.append = append
+                self.replace_partition = replace_partition
         
+        @staticmethod
+        def insert_sql(table):
+                """ Return the statement inserting the staged rows into the fact table """
+                if (table == "temperature_events"):
+                        return SqlQueries.temperature_events_insert
+                elif(table == "rainfall_events"):
+                        return SqlQueries.rainfall_events_insert
+                elif(table == "carpark_availability"):
+                        return SqlQueries.carpark_availability_insert
+                elif(table == "carpark_availability_delta"):
+                        return SqlQueries.carpark_availability_delta_insert
+                else:
+                        raise ValueError(f"No table found: {table}")
+
+        @staticmethod
+        def replace_partition_sql(table):
+                """ Return the statements replacing the staged date_time partitions of the fact table """
+                delete_sql = SqlQueries.fact_partition_delete.format(
+                        table=table,
+                        staging_table=LoadFactOperator.staging_tables[table]
+                )
+                return [delete_sql, LoadFactOperator.insert_sql(table)]
+
+        @instrumented
         def execute(self, context):
                 redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+                insert_sql = LoadFactOperator.insert_sql(self.table)
+                metrics = get_metrics()
+
+                if (self.replace_partition == True):
+                        self.log.info(f"Replacing the staged date_time partitions of the { self.table } fact table")
+                        # Both statements run in one transaction, committed at the end.
+                        with metrics.timer('insert', table=self.table):
+                                redshift.run(LoadFactOperator.replace_partition_sql(self.table), autocommit=False)
+                        return
 
                 if (self.append == False):
                         self.log.info(f"Clearing data from Redshift {self.table} table")
-                        redshift.run("DELETE FROM {}".format(self.table))
+                        with metrics.timer('delete', table=self.table):
+                                redshift.run("DELETE FROM {}".format(self.table))
                 
                 self.log.info(f"Start loading the { self.table } fact table")
-                if (self.table == "temperature_events"):
-                        redshift.run(SqlQueries.temperature_events_insert)
-                elif(self.table == "rainfall_events"):
-                        redshift.run(SqlQueries.rainfall_events_insert)
-                elif(self.table == "carpark_availability"):
-                        redshift.run(SqlQueries.carpark_availability_insert)
-                else:
-                        self.log("No table found")
\ No newline at end of file
+                with metrics.timer('insert', table=self.table):
+                        redshift.run(insert_sql)
@@ -1,8 +1,18 @@
+import json
+import re
+from datetime import datetime
+
 from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.fingerprint import FINGERPRINT_SUFFIX
+from helpers.metrics import get_metrics, instrumented
+from helpers.output import COMPRESSION_EXTENSIONS, FILE_EXTENSIONS
+from helpers.sql_queries import SqlQueries
+
 class LoadS3ToRedshiftOperator(BaseOperator):
     """
     The custom operator will clear all the data in the staging table. 
@@ -15,6 +25,20 @@ class LoadS3ToRedshiftOperator(BaseOperator):
         s3_bucket: The name of bucket
         s3_key: The folder and filename
         region: The region used in the AWS environment. Default is us-west-2
+        file_format: The format of the files in S3, either csv or parquet. Default is csv
+        fingerprint: If fingerprint is True, it reads the fingerprint file saved next to s3_key by the helper,
+                and skips the load when the same content is already in the staging table.
+                Else, the data is copied from the file holding the content, and its fingerprint is recorded
+                in the load_fingerprints table in the same transaction.
+        compression: The compression of the csv files, either gzip or zstd. Default is None, which detects it
+                from the extension of the key, e.g. .csv.gz, and means no compression for other keys.
+        batch: If batch is True, s3_key is a prefix. Every file under the prefix with the extension of the
+                file format and compression that is not in the load_ledger table yet is listed in a COPY manifest,
+                and they are all loaded in one COPY. The staging table, the COPY and the ledger of the keys
+                are committed in one transaction, so each key is loaded exactly once.
+        key_pattern: In batch mode, an optional regular expression the keys must match, e.g. to leave out
+                carpark_info files under the carpark_ prefix.
+        manifest_prefix: In batch mode, the folder of the manifests in the bucket.
     """
     template_fields = ("s3_key",)
     ui_color = '#358140'   
@@ -23,11 +47,22 @@ class LoadS3ToRedshiftOperator(BaseOperator):
         FROM '{}'
         ACCESS_KEY_ID '{}'
         SECRET_ACCESS_KEY '{}'
-        REGION '{}'
+        {}
+    """
+    # COPY options for each file format. Parquet files are typed, so no header or time format is needed,
+    # and Redshift requires the bucket to be in the same region as the cluster.
+    format_options = {
+        'csv': """REGION '{region}'
         IGNOREHEADER 1
         CSV
-        timeformat 'auto'        
-    """
+        timeformat 'auto'""",
+        'parquet': """FORMAT AS PARQUET""",
+    }
+    # COPY option for each compression of the csv files.
+    compression_options = {
+        'gzip': 'GZIP',
+        'zstd': 'ZSTD',
+    }
 
     @apply_defaults
     def __init__(self,
@@ -37,6 +72,12 @@ class LoadS3ToRedshiftOperator(BaseOperator):
                     s3_bucket="",
                     s3_key="",
                     region="us-west-2",
+                    file_format="csv",
+                    fingerprint=False,
+                    compression=None,
+                    batch=False,
+                    key_pattern=None,
+                    manifest_prefix="manifests",
                     *args, **kwargs):
         
         super(LoadS3ToRedshiftOperator, self).__init__(*args, **kwargs)
@@ -46,24 +87,140 @@ class LoadS3ToRedshiftOperator(BaseOperator):
         self.s3_bucket = s3_bucket
         self.s3_key = s3_key
         self.region = region
+        self.file_format = file_format
+        self.fingerprint = fingerprint
+        self.compression = compression
+        self.batch = batch
+        self.key_pattern = key_pattern
+        self.manifest_prefix = manifest_prefix
+
+    @staticmethod
+    def detect_compression(key):
+        """ Return the compression of the file from the extension of its key, or None """
+        for compression, extension in COMPRESSION_EXTENSIONS.items():
+            if key.endswith('.' + extension):
+                return compression
+        return None
+
+    @staticmethod
+    def copy_options(file_format, region, compression=None):
+        """ Return the COPY options of the file format and compression """
+        copy_options = LoadS3ToRedshiftOperator.format_options[file_format].format(region=region)
+        if compression is not None:
+            copy_options += "\n        " + LoadS3ToRedshiftOperator.compression_options[compression]
+        return copy_options
 
+    def batch_keys(self, s3, prefix, redshift):
+        """ Return the keys under the prefix that were not loaded in the table yet, in the order of their names """
+        extension = '.' + FILE_EXTENSIONS[self.file_format]
+        if self.compression is not None:
+            extension += '.' + COMPRESSION_EXTENSIONS[self.compression]
+        keys = [key for key in (s3.list_keys(self.s3_bucket, prefix=prefix) or [])
+                if key.endswith(extension) and (self.key_pattern is None or re.fullmatch(self.key_pattern, key))]
+        loaded = set(key for key, in redshift.get_records(SqlQueries.load_ledger_select,
+                                                         parameters=(self.table, prefix + '%')))
+        return sorted(key for key in keys if key not in loaded)
+
+    def write_manifest(self, s3, keys, context):
+        """ Write the COPY manifest of the keys to S3, and return its key """
+        entries = []
+        for key in keys:
+            entry = {'url': "s3://{}/{}".format(self.s3_bucket, key), 'mandatory': True}
+            if self.file_format == 'parquet':
+                # Redshift needs the size of each Parquet file in the manifest.
+                entry['meta'] = {'content_length': s3.get_key(key, self.s3_bucket).content_length}
+            entries.append(entry)
+        manifest_key = "{}/{}_{}.manifest".format(self.manifest_prefix, self.table, context['ts_nodash'])
+        s3.load_string(json.dumps({'entries': entries}), manifest_key, bucket_name=self.s3_bucket, replace=True)
+        return manifest_key
+
+    def execute_batch(self, context, redshift, credentials, copy_options):
+        """ Load every file under the s3_key prefix that is not in the load ledger in one COPY and one commit """
+        s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+        prefix = self.s3_key.format(**context)
+        keys = self.batch_keys(s3, prefix, redshift)
+        delete_sql = "DELETE FROM {}".format(self.table)
+        if not keys:
+            self.log.info(f"No new files under {prefix}, clearing the {self.table} table")
+            redshift.run(delete_sql)
+            return
+
+        manifest_key = self.write_manifest(s3, keys, context)
+        self.log.info(f"Copying {len(keys)} files listed in {manifest_key} to Redshift {self.table} table")
+        copy_sql = LoadS3ToRedshiftOperator.copy_sql.format(
+            self.table,
+            "s3://{}/{}".format(self.s3_bucket, manifest_key),
+            credentials.access_key,
+            credentials.secret_key,
+            copy_options + "\n        MANIFEST",
+        )
+        ledger_sql = SqlQueries.load_ledger_insert.format(values=",\n".join(
+            "('{}', '{}', '{}', '{}')".format(self.table, key, manifest_key, datetime.utcnow().isoformat())
+            for key in keys))
+        # The staging table and the ledger of the keys are replaced in one transaction and one commit.
+        metrics = get_metrics()
+        with metrics.timer('copy', table=self.table):
+            redshift.run([delete_sql, copy_sql, ledger_sql], autocommit=False)
+        metrics.count('files_copied', len(keys), table=self.table)
+
+    @instrumented
     def execute(self, context):
+        if self.file_format not in LoadS3ToRedshiftOperator.format_options:
+            raise ValueError(f"Unknown file format: {self.file_format}")
+        if self.compression is not None and (self.file_format != 'csv'
+                or self.compression not in LoadS3ToRedshiftOperator.compression_options):
+            raise ValueError(f"Unsupported compression for {self.file_format} files: {self.compression}")
+
         aws_hook = AwsHook(self.aws_credentials_id)
         credentials = aws_hook.get_credentials()
         redshift = PostgresHook(postgres_conn_id = self.redshift_conn_id)
+
+        if (self.batch == True):
+            self.execute_batch(context, redshift, credentials,
+                               self.copy_options(self.file_format, self.region, self.compression))
+            return
+
+        rendered_key = self.s3_key.format(**context)
+
+        if (self.fingerprint == True):
+            s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+            fingerprint = json.loads(s3.read_key(rendered_key + FINGERPRINT_SUFFIX, self.s3_bucket))
+            loaded = dict(redshift.get_records(SqlQueries.load_fingerprint_select.format(tables=f"'{self.table}'")))
+            if loaded.get(self.table) == fingerprint['fingerprint']:
+                self.log.info(f"The content of {rendered_key} is already in the {self.table} table, skipping the load")
+                return
+            # The file of this run is not written when the content did not change, so copy the file holding it.
+            rendered_key = fingerprint['data_key']
         
         self.log.info(f"Clearing data from destination Redshift {self.table} table")
-        redshift.run("DELETE FROM {}".format(self.table))
+        delete_sql = "DELETE FROM {}".format(self.table)
+        if (self.fingerprint == False):
+            redshift.run(delete_sql)
         
         self.log.info(f"Copying data from s3 to Redshift {self.table} table")
-        rendered_key = self.s3_key.format(**context)
+        compression = self.compression
+        if compression is None and self.file_format == 'csv':
+            compression = self.detect_compression(rendered_key)
         s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
         formatted_sql = LoadS3ToRedshiftOperator.copy_sql.format(
             self.table,
             s3_path,
             credentials.access_key,
             credentials.secret_key,
-            self.region,
+            self.copy_options(self.file_format, self.region, compression),
         )
         
-        redshift.run(formatted_sql)
\ No newline at end of file
+        if (self.fingerprint == True):
+            record_sql = SqlQueries.load_fingerprint_record.format(
+                table=self.table,
+                fingerprint=fingerprint['fingerprint'],
+                source=rendered_key,
+                loaded_at=datetime.utcnow().isoformat(),
+            )
+            # The staging table and its fingerprint are replaced in one transaction.
+            with get_metrics().timer('copy', table=self.table):
+                redshift.run([delete_sql, formatted_sql, record_sql], autocommit=False)
+            return
+
+        with get_metrics().timer('copy', table=self.table):
+            redshift.run(formatted_sql)
\ No newline at end of file
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pandas as pd
+
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+from helpers.fingerprint import dataframe_fingerprint
+from helpers.geo import nearest_stations
+from helpers.metrics import get_metrics, instrumented
+from helpers.sql_queries import SqlQueries
+
+class NearestStationOperator(BaseOperator):
+    """
+    The custom operator to build the bridge table between the carparks and their nearest weather stations,
+    so the carpark availability can be joined to the temperature and rainfall events.
+
+    It reads the coordinates of the carpark and weather_stations dimension tables, finds the k nearest
+    stations of every carpark by haversine distance, and replaces the bridge table in one transaction.
+    The fingerprint of both dimensions is saved in load_fingerprints, so the bridge is only rebuilt
+    when either of them changed.
+
+    Args:
+        redshift_conn_id: The configuration to connect to Redshift
+        table: The name of the bridge table. Default is carpark_station
+        k: The number of nearest stations of each carpark. Default is 3
+    """
+    ui_color = '#80BD9E'
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 table="carpark_station",
+                 k=3,
+                 *args, **kwargs):
+
+        super(NearestStationOperator, self).__init__(*args, **kwargs)
+        self.redshift_conn_id = redshift_conn_id
+        self.table = table
+        self.k = k
+
+    @instrumented
+    def execute(self, context):
+        redshift = PostgresHook(postgres_conn_id = self.redshift_conn_id)
+        metrics = get_metrics()
+
+        carparks = pd.DataFrame(redshift.get_records(SqlQueries.carpark_coordinates_select),
+                                columns=['carpark_id', 'carpark_latitude', 'carpark_longitude'])
+        stations = pd.DataFrame(redshift.get_records(SqlQueries.weather_stations_coordinates_select),
+                                columns=['station_id', 'station_latitude', 'station_longitude'])
+
+        fingerprint = "|".join([dataframe_fingerprint(carparks), dataframe_fingerprint(stations), str(self.k)])
+        loaded = dict(redshift.get_records(SqlQueries.load_fingerprint_select.format(tables=f"'{self.table}'")))
+        if loaded.get(self.table) == fingerprint:
+            self.log.info(f"The carpark and weather_stations tables did not change, skipping the {self.table} table")
+            return
+
+        with metrics.timer('transform', table=self.table):
+            bridge = nearest_stations(carparks, stations, self.k)
+        self.log.info(f"Found the {self.k} nearest of {len(stations)} weather stations for {len(carparks)} carparks")
+
+        statements = ["DELETE FROM {}".format(self.table)]
+        if not bridge.empty:
+            statements.append(SqlQueries.carpark_station_insert.format(table=self.table, values=",\n".join(
+                "('{}', '{}', {}, {:.3f})".format(str(carpark_id).replace("'", "''"), str(station_id).replace("'", "''"),
+                                                  station_rank, distance_km)
+                for carpark_id, station_id, station_rank, distance_km in bridge.itertuples(index=False, name=None))))
+        statements.append(SqlQueries.load_fingerprint_record.format(
+            table=self.table,
+            fingerprint=fingerprint,
+            source="carpark, weather_stations",
+            loaded_at=datetime.utcnow().isoformat(),
+        ))
+        # The bridge and its fingerprint are replaced in one transaction.
+        with metrics.timer('insert', table=self.table):
+            redshift.run(statements, autocommit=False)
+        metrics.count('rows_inserted', len(bridge), table=self.table)
+        self.log.info(f"Loaded {len(bridge)} rows to the {self.table} table")
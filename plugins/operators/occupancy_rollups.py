@@ -0,0 +1,173 @@
+import time
+from datetime import datetime, timedelta
+
+from croniter import croniter
+
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator, DagModel, DagRun
+from airflow.utils import timezone
+from airflow.utils.db import provide_session
+from airflow.utils.decorators import apply_defaults
+from airflow.utils.state import State
+
+from helpers.metrics import get_metrics, instrumented
+from helpers.sql_queries import SqlQueries
+
+
+class OccupancyRollupOperator(BaseOperator):
+    """
+    The custom operator to maintain the hourly, daily and weekly occupancy rollups of every carpark.
+
+    Each rollup keeps, per bucket and carpark, the MIN, MAX, SUM and COUNT of the lots available, and the
+    occupancy ratio against the total_lots of the carpark dimension. Only the buckets touched by the date_times
+    in the staging table, i.e. the rows loaded by this run, are recomputed: the hourly buckets from the fact table,
+    the daily buckets from the hourly ones and the weekly buckets from the daily ones, all in one transaction.
+    So the dashboards can read the rollups instead of the 10 minutes facts.
+
+    The carpark dimension is loaded by another DAG, so with dimension_dag_id the operator first waits for the
+    run of that DAG due before the execution time, i.e. the latest run started at or before it, and only while
+    that run is queued or running, which is one lookup of the Airflow metadata database on every other run.
+    It does not wait when the dimension DAG is paused, has not started yet or its run failed, nor after the
+    dimension_timeout: the current dimension tables are used, and the touched buckets are still recomputed.
+
+    Args:
+        redshift_conn_id: Configuration to connect to Redshift.
+        origin_table: The fact table of the carpark availability. Default is carpark_availability
+        table_prefix: The prefix of the rollup tables, followed by the name of the grain,
+                      e.g. carpark_occupancy_hourly. Default is carpark_occupancy
+        incremental: If incremental is True, only the buckets of the date_times in the staging_table are recomputed,
+                     whether they are new, backfilled or replaced. A run with incremental False recomputes everything.
+        staging_table: The staging table of the origin_table, only needed when incremental is True.
+        dimension_dag_id: The DAG loading the carpark dimension, to wait for. Default is no wait
+        dimension_schedule: The cron schedule of the dimension DAG, e.g. '0 3 25 * *'.
+        dimension_timeout: The seconds to wait for the dimension run. Default is 2 hours
+        dimension_poke_interval: The seconds between two lookups of the dimension run. Default is 5 minutes
+    """
+    ui_color = '#5934eb'
+    # The grains of the rollups, from the finest to the coarsest, and their DATE_TRUNC unit.
+    grains = [
+        ("hourly", "hour"),
+        ("daily", "day"),
+        ("weekly", "week"),
+    ]
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 origin_table="carpark_availability",
+                 table_prefix="carpark_occupancy",
+                 incremental=True,
+                 staging_table="",
+                 dimension_dag_id="",
+                 dimension_schedule="",
+                 dimension_timeout=2 * 60 * 60,
+                 dimension_poke_interval=5 * 60,
+                 *args, **kwargs):
+
+        super(OccupancyRollupOperator, self).__init__(*args, **kwargs)
+        if incremental and not staging_table:
+            raise ValueError("The incremental mode needs the staging_table of the origin_table")
+        if dimension_dag_id and not dimension_schedule:
+            raise ValueError("Waiting for the dimension DAG needs its dimension_schedule")
+        self.redshift_conn_id = redshift_conn_id
+        self.origin_table = origin_table
+        self.table_prefix = table_prefix
+        self.incremental = incremental
+        self.staging_table = staging_table
+        self.dimension_dag_id = dimension_dag_id
+        self.dimension_schedule = dimension_schedule
+        self.dimension_timeout = dimension_timeout
+        self.dimension_poke_interval = dimension_poke_interval
+
+    def due_execution_date(self, execution_date):
+        """ Return the execution date of the latest run of the dimension DAG started at or before the execution date """
+        execution_date = timezone.make_naive(execution_date, timezone.utc)
+        # A run starts at the end of its interval, i.e. the run of the 25th of July starts on the 25th of August.
+        # croniter excludes the start time from get_prev, so a run started exactly at the execution date is included.
+        started = croniter(self.dimension_schedule, execution_date + timedelta(seconds=1)).get_prev(datetime)
+        due = croniter(self.dimension_schedule, started).get_prev(datetime)
+        return timezone.make_aware(due, timezone.utc)
+
+    @provide_session
+    def dimension_in_progress(self, execution_date, session=None):
+        """ Return whether the run of the dimension DAG due before the execution date is queued or running """
+        dag = session.query(DagModel).filter(DagModel.dag_id == self.dimension_dag_id).first()
+        if dag is None or dag.is_paused:
+            self.log.info(f"The {self.dimension_dag_id} DAG is not active, using the current dimension tables")
+            return False
+
+        due = self.due_execution_date(execution_date)
+        dag_runs = DagRun.find(dag_id=self.dimension_dag_id, execution_date=due, session=session)
+        if not dag_runs:
+            first_run = (session.query(DagRun)
+                         .filter(DagRun.dag_id == self.dimension_dag_id)
+                         .order_by(DagRun.execution_date)
+                         .first())
+            if first_run is None or first_run.execution_date > due:
+                self.log.info(f"No run of {self.dimension_dag_id} is due at {due}, using the current dimension tables")
+                return False
+            self.log.info(f"Waiting for the scheduler to create the {due} run of {self.dimension_dag_id}")
+            return True
+
+        state = dag_runs[0].state
+        if state == State.RUNNING or state is None:
+            self.log.info(f"Waiting for the {due} run of {self.dimension_dag_id}, which is {state}")
+            return True
+        if state != State.SUCCESS:
+            self.log.warning(f"The {due} run of {self.dimension_dag_id} is {state}, using the current dimension tables")
+        return False
+
+    def wait_for_dimension(self, execution_date):
+        """ Wait while the due run of the dimension DAG is in progress, at most dimension_timeout seconds """
+        started = time.monotonic()
+        while self.dimension_in_progress(execution_date):
+            if time.monotonic() - started >= self.dimension_timeout:
+                self.log.warning(f"Timed out waiting for {self.dimension_dag_id}, using the current dimension tables")
+                return
+            time.sleep(self.dimension_poke_interval)
+
+    def rollup_sql(self):
+        """ Return the statements recomputing the touched buckets of every grain """
+        tables = [f"{self.table_prefix}_{name}" for name, _ in OccupancyRollupOperator.grains]
+        finest_table = tables[0]
+        finest_grain = OccupancyRollupOperator.grains[0][1]
+
+        statements = []
+        if self.incremental:
+            statements.append(SqlQueries.rollup_touched_from_staging.format(
+                table=finest_table, grain=finest_grain, staging_table=self.staging_table))
+        else:
+            statements.extend("DELETE FROM {};".format(table) for table in tables)
+            statements.append(SqlQueries.rollup_touched_from_origin.format(
+                table=finest_table, grain=finest_grain, origin_table=self.origin_table))
+
+        statements.append(SqlQueries.rollup_from_origin.format(
+            table=finest_table,
+            grain=finest_grain,
+            origin_table=self.origin_table,
+            columns=SqlQueries.rollup_columns,
+        ))
+        for source_table, table, (_, grain) in zip(tables, tables[1:], OccupancyRollupOperator.grains[1:]):
+            statements.append(SqlQueries.rollup_from_finer.format(
+                table=table,
+                grain=grain,
+                source_table=source_table,
+                columns=SqlQueries.rollup_columns,
+            ))
+        statements.extend("DROP TABLE {}_touched;".format(table) for table in tables)
+        return "\n".join(statements)
+
+    @instrumented
+    def execute(self, context):
+        if self.dimension_dag_id:
+            self.wait_for_dimension(context['execution_date'])
+
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+
+        if self.incremental:
+            self.log.info(f"Updating the {self.table_prefix} rollups with the rows in {self.staging_table}")
+        else:
+            self.log.info(f"Recomputing the {self.table_prefix} rollups")
+        # All the grains are updated in one transaction.
+        with get_metrics().timer('insert', table=self.table_prefix):
+            redshift.run(self.rollup_sql(), autocommit=False)
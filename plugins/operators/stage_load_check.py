@@ -0,0 +1,210 @@
+import json
+from datetime import datetime
+
+from airflow.contrib.hooks.aws_hook import AwsHook
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.hooks.S3_hook import S3Hook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+
+from helpers.metrics import get_metrics, instrumented
+from helpers.quality_checks import (HISTORY_INSERT, HISTORY_SELECT, QUALITY_CHECKS,
+                                    evaluate, new_run_id, profile_sql)
+from helpers.sql_queries import SqlQueries
+from operators.load_fact import LoadFactOperator
+from operators.load_to_redshift import LoadS3ToRedshiftOperator
+
+class StageLoadCheckOperator(BaseOperator):
+    """
+    The custom operator to stage, load and check one fact dataset in a single task.
+
+    It does the work of LoadS3ToRedshiftOperator, LoadFactOperator with replace_partition and
+    DataQualityOperator on one connection and in one transaction: it clears the staging table, copies
+    the file from S3, replaces the staged date_time partitions of the fact table, and profiles both tables
+    with the checks of the fact table in the QUALITY_CHECKS registry. The transaction is committed only
+    if every check passes. Else, it is rolled back, so neither the staging nor the fact table change,
+    the metrics are saved in data_quality_history on their own, and it throws an error.
+
+    The staging table is cleared with DELETE rather than TRUNCATE, because TRUNCATE commits the transaction in Redshift.
+
+    With stage=False, e.g. in the offline mode of the DAG, the staging table was already filled by the helper
+    with postgres_conn_id, see helpers/postgres_loader.py, so only the load and the checks run in the transaction.
+
+    Args:
+        aws_credentials_id: The access and secret keys to access AWS resources (i.e. S3 bucket)
+        redshift_conn_id: The configuration to connect to Redshift
+        table: The name of the fact table. The staging table is the one it is loaded from in LoadFactOperator.
+        s3_bucket: The name of bucket
+        s3_key: The folder and filename
+        execution_time: The execution time, used to check the rows loaded at that time.
+        region: The region used in the AWS environment. Default is us-west-2
+        file_format: The format of the files in S3, either csv or parquet. Default is csv
+        compression: The compression of the csv files, either gzip or zstd. Default is None, which detects it
+                from the extension of the key.
+        stage: If False, the rows already in the staging table are loaded and checked, without clearing it
+                and copying the file from S3. Default is True
+        archive_key: The key of the record of the run in the raw archive, e.g. raw/carpark/runs/{{ ts_nodash }}.json.
+                When the payload of the run is identical to the previous run, the helper did not save a file,
+                and nothing is staged, loaded or checked. Default is None, which always loads the file.
+        carry_forward: If True, a run whose payload is identical to the previous run gets a copy of the rows of
+                that run at its execution time instead, so the fact table has no gap. Only for the fact tables
+                stamped with the execution time, i.e. carpark_availability. Default is False
+    """
+    template_fields = ("s3_key", "execution_time", "archive_key")
+    ui_color = '#F9C966'
+
+    # The weather readings are stamped with their own timestamp, so an identical payload is already loaded.
+    carry_forward_sql = {
+        "carpark_availability": SqlQueries.carpark_availability_carry_forward,
+    }
+
+    @apply_defaults
+    def __init__(self,
+                 aws_credentials_id="",
+                 redshift_conn_id="",
+                 table="",
+                 s3_bucket="",
+                 s3_key="",
+                 execution_time="",
+                 region="us-west-2",
+                 file_format="csv",
+                 compression=None,
+                 stage=True,
+                 archive_key=None,
+                 carry_forward=False,
+                 *args, **kwargs):
+
+        super(StageLoadCheckOperator, self).__init__(*args, **kwargs)
+        self.aws_credentials_id = aws_credentials_id
+        self.redshift_conn_id = redshift_conn_id
+        self.table = table
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.execution_time = execution_time
+        self.region = region
+        self.file_format = file_format
+        self.compression = compression
+        self.stage = stage
+        self.archive_key = archive_key
+        self.carry_forward = carry_forward
+
+    def is_unchanged(self):
+        """ Return the record of the run if the raw archive recorded its payload as identical to the previous run, else None """
+        s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+        if not s3.check_for_key(self.archive_key, self.s3_bucket):
+            return None
+        record = json.loads(s3.read_key(self.archive_key, self.s3_bucket))
+        return record if record.get('unchanged', False) else None
+
+    def copy_previous_partition(self, record, context):
+        """ Replace the rows of the execution time with the rows of the previous run the payload is identical to """
+        # The records archived before the previous run was kept in them are identical to the previous scheduled run.
+        previous = record.get('previous_ts_nodash') or datetime.strftime(context['prev_execution_date'], '%Y%m%dT%H%M%S')
+        parameters = {
+            'date_time': datetime.strftime(datetime.strptime(self.execution_time, '%Y%m%dT%H%M%S'), "%Y-%m-%d %H:%M:%S"),
+            'previous': datetime.strftime(datetime.strptime(previous, '%Y%m%dT%H%M%S'), "%Y-%m-%d %H:%M:%S"),
+        }
+
+        metrics = get_metrics()
+        redshift = PostgresHook(postgres_conn_id = self.redshift_conn_id)
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            with metrics.timer('insert', table=self.table):
+                cursor.execute("DELETE FROM {} WHERE date_time = %(date_time)s".format(self.table), parameters)
+                cursor.execute(self.carry_forward_sql[self.table], parameters)
+                rows = cursor.rowcount
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        metrics.count('rows_inserted', rows, table=self.table)
+        if not rows:
+            self.log.warning(f"No {self.table} rows at {parameters['previous']} to copy to {parameters['date_time']}")
+        self.log.info(f"Copied {rows} {self.table} rows of the identical run at {parameters['previous']} to {parameters['date_time']}")
+
+    @instrumented
+    def execute(self, context):
+        if self.table not in LoadFactOperator.staging_tables:
+            raise ValueError(f"No table found: {self.table}")
+        if self.file_format not in LoadS3ToRedshiftOperator.format_options:
+            raise ValueError(f"Unknown file format: {self.file_format}")
+        if self.carry_forward and self.table not in self.carry_forward_sql:
+            raise ValueError(f"The rows of {self.table} cannot be carried forward")
+        staging_table = LoadFactOperator.staging_tables[self.table]
+        record = self.is_unchanged() if self.archive_key else None
+        if record is not None:
+            self.log.info(f"The payload of {self.archive_key} is identical to the previous run, skipping the {self.table} load")
+            if self.carry_forward:
+                self.copy_previous_partition(record, context)
+            return
+        checks = [check for check in QUALITY_CHECKS['fact'] if check['target_table'] == self.table]
+
+        if self.stage:
+            credentials = AwsHook(self.aws_credentials_id).get_credentials()
+            rendered_key = self.s3_key.format(**context)
+            compression = self.compression
+            if compression is None and self.file_format == 'csv':
+                compression = LoadS3ToRedshiftOperator.detect_compression(rendered_key)
+            copy_sql = LoadS3ToRedshiftOperator.copy_sql.format(
+                staging_table,
+                "s3://{}/{}".format(self.s3_bucket, rendered_key),
+                credentials.access_key,
+                credentials.secret_key,
+                LoadS3ToRedshiftOperator.copy_options(self.file_format, self.region, compression),
+            )
+
+        e_time = datetime.strftime(datetime.strptime(self.execution_time, '%Y%m%dT%H%M%S'), "%Y-%m-%d %H:%M:%S")
+        parameters = {
+            'run_id': new_run_id(),
+            'run_time': datetime.utcnow(),
+            'execution_time': e_time,
+        }
+
+        metrics = get_metrics()
+        redshift = PostgresHook(postgres_conn_id = self.redshift_conn_id)
+        conn = redshift.get_conn()
+        try:
+            cursor = conn.cursor()
+            if self.stage:
+                self.log.info(f"Copying {rendered_key} to the {staging_table} table")
+                with metrics.timer('copy', table=staging_table):
+                    cursor.execute("DELETE FROM {}".format(staging_table))
+                    cursor.execute(copy_sql)
+            else:
+                self.log.info(f"Loading the rows already staged in the {staging_table} table")
+            self.log.info(f"Replacing the staged date_time partitions of the {self.table} fact table")
+            with metrics.timer('insert', table=self.table):
+                for sql in LoadFactOperator.replace_partition_sql(self.table):
+                    cursor.execute(sql)
+                metrics.count('rows_inserted', cursor.rowcount, table=self.table)
+
+            self.log.info(f"Profiling {[check['name'] for check in checks]} at {e_time}")
+            with metrics.timer('check', table=self.table):
+                cursor.execute(profile_sql(checks), parameters)
+                records = cursor.fetchall()
+            failures = evaluate(checks, records)
+            if not failures:
+                with metrics.timer('commit', table=self.table):
+                    conn.commit()
+            else:
+                cursor.execute(HISTORY_SELECT, parameters)
+                history = cursor.fetchall()
+                conn.rollback()
+                # Keep the metrics of the failed run, without the staged and loaded rows.
+                cursor.executemany(HISTORY_INSERT, history)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        for name, role, row_count, null_count, duplicate_count, min_value, max_value in records:
+            self.log.info(f"{name} {role}: {row_count} rows, {null_count} nulls, {duplicate_count} duplicate keys, "
+                          f"min {min_value}, max {max_value}")
+        if failures:
+            raise ValueError("Data Quality check failed, the load was rolled back. " + "; ".join(failures))
+        self.log.info(f"Staged, loaded and checked the {self.table} fact table, run id {parameters['run_id']}")